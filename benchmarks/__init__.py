@@ -0,0 +1 @@
+"""Benchmarks of the analysis core on synthetic TCGA-scale data."""
@@ -0,0 +1,246 @@
+"""Timed scenarios over synthetic data, written to JSON and compared against a baseline.
+
+    python -m benchmarks.run --samples 10000 --genes 1000 --out bench.json
+    python -m benchmarks.run --samples 10000 --genes 1000 --compare bench.json
+
+Every scenario is timed ``--repeat`` times (the median is what gets compared) and then
+run once more under tracemalloc for its peak memory. ``--compare`` exits with status 1
+when a scenario got slower than ``--tolerance`` times its baseline median.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import synthetic
+from tcga_ddr.analysis import Datasets
+from tcga_ddr.charts import (FOOTPRINT_CHARTS_PER_PAGE, at_risk_table, footprint_bar_options, footprint_heatmap_options,
+                             footprint_split_options, km_chart_options)
+from tcga_ddr.cohorts import ALL_GENES, ANY_GENES, GeneLossIndex, cohort_labels
+from tcga_ddr.data import sample_dictionary
+from tcga_ddr.footprints import FootprintIndex
+from tcga_ddr.heatmap import BY_CANCER_TYPE, clustered_heatmap, footprint_means
+from tcga_ddr.logrank import multivariate_logrank, pairwise_logrank
+from tcga_ddr.survival import ENDPOINTS, KaplanMeier, SurvivalIndex
+
+# Building the gene-loss DataFrame itself is skipped above this many cells
+MAX_FRAME_CELLS = 50_000_000
+
+
+def random_deficiencies(genes, k, rng, genes_per_deficiency=3):
+    return [{
+        'name': f'D{i + 1}',
+        'genes': list(rng.choice(genes, size=genes_per_deficiency, replace=False)),
+        'mutation_type': ANY_GENES if i % 2 == 0 else ALL_GENES,
+    } for i in range(k)]
+
+
+def build_scenarios(samples, genes, seed):
+    """Scenario name -> zero-argument callable, with all data generated up front.
+
+    Also returns the in-memory size (MB) of each loaded index.
+    """
+    rng = np.random.default_rng(seed)
+    scenarios = {}
+    if samples * genes <= MAX_FRAME_CELLS:
+        gene_loss = synthetic.gene_loss_frame(samples, genes, seed=seed)
+        scenarios['index gene loss'] = lambda: GeneLossIndex.from_frame(gene_loss)
+    survival = synthetic.survival_frame(samples, seed=seed + 1)
+    footprint = synthetic.footprint_frame(samples, seed=seed + 2)
+    scenarios['index survival'] = lambda: SurvivalIndex(survival)
+    scenarios['index footprints'] = lambda: FootprintIndex.from_frame(footprint)
+
+    datasets = Datasets(synthetic.gene_loss_index(samples, genes, seed=seed), SurvivalIndex(survival),
+                        FootprintIndex.from_frame(footprint))
+    index = datasets.gene_loss
+    all_types = index.cancer_types
+
+    def grouping(deficiencies):
+        def run():
+            # Masks are memoized per index; clear them so every repeat does the full work
+            index._masks.clear()
+            cohorts = index.assign(deficiencies, all_types)
+            cohorts.contingency()
+            return cohorts
+        return run
+
+    for k in range(1, 11):
+        scenarios[f'grouping {k} deficiencies'] = grouping(random_deficiencies(index.genes, k, rng))
+
+    # Three deficiencies, i.e. eight cohorts, for the downstream scenarios
+    cohorts = index.assign(random_deficiencies(index.genes, 3, rng), all_types)
+    all_groups = list(range(len(cohorts.names)))
+    survival_codes = cohorts.codes_for(datasets.survival_positions)
+    footprint_codes = cohorts.codes_for(datasets.footprint_positions)
+
+    def survival_endpoint(endpoint):
+        def run():
+            endpoint_data = datasets.survival[endpoint]
+            km = KaplanMeier.fit(endpoint_data, endpoint_data.labels(survival_codes, all_groups), len(all_groups))
+            non_empty = [i for i in all_groups if km.n[i]]
+            pairwise_logrank(km.deaths, km.at_risk, list(itertools.combinations(non_empty, 2)))
+            multivariate_logrank(km.deaths, km.at_risk)
+            return km
+        return run
+
+    for endpoint in ENDPOINTS:
+        scenarios[f'survival {endpoint}'] = survival_endpoint(endpoint)
+
+    def km_chart():
+        # The interactive chart and number-at-risk table of the survival page
+        endpoint_data = datasets.survival['OS']
+        km = KaplanMeier.fit(endpoint_data, endpoint_data.labels(survival_codes, all_groups), len(all_groups))
+        names = [str(group) for group in all_groups]
+        at_risk_table(km, names)
+        return json.dumps(km_chart_options(km, names))
+
+    scenarios['km chart OS'] = km_chart
+
+    def footprints_display_all():
+        # What the footprint page does for 'Display All' split by cancer type
+        footprint_index = datasets.footprint
+        cube = footprint_index.aggregate(cohort_labels(footprint_codes, all_groups), len(all_groups))
+        for feature in footprint_index.features:
+            cube.group_stats(feature)
+            for group in all_groups:
+                cube.cancer_type_stats(feature, group, footprint_index.cancer_types)
+        return cube
+
+    scenarios['footprints display all'] = footprints_display_all
+
+    def footprints_first_page():
+        # What the footprint page draws for 'Display All': one page of charts, split and unsplit
+        footprint_index = datasets.footprint
+        page = footprint_index.features[:FOOTPRINT_CHARTS_PER_PAGE]
+        cube = footprint_index.aggregate(cohort_labels(footprint_codes, all_groups), len(all_groups), features=page)
+        names = [str(group) for group in all_groups]
+        charts = []
+        for feature in page:
+            means = [round(float(mean), 1) for mean in cube.group_means(feature)]
+            charts.append(footprint_bar_options(feature, names, names, means, 15, [(m, m) for m in means], 'SEM'))
+            by_type = [cube.cancer_type_means(feature, group, footprint_index.cancer_types).round(1)
+                       for group in all_groups]
+            categories = sorted(set().union(*(means.index for means in by_type)))
+            charts.append(footprint_split_options(feature, names, categories,
+                                                  [[means.get(c) for means in by_type if c in means.index]
+                                                   for c in categories], {}))
+        return json.dumps(charts)
+
+    scenarios['footprints first page'] = footprints_first_page
+
+    def footprints_heatmap():
+        # The clustered heatmap of every feature with one row per cohort and cancer type
+        footprint_index = datasets.footprint
+        cube = footprint_index.aggregate(cohort_labels(footprint_codes, all_groups), len(all_groups))
+        names = [str(group) for group in all_groups]
+        z, means = clustered_heatmap(footprint_means(cube, names, footprint_index.cancer_types, BY_CANCER_TYPE))
+        return json.dumps(footprint_heatmap_options(z, means))
+
+    scenarios['footprints heatmap'] = footprints_heatmap
+    memory = {
+        'gene loss': index.nbytes, 'survival': datasets.survival.nbytes,
+        'footprints': datasets.footprint.nbytes, 'sample dictionary': sample_dictionary().nbytes,
+    }
+    return scenarios, {name: nbytes / 2 ** 20 for name, nbytes in memory.items()}
+
+
+def measure(function, repeat, memory=True):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    result = {'seconds_median': statistics.median(times), 'seconds_min': min(times), 'repeat': repeat}
+    if memory:
+        tracemalloc.start()
+        try:
+            function()
+            result['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print current vs baseline medians; return the names of scenarios that regressed."""
+    regressions = []
+    print(f"{'scenario':32} {'baseline s':>11} {'current s':>10} {'ratio':>7}")
+    for name, current in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if before is None:
+            print(f'{name:32} {"-":>11} {current["seconds_median"]:10.4f}')
+            continue
+        ratio = current['seconds_median'] / before['seconds_median']
+        flag = '  SLOWER' if ratio > tolerance else ''
+        print(f'{name:32} {before["seconds_median"]:11.4f} {current["seconds_median"]:10.4f} {ratio:7.2f}{flag}')
+        if ratio > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run', description=__doc__.splitlines()[0])
+    parser.add_argument('--samples', type=int, default=10_000, help='number of samples (default: 10000)')
+    parser.add_argument('--genes', type=int, default=1_000, help='number of genes (default: 1000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per scenario (default: 3)')
+    parser.add_argument('--only', nargs='+', help='run only scenarios whose name starts with one of these')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slowdown ratio reported as a regression (default: 1.25)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    scenarios, memory = build_scenarios(args.samples, args.genes, args.seed)
+    print(f'generated {args.samples} samples x {args.genes} genes in {time.perf_counter() - start:.1f}s; '
+          + ', '.join(f'{name} {mb:.1f} MB' for name, mb in memory.items()), file=sys.stderr)
+
+    results = {
+        'meta': {
+            'samples': args.samples, 'genes': args.genes, 'seed': args.seed,
+            'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+            'revision': git_revision(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'index_mb': memory,
+        },
+        'scenarios': {},
+    }
+    for name, function in scenarios.items():
+        if args.only and not name.startswith(tuple(args.only)):
+            continue
+        results['scenarios'][name] = measure(function, args.repeat, memory=not args.no_memory)
+        result = results['scenarios'][name]
+        peak = f", peak {result['peak_mb']:.1f} MB" if 'peak_mb' in result else ''
+        print(f"{name}: {result['seconds_median']:.4f}s{peak}", file=sys.stderr)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if baseline['meta']['samples'] != args.samples or baseline['meta']['genes'] != args.genes:
+            print('warning: the baseline was run on a different data size', file=sys.stderr)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
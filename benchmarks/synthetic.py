@@ -0,0 +1,106 @@
+"""Synthetic gene-loss, survival and footprint tables shaped like the TCGA workbooks.
+
+Everything is drawn from a seeded generator, so a given size always produces the same
+tables. Gene loss is also available directly as a GeneLossIndex, built chunk by chunk,
+because the DataFrame of a million samples by a thousand genes does not fit in memory.
+"""
+import numpy as np
+import pandas as pd
+
+from tcga_ddr.cohorts import GeneLossIndex
+from tcga_ddr.data import sample_dictionary
+
+CANCER_TYPES = [
+    'ACC', 'BLCA', 'BRCA', 'CESC', 'CHOL', 'COAD', 'DLBC', 'ESCA', 'GBM', 'HNSC', 'KICH',
+    'KIRC', 'KIRP', 'LAML', 'LGG', 'LIHC', 'LUAD', 'LUSC', 'MESO', 'OV', 'PAAD', 'PCPG',
+    'PRAD', 'READ', 'SARC', 'SKCM', 'STAD', 'TGCT', 'THCA', 'THYM', 'UCEC', 'UCS', 'UVM',
+]
+ENDPOINT_MISSING = {'OS': 0.01, 'DSS': 0.05, 'DFI': 0.45, 'PFI': 0.01}
+N_FEATURES = 22
+
+
+def sample_ids(n):
+    return np.array([f'SYN-{i:07d}' for i in range(n)], dtype=object)
+
+
+def cancer_types(n):
+    # Uneven cohort sizes, like TCGA where BRCA is ~20x larger than the smallest projects.
+    # Fixed seed, so a sample has the same cancer type in every table
+    rng = np.random.default_rng(12345)
+    weights = rng.gamma(1.5, size=len(CANCER_TYPES))
+    return rng.choice(CANCER_TYPES, size=n, p=weights / weights.sum())
+
+
+def _gene_loss_block(n, n_genes, rng, loss_rates):
+    values = (rng.random((n, n_genes)) < loss_rates).astype(np.float32)
+    values[rng.random((n, n_genes)) < 0.02] = np.nan
+    return values
+
+
+def gene_loss_frame(n, n_genes, seed=0):
+    """Gene-loss sheet: sample, cancer type, then one 0/1/NaN column per gene."""
+    rng = np.random.default_rng(seed)
+    types = cancer_types(n)
+    loss_rates = rng.uniform(0.01, 0.2, size=n_genes)
+    frame = pd.DataFrame(_gene_loss_block(n, n_genes, rng, loss_rates), columns=[f'GENE{g:04d}' for g in range(n_genes)])
+    frame.insert(0, 'Cancer type', types)
+    frame.insert(0, 'TCGA Sample', sample_ids(n))
+    return frame
+
+
+def gene_loss_index(n, n_genes, seed=0, chunk=8192):
+    """GeneLossIndex with the same distribution as ``gene_loss_frame``, without the frame.
+
+    ``chunk`` must be a multiple of 8.
+    """
+    rng = np.random.default_rng(seed)
+    types = cancer_types(n)
+    loss_rates = rng.uniform(0.01, 0.2, size=n_genes)
+    n_bytes = (n + 7) // 8
+    loss_bits = np.zeros((n_genes, n_bytes), dtype=np.uint8)
+    valid_bits = np.zeros((n_genes, n_bytes), dtype=np.uint8)
+    # Chunks are multiples of 8 samples, so each one fills whole bytes
+    for start in range(0, n, chunk):
+        values = _gene_loss_block(min(chunk, n - start), n_genes, rng, loss_rates)
+        valid = ~np.isnan(values)
+        loss = valid & (values != 0)
+        columns = slice(start // 8, start // 8 + (len(values) + 7) // 8)
+        loss_bits[:, columns] = np.packbits(loss.T, axis=1)
+        valid_bits[:, columns] = np.packbits(valid.T, axis=1)
+    cancer_codes, categories = pd.factorize(types)
+    return GeneLossIndex(sample_dictionary().encode(sample_ids(n)), list(categories), cancer_codes.astype(np.int16),
+                         [f'GENE{g:04d}' for g in range(n_genes)], loss_bits, valid_bits)
+
+
+def survival_frame(n, seed=1):
+    """Survival sheet: sample, cancer type and an (event, time in days) pair per endpoint."""
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({'TCGA Sample': sample_ids(n), 'Cancer type': cancer_types(n)})
+    # Median survival differs between cancer types
+    type_scale = dict(zip(CANCER_TYPES, rng.uniform(500, 4000, size=len(CANCER_TYPES))))
+    scale = frame['Cancer type'].map(type_scale).to_numpy()
+    for endpoint, missing in ENDPOINT_MISSING.items():
+        event_time = rng.exponential(scale)
+        censor_time = rng.uniform(30, 5000, size=n)
+        time = np.ceil(np.minimum(event_time, censor_time))
+        event = (event_time <= censor_time).astype(float)
+        absent = rng.random(n) < missing
+        time[absent] = np.nan
+        event[absent] = np.nan
+        frame[endpoint] = event
+        frame[f'{endpoint}.time'] = time
+    return frame
+
+
+def footprint_frame(n, seed=2, coverage=0.8):
+    """Footprint sheet for a random ``coverage`` share of the samples: sample, cancer type, subtype, features."""
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(n, size=int(n * coverage), replace=False))
+    m = len(rows)
+    values = rng.lognormal(mean=rng.uniform(0, 4, size=N_FEATURES), sigma=1.0, size=(m, N_FEATURES))
+    values[rng.random((m, N_FEATURES)) < 0.05] = np.nan
+    frame = pd.DataFrame(values, columns=[f'feature {f}' for f in range(N_FEATURES)])
+    frame.insert(0, 'Subtype', rng.choice(['A', 'B', 'C'], size=m))
+    frame.insert(0, 'Cancer type', cancer_types(n)[rows])
+    frame.insert(0, 'TCGA Sample', sample_ids(n)[rows])
+    return frame
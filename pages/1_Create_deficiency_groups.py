@@ -1,27 +1,31 @@
 import streamlit as st
 import pandas as pd
-import itertools
-import json
 from streamlit_echarts import st_echarts
+from tcga_ddr.admin import run_page
+from tcga_ddr.data import GENE_LOSS_FILE, source_version
+from tcga_ddr.ingest import load_gene_loss
+from tcga_ddr.instrument import span
+from tcga_ddr.store import definition_key, shared_store
 
 def create_groups_page():
-    # Initialize session state for group results
-    if 'group_results' not in st.session_state:
-        st.session_state.group_results = {}
+    # Initialize session state for the key of the current cohorts in the shared store
+    if 'cohort_key' not in st.session_state:
+        st.session_state.cohort_key = None
     if 'initialized' not in st.session_state:
         st.session_state.initialized = False
 
-    # Load the data
-    @st.cache
-    def load_data(file_path):
-        data = pd.read_excel(file_path)
-        return data
+    # Load the data; only its compact index is kept, shared read-only by every session.
+    # CSV and Parquet files are streamed into memory-mapped bitsets
+    @st.experimental_singleton
+    def load_index(file_path, version):
+        return load_gene_loss(file_path)
 
-    data = load_data('DDR factors gene loss.xlsx')
+    with span('load data'):
+        index = load_index(GENE_LOSS_FILE, source_version(GENE_LOSS_FILE))
 
     # Get available genes and cancer types
-    genes = data.columns[2:]
-    cancer_types = list(data['Cancer type'].unique())
+    genes = index.genes
+    cancer_types = list(index.cancer_types)
     cancer_types_with_all_none = ["Select All"] + cancer_types
 
     # Define the color palette and map to cancer types
@@ -60,71 +64,26 @@ def create_groups_page():
     if "Select All" in selected_cancer_types:
         selected_cancer_types = cancer_types
 
-    filtered_data = data[data['Cancer type'].isin(selected_cancer_types)]
-
-    # Drop rows with NaN values in the selected genes for each deficiency
-    for deficiency in deficiencies:
-        selected_genes = deficiency['genes']
-        if selected_genes:
-            filtered_data = filtered_data.dropna(subset=selected_genes)
-
     # Submit button for user to finalize selections
     if st.sidebar.button("Submit", key='submit_button'):
-        # Analyze the data based on user input
-        results = {}
-        for deficiency in deficiencies:
-            deficiency_name = deficiency['name']
-            selected_genes = deficiency['genes']
-            mutation_type = deficiency['mutation_type']
-            if selected_genes:
-                if mutation_type == 'Any of the selected genes':
-                    results[deficiency_name] = {
-                        'deficient': set(filtered_data[filtered_data[selected_genes].any(axis=1)]['TCGA Sample']),
-                        'proficient': set(filtered_data[~filtered_data[selected_genes].any(axis=1)]['TCGA Sample'])
-                    }
-                else:  # All of the selected genes
-                    results[deficiency_name] = {
-                        'deficient': set(filtered_data[filtered_data[selected_genes].all(axis=1)]['TCGA Sample']),
-                        'proficient': set(filtered_data[~filtered_data[selected_genes].all(axis=1)]['TCGA Sample'])
-                    }
-            else:
-                results[deficiency_name] = {'deficient': set(), 'proficient': set()}
-
-        # Generate all possible combinations of deficiencies and proficiencies
-        combinations = list(itertools.product(['d', 'p'], repeat=num_groups))
-
-        # Calculate the groups based on these combinations
-        group_results = {}
-        all_samples = set(filtered_data['TCGA Sample'])
-
-        for comb in combinations:
-            group_name_parts = []
-            group_samples = all_samples.copy()
-            for i, status in enumerate(comb):
-                if status == 'd':
-                    group_name_parts.append(f'd{deficiencies[i]["name"]}')
-                    group_samples &= results[deficiencies[i]['name']]['deficient']
-                else:
-                    group_name_parts.append(f'p{deficiencies[i]["name"]}')
-                    group_samples &= results[deficiencies[i]['name']]['proficient']
-            group_name = '-'.join(group_name_parts)
-            group_results[group_name] = group_samples
-
-        # Save the group results to session state
-        st.session_state.group_results = group_results
+        # Reuse the cohorts if anyone already submitted the same definition; otherwise assign
+        # every sample to its deficient/proficient combination in one pass and store them
+        with span('assign cohorts'):
+            cohort_key = definition_key(deficiencies, selected_cancer_types, source_version(GENE_LOSS_FILE))
+            cohorts = shared_store().get(cohort_key)
+            if cohorts is None:
+                cohorts = index.assign(deficiencies, selected_cancer_types)
+                shared_store().put(cohort_key, cohorts)
+            counts = cohorts.contingency()
+        st.session_state.cohort_key = cohort_key
         st.session_state.initialized = True
 
         # Display the results as a table
         st.header('Deficiency Groups Summary')
-        summary_table = []
-
-        for group_name, samples in group_results.items():
-            summary_table.append({
-                'Deficiency Group': group_name,
-                'Sample Number': len(samples)
-            })
-
-        summary_df = pd.DataFrame(summary_table)
+        summary_df = pd.DataFrame({
+            'Deficiency Group': counts.index,
+            'Sample Number': counts.sum(axis=1).to_numpy()
+        })
         st.table(summary_df)
 
         # Display the pie charts in a 2-per-row grid
@@ -135,10 +94,8 @@ def create_groups_page():
         
         for idx, row in summary_df.iterrows():
             group_name = row['Deficiency Group']
-            group_samples = group_results[group_name]
-        
-            group_data = filtered_data[filtered_data['TCGA Sample'].isin(group_samples)]
-            cancer_type_counts = group_data['Cancer type'].value_counts()
+            cancer_type_counts = counts.iloc[idx]
+            cancer_type_counts = cancer_type_counts[cancer_type_counts > 0].sort_values(ascending=False, kind='stable')
         
             # Define options for ECharts
             options = {
@@ -183,7 +140,7 @@ def create_groups_page():
 
         
             # Display in grid
-            with cols[idx % 2]:  # Adjust for 2 columns per row
+            with span('pie chart'), cols[idx % 2]:  # Adjust for 2 columns per row
                 st_echarts(options=options, height="400px")
             
             # Toggleable Cancer Type Legend
@@ -224,10 +181,6 @@ def create_groups_page():
             # Display the table in Streamlit
             st.markdown(table_html, unsafe_allow_html=True)
 
-        # Save the group results to a file
-        with open('group_results.json', 'w') as f:
-            json.dump({k: list(v) for k, v in group_results.items()}, f)
-
 
 if __name__ == "__main__":
-    create_groups_page()
\ No newline at end of file
+    run_page('Create deficiency groups', create_groups_page)
\ No newline at end of file
@@ -1,31 +1,61 @@
 import streamlit as st
 import pandas as pd
-import json
 import itertools
-from lifelines import KaplanMeierFitter
-from lifelines.statistics import logrank_test
-import matplotlib.pyplot as plt
 import textwrap
+import numpy as np
+from streamlit_echarts import st_echarts
+from tcga_ddr.admin import run_page
+from tcga_ddr.atlas import ATLAS_DIR, atlas_version, load_atlas
+from tcga_ddr.bootstrap import survival_intervals
+from tcga_ddr.cache import canonical_key
+from tcga_ddr.charts import at_risk_table, figure_png, km_chart_options, km_figure
+from tcga_ddr.cohorts import cohort_labels
+from tcga_ddr.cox import compare_cohorts
+from tcga_ddr.data import GENE_LOSS_FILE, SURVIVAL_FILE, read_table, source_version
+from tcga_ddr.instrument import span
+from tcga_ddr.logrank import multivariate_logrank, pairwise_logrank
+from tcga_ddr.multitest import CORRECTIONS, adjust_pvalues
+from tcga_ddr.parallel import MAX_WORKERS, SharedArray
+from tcga_ddr.store import shared_cache, shared_results, shared_store
+from tcga_ddr.survival import (DAYS_PER_YEAR, ENDPOINTS, RMST_HORIZON_YEARS, KaplanMeier, SurvivalIndex,
+                               landmark_table)
 
 
 def survival_simplified_page():
     st.title("Survival analysis")
     
-    @st.cache
-    def load_data(file_path):
-        return pd.read_excel(file_path)
-    
-    # Load the survival data
-    survival_data = load_data('Survival_simple.xlsx')
+    @st.experimental_singleton
+    def load_index(file_path, version):
+        return SurvivalIndex(read_table(file_path))
 
+    @st.experimental_singleton
+    def load_precomputed(path, version):
+        return load_atlas(path)
 
-    # Load group results from session state or file
-    if 'group_results' in st.session_state:
-        group_results = st.session_state.group_results
-    else:
-        with open('group_results.json', 'r') as f:
-            group_results = json.load(f)
-            st.session_state.group_results = group_results  # Save to session state
+    @st.experimental_singleton
+    def load_shared_columns(file_path, version, endpoint):
+        # An endpoint's times, events and covariates in shared memory for the Cox workers,
+        # copied once per process
+        index = load_index(file_path, version)
+        data = index[endpoint]
+        covariates = index.covariate_values[data.rows]
+        columns = {'time': data.time, 'event': data.event}
+        columns.update({name: covariates[:, j] for j, name in enumerate(index.covariates)})
+        return {name: SharedArray(column) for name, column in columns.items()}
+
+    # Load the survival data as pre-sorted endpoints, shared read-only by every session
+    with span('load data'):
+        survival_index = load_index(SURVIVAL_FILE, source_version(SURVIVAL_FILE))
+        atlas = load_precomputed(ATLAS_DIR, atlas_version(ATLAS_DIR))
+
+
+    # Fetch the cohorts defined on the 'Create deficiency groups' page from the shared store
+    cohorts = shared_store().get(st.session_state.get('cohort_key'))
+    if cohorts is None:
+        st.info("Please create deficiency groups first on the 'Create deficiency groups' page.")
+        return
+    positions = cohorts.index.positions(('survival', source_version(SURVIVAL_FILE)), survival_index.sample_keys)
+    cohort_codes = cohorts.codes_for(positions)
 
     # User selection for endpoint
     st.subheader('Survival Endpoint to Plot')
@@ -35,19 +65,15 @@ def survival_simplified_page():
     if endpoint_choice == 'OS':
         st.markdown("**OS** (Overall Survival) is the period from the date of diagnosis until the date of death from any cause, including non-cancer-related deaths.")
         endpoint = 'OS'
-        time_column = 'OS.time'
     elif endpoint_choice == 'DSS':
         st.markdown("**DSS** (Disease-Specific Survival) is calculated as the period between the date of initial diagnosis until the date of death specifically from the disease.")
         endpoint = 'DSS'
-        time_column = 'DSS.time'
     elif endpoint_choice == 'DFI':
         st.markdown("**DFI** (Disease-Free Interval) is the period from the date of diagnosis until the first new tumor progression event after the patient has been declared disease-free post-treatment.")
         endpoint = 'DFI'
-        time_column = 'DFI.time'
     else:
         st.markdown("**PFI** (Progression-Free Interval) is the period from the date of diagnosis until the first occurrence of a new tumor event, which includes disease progression, locoregional recurrence, distant metastasis, new primary tumor, or death with a tumor.")
         endpoint = 'PFI'
-        time_column = 'PFI.time'
     # Explanation table data
     explanation_data = {
         "Cancer type": ["ACC", "BLCA", "BRCA", "CESC", "CHOL", "COAD", "DLBC", "ESCA", "GBM", "HNSC", "KICH", "KIRC", "KIRP", "LAML", "LGG", "LIHC", "LUAD", "LUSC", "MESO", "OV", "PAAD", "PCPG", "PRAD", "READ", "SARC", "SKCM", "STAD", "TGCT", "THCA", "THYM", "UCEC", "UCS", "UVM"],
@@ -100,70 +126,176 @@ def survival_simplified_page():
         st.table(explanation_df)
 
     # Group selection
-    selected_groups = st.multiselect('Select Groups', list(group_results.keys()))
+    selected_groups = st.multiselect('Select Groups', cohorts.names)
 
     # Option to toggle legend visibility
     show_legend = st.checkbox('Show Legend', value=True)
 
+    # Optional correction of the pairwise p-values for multiple testing
+    correction = st.selectbox('Multiple-testing correction', list(CORRECTIONS))
+
     if selected_groups:
-        # Filter for the required groups
-        filtered_survival_data = pd.concat([survival_data[survival_data['TCGA Sample'].isin(group_results[group])] for group in selected_groups])
-        filtered_survival_data = filtered_survival_data.dropna(subset=[time_column, endpoint])
-
-        # Create a dictionary to hold the filtered dataframes
-        grouped_data = {group: filtered_survival_data[filtered_survival_data['TCGA Sample'].isin(group_results[group])] for group in selected_groups}
-
-        # Perform log-rank tests
-        def perform_logrank_test(grouped_data, groups):
-            results = {}
-            for group1, group2 in itertools.combinations(groups, 2):
-                data1 = grouped_data[group1]
-                data2 = grouped_data[group2]
-
-                if not data1.empty and not data2.empty:
-                    result = logrank_test(
-                        data1[time_column], data2[time_column],
-                        event_observed_A=data1[endpoint], event_observed_B=data2[endpoint]
-                    )
-                    results[(group1, group2)] = result
-            return results
+        # Deaths, removals and numbers at risk per cohort, cached by cohort fingerprint so that
+        # only cohorts whose samples changed since an earlier submit are counted again
+        endpoint_data = survival_index[endpoint]
+        selected_codes = [cohorts.names.index(group) for group in selected_groups]
+
+        # Single-gene definitions are summed from the precomputed atlas when it is up to date
+        gene = cohorts.single_gene()
+        use_atlas = atlas is not None and gene is not None and atlas.covers(
+            gene, gene_loss=source_version(GENE_LOSS_FILE), survival=source_version(SURVIVAL_FILE))
+
+        def count_cohorts(missing):
+            if use_atlas:
+                return atlas.survival_counts(endpoint, gene, cohorts.definition[1], [selected_codes[i] for i in missing])
+            labels = endpoint_data.labels(cohort_codes, [selected_codes[i] for i in missing])
+            return np.stack(endpoint_data.counts(labels, len(missing)), axis=1)
+
+        with span('kaplan-meier'):
+            fingerprints = cohorts.fingerprints()
+            counts = shared_results().rows(('survival', endpoint, source_version(SURVIVAL_FILE)),
+                                           [fingerprints[code] for code in selected_codes], count_cohorts)
+            km = KaplanMeier(endpoint_data.grid, counts[:, 0], counts[:, 1], counts[:, 2])
+
+        # Perform all pairwise log-rank tests, plus the overall test, from the same count matrices
+        def perform_logrank_test(km, correction):
+            non_empty = [i for i in range(len(km.n)) if km.n[i]]
+            pairs = list(itertools.combinations(non_empty, 2))
+            pairs, _, p_values = pairwise_logrank(km.deaths, km.at_risk, pairs)
+            adjusted = adjust_pvalues(p_values, CORRECTIONS[correction])
+            results = {(i, j): (p, p_adj) for (i, j), p, p_adj in zip(pairs, p_values, adjusted)}
+            return results, multivariate_logrank(km.deaths, km.at_risk)
 
         # Plotting functions
-        def plot_km_curves(grouped_data, groups, logrank_results, show_legend):
-            plt.figure(figsize=(10, 9), dpi=600)
-        
-            for group in groups:
-                data = grouped_data[group]
-                if not data.empty:
-                    kmf = KaplanMeierFitter()
-                    kmf.fit(durations=data[time_column], event_observed=data[endpoint], label=group)
-                    kmf.plot_survival_function(ci_show=True)
-        
-            plt.xlabel('Days', fontsize=20)
-            plt.ylabel('Probability', fontsize=20)
-            plt.xticks(fontsize=20)
-            plt.yticks(fontsize=20)
-            
-            if show_legend:
-                plt.legend(loc='upper right', fontsize=14)
-            else:
-                plt.gca().legend().remove()  # Remove legend if the checkbox is unchecked
-            
-            st.pyplot(plt)
+        def plot_km_curves(km, groups, logrank_results, overall_result, correction, show_legend):
+            # Interactive vector chart built from the precomputed step functions
+            with span('km chart'):
+                st_echarts(options=km_chart_options(km, groups, show_legend), height="600px")
+            st.markdown('**Number at risk**')
+            st.dataframe(at_risk_table(km, groups))
+
+            # The 600-dpi static figure is only rendered when asked for
+            if st.button('Prepare high-resolution PNG'):
+                with span('png figure'):
+                    png = figure_png(km_figure(km, groups, show_legend), dpi=600)
+                st.download_button(
+                    'Download Kaplan-Meier plot (PNG, 600 dpi)',
+                    data=png,
+                    file_name=f'kaplan_meier_{endpoint}.png',
+                    mime='image/png'
+                )
         
             # Display p-values and sample sizes in a table
             p_values = []
-            for (group1, group2), result in logrank_results.items():
-                n1 = len(grouped_data[group1])
-                n2 = len(grouped_data[group2])
-                p_values.append([group1, group2, f'{result.p_value:.4f}', f'{n1}', f'{n2}'])
+            for (i, j), (p_value, p_adjusted) in logrank_results.items():
+                row = [groups[i], groups[j], f'{p_value:.4f}']
+                if CORRECTIONS[correction]:
+                    row.append(f'{p_adjusted:.4f}')
+                p_values.append(row + [f'{int(km.n[i])}', f'{int(km.n[j])}'])
+            columns = ['Group 1', 'Group 2', 'p-value'] + ([f'p-value ({correction})'] if CORRECTIONS[correction] else []) + ['n1', 'n2']
         
             st.subheader('Log-Rank Test Results')
-            st.write(pd.DataFrame(p_values, columns=['Group 1', 'Group 2', 'p-value', 'n1', 'n2']))
+            st.write(pd.DataFrame(p_values, columns=columns))
+
+            statistic, dof, p_overall = overall_result
+            if dof > 1:
+                st.markdown(f"**Overall log-rank test** across {dof + 1} groups: χ² = {statistic:.2f}, df = {dof}, p-value = {p_overall:.4f}")
+
+
+        with span('log-rank tests'):
+            logrank_results, overall_result = perform_logrank_test(km, correction)
+        plot_km_curves(km, selected_groups, logrank_results, overall_result, correction, show_legend)
+
+        # Median survival, RMST and landmark survival of every selected group, endpoint and cancer type,
+        # all read off the Kaplan-Meier step functions
+        st.subheader('Survival Summary')
+        horizon_years = st.number_input('RMST horizon (years)', min_value=0.5, max_value=30.0,
+                                        value=float(RMST_HORIZON_YEARS), step=0.5)
+        horizon = horizon_years * DAYS_PER_YEAR
+        if st.checkbox('Show median, RMST and 1/3/5-year survival for every endpoint and cancer type'):
+            summary_key = canonical_key(
+                'landmarks', source_version(SURVIVAL_FILE), [fingerprints[code] for code in selected_codes],
+                selected_groups, horizon
+            )
+            sample_positions = np.asarray(positions)
+            strata = np.where(sample_positions >= 0, cohorts.index.cancer_codes[sample_positions], -1)
+            group_codes = np.asarray(cohort_labels(cohort_codes, selected_codes))
+            with span('survival summary'):
+                summary_df = shared_cache().get_or_compute(summary_key, lambda: landmark_table(
+                    survival_index, group_codes, strata, selected_groups, cohorts.index.cancer_types, horizon))
+            summary_df = summary_df.rename(columns={'RMST': f'RMST ({horizon_years:g} years)'})
+            summary_df['Median'] = [('not reached' if np.isinf(v) else f'{v:.0f}') for v in summary_df['Median']]
+            st.caption('Times in days; survival is left blank past the last follow-up of a group.')
+            st.dataframe(summary_df.round(3))
+            st.download_button('Download survival summary (CSV)', data=summary_df.to_csv(index=False),
+                               file_name='survival_summary.csv', mime='text/csv')
+
+        # Percentile bootstrap intervals of the median survival and the restricted mean survival time
+        if st.checkbox('Bootstrap confidence intervals for median survival and RMST'):
+            intervals_key = canonical_key(
+                'survival_intervals', endpoint, source_version(SURVIVAL_FILE),
+                [fingerprints[code] for code in selected_codes], horizon
+            )
+            labels = endpoint_data.labels(cohort_codes, selected_codes)
+            with st.spinner('Resampling...'), span('bootstrap'):
+                intervals = shared_cache().get_or_compute(intervals_key, lambda: survival_intervals(
+                    endpoint_data, labels, len(selected_codes), horizon))
+
+            def days(value):
+                return 'not reached' if np.isinf(value) else ('' if np.isnan(value) else f'{value:.0f}')
+
+            rows = []
+            for group, result in zip(selected_groups, intervals):
+                if not len(result['estimate']):
+                    continue
+                (median, rmst), (median_low, rmst_low), (median_high, rmst_high) = (
+                    result['estimate'], result['lower'], result['upper'])
+                rows.append([group, days(median), f'{days(median_low)} - {days(median_high)}',
+                             days(rmst), f'{days(rmst_low)} - {days(rmst_high)}', result['resamples']])
+            st.subheader('Median Survival and Restricted Mean Survival Time (days)')
+            st.write(pd.DataFrame(rows, columns=['Group', 'Median', 'Median 95% CI', f'RMST ({horizon_years:g} years)',
+                                                 'RMST 95% CI', 'Resamples']))
 
+        # Cox proportional-hazards model with a separate baseline hazard per cancer type, so that
+        # cohorts are only compared within cancer types
+        def fit_cox_models(endpoints, reference, covariates):
+            rows = []
+            columns = [survival_index.covariates.index(name) for name in covariates]
+            for name in endpoints:
+                data = survival_index[name]
+                labels = data.labels(cohort_codes, selected_codes)
+                sample_positions = positions[data.rows]
+                strata = np.where(sample_positions >= 0, cohorts.index.cancer_codes[sample_positions], -1)
+                table = compare_cohorts(
+                    data.time, data.event, data.time_index, len(data.grid), strata, labels, len(selected_codes),
+                    selected_groups.index(reference),
+                    covariates=survival_index.covariate_values[data.rows][:, columns] if columns else None,
+                    covariate_names=covariates,
+                    shared=load_shared_columns(SURVIVAL_FILE, source_version(SURVIVAL_FILE), name)
+                    if covariates and MAX_WORKERS > 1 else None,
+                )
+                table.insert(0, 'Endpoint', name)
+                table.insert(1, 'Group', [selected_groups[i] for i in table.pop('group')])
+                rows.append(table)
+            return pd.concat(rows, ignore_index=True)
 
-        logrank_results = perform_logrank_test(grouped_data, selected_groups)
-        plot_km_curves(grouped_data, selected_groups, logrank_results, show_legend)
+        st.subheader('Cox Proportional-Hazards Model')
+        if len(selected_groups) > 1 and st.checkbox('Fit a Cox model stratified by cancer type'):
+            reference = st.selectbox('Reference group', selected_groups)
+            cox_endpoints = st.multiselect('Endpoints', ENDPOINTS, default=[endpoint])
+            covariates = st.multiselect('Adjust for', survival_index.covariates) if survival_index.covariates else []
+            if cox_endpoints:
+                # Fits depend only on the cohorts' members, so every session asking for them shares them
+                cox_key = canonical_key(
+                    'cox', source_version(SURVIVAL_FILE), [fingerprints[code] for code in selected_codes],
+                    selected_groups, reference, cox_endpoints, covariates
+                )
+                with st.spinner('Fitting Cox models...'), span('cox model'):
+                    cox_df = shared_cache().get_or_compute(
+                        cox_key, lambda: fit_cox_models(cox_endpoints, reference, covariates))
+                st.markdown(f"Hazard ratios with 95% confidence intervals against **{reference}**; "
+                            "cohorts whose hazard ratio cannot be estimated (e.g. without events) are left blank.")
+                st.dataframe(cox_df.drop(columns=['coef', 'se']).round(4))
 
 if __name__ == "__main__":
-    survival_simplified_page()
+    run_page('Survival analysis', survival_simplified_page)
@@ -1,28 +1,66 @@
 import streamlit as st
 import pandas as pd
-import json
 from streamlit_echarts import st_echarts
+from tcga_ddr.admin import run_page
+from tcga_ddr.atlas import ATLAS_DIR, atlas_version, load_atlas
+from tcga_ddr.bootstrap import footprint_intervals
+from tcga_ddr.cache import canonical_key
+from tcga_ddr.charts import (FOOTPRINT_CHARTS_PER_PAGE, footprint_bar_options, footprint_heatmap_options,
+                             footprint_split_options)
+from tcga_ddr.cohorts import cohort_labels
+from tcga_ddr.data import (FOOTPRINT_DESCRIPTIONS_FILE, FOOTPRINT_FILE, GENE_LOSS_FILE, read_table, source_version,
+                           table_format)
+from tcga_ddr.footprint_tests import feature_tests
+from tcga_ddr.footprints import FootprintCube
+from tcga_ddr.heatmap import BY_CANCER_TYPE, POOLED, clustered_heatmap, footprint_means
+from tcga_ddr.ingest import load_footprints
+from tcga_ddr.instrument import span
+from tcga_ddr.parallel import MAX_WORKERS, SharedArray
+from tcga_ddr.store import shared_cache, shared_results, shared_store
 
 def ddr_footprints_page():
-    def load_group_results(file_path):
-        with open(file_path, 'r') as f:
-            group_results = json.load(f)
-        return group_results
+    @st.experimental_singleton
+    def load_descriptions(file_path, version):
+        # Sheet2 of the workbook, or a separate table next to a CSV or Parquet footprint file
+        if table_format(file_path) == 'excel':
+            descriptions = read_table(file_path, sheet_name="Sheet2")
+        elif FOOTPRINT_DESCRIPTIONS_FILE:
+            descriptions = read_table(FOOTPRINT_DESCRIPTIONS_FILE)
+        else:
+            return pd.DataFrame(columns=['DDR Score', 'Brief Description'])
+        descriptions['DDR Score'] = descriptions['DDR Score'].str.replace('_', ' ')
+        return descriptions
 
-    @st.cache
-    def load_data():
-        return pd.read_excel("DDR footprint.xlsx", sheet_name=None)
+    @st.experimental_singleton
+    def load_index(file_path, version):
+        # Only the compact index is kept, shared read-only by every session; CSV and
+        # Parquet files are streamed into a memory-mapped value matrix
+        return load_footprints(file_path)
 
-    data_dict = load_data()
+    @st.experimental_singleton
+    def load_precomputed(path, version):
+        return load_atlas(path)
 
-    data = data_dict["Sheet1"].copy()  
-    descriptions = data_dict["Sheet2"].copy() 
-    data.columns = data.columns.str.replace('_', ' ')
-    descriptions['DDR Score'] = descriptions['DDR Score'].str.replace('_', ' ')
-    
-    group_results = load_group_results('group_results.json')
+    @st.experimental_singleton
+    def load_shared_values(file_path, version):
+        # Footprint matrix in shared memory for the test workers, copied once per process
+        # (a memory-mapped matrix is mapped by the workers instead)
+        return SharedArray(load_index(file_path, version).values)
+
+    with span('load data'):
+        descriptions = load_descriptions(FOOTPRINT_FILE, source_version(FOOTPRINT_FILE))
+        footprint_index = load_index(FOOTPRINT_FILE, source_version(FOOTPRINT_FILE))
+        atlas = load_precomputed(ATLAS_DIR, atlas_version(ATLAS_DIR))
+
+    # Fetch the cohorts defined on the 'Create deficiency groups' page from the shared store
+    cohorts = shared_store().get(st.session_state.get('cohort_key'))
+    if cohorts is None:
+        st.info("Please create deficiency groups first on the 'Create deficiency groups' page.")
+        return
+    positions = cohorts.index.positions(('footprint', source_version(FOOTPRINT_FILE)), footprint_index.sample_keys)
+    cohort_codes = cohorts.codes_for(positions)
 
-    cancer_types = list(data['Cancer type'].unique())
+    cancer_types = list(footprint_index.cancer_types)
     color_palette = [
         "#FF6F61", "#FFA177", "#FFD670", "#FF9B85", "#FFADAD",  
         "#B565A7", "#8A2BE2", "#A34DA3", "#DDA0DD", "#F9A602",  
@@ -34,10 +72,25 @@ def ddr_footprints_page():
     ]
     color_map = {cancer_types[i]: color_palette[i % len(color_palette)] for i in range(len(cancer_types))}
 
-    selected_groups = st.multiselect("Select Deficiency Groups for Analysis", list(group_results.keys()))
-    features = data.columns[3:].tolist()
+    selected_groups = st.multiselect("Select Deficiency Groups for Analysis", cohorts.names)
+    features = footprint_index.features
     selected_features = st.multiselect("Select Features to Plot (Select 'Display All' for all features)", ['Display All'] + features)
+    view = st.radio("Display", ['Bar charts', 'Heatmap'], horizontal=True,
+                    help="The heatmap shows every selected feature in one chart: the group means, z-scored per feature "
+                         "and ordered by hierarchical clustering of the rows and columns.")
+    heatmap = view == 'Heatmap'
+    if heatmap:
+        heatmap_cancer_types = st.selectbox("Cancer types in the heatmap", [POOLED, BY_CANCER_TYPE] + sorted(
+            ct for ct in footprint_index.cancer_types if not pd.isna(ct)))
     split_by_cancer_type = st.checkbox("Split by Cancer Type", value=False)
+    run_tests = st.checkbox("Test differences between groups", value=False,
+                            help="Mann-Whitney U (two groups) or Kruskal-Wallis (more groups), with Benjamini-Hochberg q-values.")
+    n_permutations = 0
+    if run_tests:
+        n_permutations = st.number_input("Permutation resamples (0 for rank tests only)", min_value=0, max_value=100000, value=0, step=1000)
+    error_bars = st.radio("Error bars", ['None', 'SD', 'SEM', '95% CI'], horizontal=True,
+                          help="Drawn on the group means; the per-cancer-type values are listed under 'Summary statistics'. "
+                               "The 95% CI is a percentile bootstrap of the group mean.")
 
     if 'Display All' in selected_features:
         selected_features = features
@@ -60,269 +113,155 @@ def ddr_footprints_page():
     bar_width = max(15, 20 - len(selected_groups) * 0.5)
 
     if selected_groups and isinstance(selected_features, list) and selected_features:
-        for selected_feature in selected_features:
-            group_means = []
-            cancer_type_means = {}
-            valid_groups = []  # Track valid groups
+        # Sums and counts for every (group, cancer type, feature) cell in a single reduction,
+        # reusing the cells of cohorts whose samples did not change since an earlier submit
+        selected_codes = [cohorts.names.index(group) for group in selected_groups]
+        labels = cohort_labels(cohort_codes, selected_codes)
+
+        # Single-gene definitions are summed from the precomputed atlas when it is up to date
+        gene = cohorts.single_gene()
+        use_atlas = atlas is not None and gene is not None and atlas.covers(
+            gene, gene_loss=source_version(GENE_LOSS_FILE), footprint=source_version(FOOTPRINT_FILE))
+
+        # Long feature lists are shown a page at a time, so a submit only aggregates and
+        # draws the charts the user can see; the heatmap takes all of them at once
+        n_pages = 1 if heatmap else -(-len(selected_features) // FOOTPRINT_CHARTS_PER_PAGE)
+        page = 1
+        if n_pages > 1:
+            page = st.selectbox(f"Page of {len(selected_features)} features", range(1, n_pages + 1),
+                                format_func=lambda p: f"{p} of {n_pages}")
+        visible_features = selected_features if heatmap else \
+            selected_features[(page - 1) * FOOTPRINT_CHARTS_PER_PAGE:page * FOOTPRINT_CHARTS_PER_PAGE]
+        columns = [footprint_index.feature_pos[feature] for feature in visible_features]
+
+        def aggregate_cohorts(missing):
+            if use_atlas:
+                return atlas.footprint_stats(gene, cohorts.definition[1], [selected_codes[i] for i in missing])[..., columns]
+            missing_labels = cohort_labels(cohort_codes, [selected_codes[i] for i in missing])
+            return footprint_index.aggregate(missing_labels, len(missing), features=visible_features).stats
+
+        with span('aggregate'):
+            fingerprints = cohorts.fingerprints()
+            stats = shared_results().rows(('footprint', source_version(FOOTPRINT_FILE), tuple(visible_features)),
+                                          [fingerprints[code] for code in selected_codes], aggregate_cohorts)
+        cube = FootprintCube(visible_features, stats)
+
+        if heatmap:
+            # Clustering is shared by everyone looking at the same cohorts and features
+            heatmap_key = canonical_key(
+                'footprint_heatmap', source_version(FOOTPRINT_FILE), [fingerprints[code] for code in selected_codes],
+                selected_groups, tuple(visible_features), heatmap_cancer_types
+            )
+            with span('heatmap'):
+                z, means = shared_cache().get_or_compute(heatmap_key, lambda: clustered_heatmap(footprint_means(
+                    cube, selected_groups, footprint_index.cancer_types, heatmap_cancer_types)))
+            if z.empty:
+                st.info("None of the selected groups has footprint data for this selection.")
+            else:
+                with span('feature chart'):
+                    st_echarts(options=footprint_heatmap_options(z, means), height=f"{max(400, 22 * len(z) + 160)}px",
+                               width=f"{max_chart_width}px")
+                with st.expander("Mean values"):
+                    st.dataframe(means.round(3))
+        else:
+            intervals = None
+            if error_bars == '95% CI':
+                # Bootstrap intervals of the group means, shared like the test results
+                intervals_key = canonical_key(
+                    'footprint_intervals', source_version(FOOTPRINT_FILE), [fingerprints[code] for code in selected_codes],
+                    tuple(visible_features)
+                )
+                with st.spinner("Resampling..."), span('bootstrap'):
+                    intervals = shared_cache().get_or_compute(intervals_key, lambda: footprint_intervals(
+                        footprint_index.values[:, columns], labels, len(selected_codes)))
+                feature_column = {feature: j for j, feature in enumerate(visible_features)}
+
+            for selected_feature in visible_features:
+                group_means = []
+                cancer_type_means = {}
+                valid_groups = []  # Track valid groups
             
-            for group in selected_groups:
-                group_samples = group_results[group]
-                group_filtered_data = data[data['TCGA Sample'].isin(group_samples)]
-                group_filtered_data = group_filtered_data.dropna(subset=[selected_feature])
-                
-                if not group_filtered_data.empty:  # Only consider groups with valid data
-                    mean_value = round(group_filtered_data[selected_feature].mean(), 1)
-                    group_means.append(mean_value)
-                    valid_groups.append(group)  # Add to valid groups
+                group_stats = cube.group_stats(selected_feature)
+                group_errors = []
+                summary_rows = []
+                for i, group in enumerate(selected_groups):
+                    if group_stats['n'][i] > 0:  # Only consider groups with valid data
+                        group_means.append(round(float(group_stats['mean'][i]), 1))
+                        valid_groups.append(group)  # Add to valid groups
+                        mean = group_means[-1]
+                        summary = {k: v[i] for k, v in group_stats.items()}
+                        if intervals is not None:
+                            j = feature_column[selected_feature]
+                            lower, upper = intervals[i]['lower'][j], intervals[i]['upper'][j]
+                            summary.update({'CI lower': lower, 'CI upper': upper})
+                            group_errors.append((mean, mean) if pd.isna(lower) else (float(lower), float(upper)))
+                        else:
+                            error = group_stats[error_bars.lower()][i] if error_bars != 'None' else 0.0
+                            error = 0.0 if pd.isna(error) else float(error)
+                            group_errors.append((mean - error, mean + error))
+                        summary_rows.append({'Group': group, 'Cancer type': 'All', **summary})
                     
-                    if split_by_cancer_type:
-                        cancer_type_means[group] = group_filtered_data.groupby('Cancer type')[selected_feature].mean().round(1).dropna()
+                        if split_by_cancer_type:
+                            cancer_type_stats = cube.cancer_type_stats(selected_feature, i, footprint_index.cancer_types)
+                            cancer_type_means[group] = cancer_type_stats['mean'].round(1)
+                            summary_rows.extend({'Group': group, 'Cancer type': ct, **row} for ct, row in cancer_type_stats.iterrows())
 
-            wrapped_group_labels = wrap_labels(valid_groups)
+                wrapped_group_labels = wrap_labels(valid_groups)
 
-            # Display the brief description for the selected feature before rendering the plot
-            description = descriptions.loc[descriptions['DDR Score'] == selected_feature, 'Brief Description'].values
-            # Custom function to capitalize only the first letter if the entire string is in lowercase
-            def smart_capitalize(text):
-                if text.islower():
-                    return text.capitalize()
-                return text
+                # Display the brief description for the selected feature before rendering the plot
+                description = descriptions.loc[descriptions['DDR Score'] == selected_feature, 'Brief Description'].values
+                # Custom function to capitalize only the first letter if the entire string is in lowercase
+                def smart_capitalize(text):
+                    if text.islower():
+                        return text.capitalize()
+                    return text
             
-            # Apply the smart capitalization to the selected feature
-            capitalized_feature = smart_capitalize(selected_feature)
+                # Apply the smart capitalization to the selected feature
+                capitalized_feature = smart_capitalize(selected_feature)
             
-            if description:
-                st.markdown(f"<h3 style='text-align: center;'>{capitalized_feature}</h3>", unsafe_allow_html=True)
-                st.markdown(f"<p style='text-align: center; font-style: italic;'>{description[0]}</p>", unsafe_allow_html=True)
-                st.markdown("<hr>", unsafe_allow_html=True)  # Horizontal divider line
+                if len(description):
+                    st.markdown(f"<h3 style='text-align: center;'>{capitalized_feature}</h3>", unsafe_allow_html=True)
+                    st.markdown(f"<p style='text-align: center; font-style: italic;'>{description[0]}</p>", unsafe_allow_html=True)
+                    st.markdown("<hr>", unsafe_allow_html=True)  # Horizontal divider line
 
-            if split_by_cancer_type and valid_groups:
-                categories = sorted(set([ct for means in cancer_type_means.values() for ct in means.index]))
-                series = []
-                for idx, cat in enumerate(categories):
-                    bar_color = color_map.get(cat, '#FFFFFF')
-                    series.append({
-                        "name": cat,
-                        "type": 'bar',
-                        "data": [cancer_type_means[group].get(cat) for group in valid_groups if cat in cancer_type_means[group].index],
-                        "itemStyle": {
-                            "color": bar_color
-                        },
-                        "label": {
-                            "show": True,
-                            "position": 'top',
-                            "formatter": "{c}",
-                            "fontSize": 12,  
-                            "fontWeight": 'bold',
-                            "color": bar_color, 
-                            "backgroundColor": "rgba(110, 122, 131, 0.3)",  
-                            "padding": [3, 5],  
-                            "borderRadius": 3, 
-                            "distance": 10
-                        }
+                if split_by_cancer_type and valid_groups:
+                    categories = sorted(set([ct for means in cancer_type_means.values() for ct in means.index]))
+                    data = [[cancer_type_means[group].get(cat) for group in valid_groups if cat in cancer_type_means[group].index]
+                            for cat in categories]
+                    options = footprint_split_options(selected_feature, wrapped_group_labels, categories, data, color_map)
+                elif valid_groups:
+                    options = footprint_bar_options(selected_feature, wrapped_group_labels, valid_groups, group_means, bar_width,
+                                                    errors=group_errors if error_bars != 'None' else None,
+                                                    error_name=error_bars)
+                else:
+                    continue
+                with span('feature chart'):
+                    st_echarts(options=options, height="600px", width=f"{max_chart_width}px")
 
-                    })
-                
-                options = {
-                    "tooltip": {
-                        "trigger": 'axis',
-                        "axisPointer": {"type": 'shadow'}
-                    },
-                    "legend": {
-                        "data": categories,
-                        "orient": 'vertical',
-                        "right": '5%',
-                        "top": 'middle',
-                        "type": 'scroll',
-                        "textStyle": {"color": "#FFFFFF", "fontSize": 12}
-                    },
-                    "grid": {
-                        "left": '6%',
-                        "right": '20%',
-                        "bottom": '10%',
-                        "containLabel": True
-                    },
-                    "xAxis": {
-                        "type": 'category',
-                        "data": wrapped_group_labels,
-                        "axisLabel": {
-                            "color": "#FFFFFF",
-                            "fontSize": 12
-                        }
-                    },
-                    "yAxis": {
-                        "type": 'value',
-                        "name": f"Mean of {selected_feature}",
-                        "nameLocation": 'middle',
-                        "nameGap": 50,
-                        "nameTextStyle": {
-                            "fontSize": 14,
-                            "fontWeight": 'bold',
-                            "color": "#FFFFFF"
-                        },
-                        "axisLabel": {"color": "#FFFFFF"}
-                    },
-                    "dataZoom": [
-                        {
-                            "type": "slider",
-                            "xAxisIndex": 0,
-                            "start": 0,
-                            "end": 100,  
-                            "handleSize": "150%",  
-                            "height": 25,  
-                            "bottom": '2%',
-                            "backgroundColor": "rgba(0, 0, 0, 0)",  
-                            "dataBackground": {
-                                "lineStyle": {
-                                    "color": {
-                                        "type": 'linear',
-                                        "x": 0,
-                                        "y": 0,
-                                        "x2": 1,
-                                        "y2": 0,
-                                        "colorStops": [
-                                            {"offset": 0, "color": "#E07B5F"},  # Coral Pink (light)
-                                            {"offset": 1, "color": "#C1533E"}   # Dark Coral (dark)
-                                        ]
-                                    },
-                                    "width": 2
-                                },
-                                "areaStyle": {"color": "rgba(0, 0, 0, 0)"}
-                            },
-                            "handleStyle": {
-                                "color": "#E07B5F",  # Coral Pink
-                                "borderColor": "#C1533E",  # Dark Coral
-                                "borderWidth": 2,
-                                "borderRadius": "50%"
-                            },
-                            "textStyle": {
-                                "color": "#C1533E",  # Dark Coral
-                                "fontSize": 9
-                            },
-                            "fillerColor": "rgba(224, 123, 95, 0.2)", 
-                            "borderColor": "#C1533E"  # Dark Coral
-                        }
-                    ],
-                    "series": series
-                }
-            elif valid_groups:
-                options = {
-                    "tooltip": {"trigger": 'axis', "axisPointer": {"type": 'shadow'}},
-                    "legend": {
-                        "data": valid_groups,
-                        "orient": 'vertical',
-                        "right": '5%',
-                        "top": 'middle',
-                        "type": 'scroll',
-                        "textStyle": {"color": "#FFFFFF", "fontSize": 12}
-                    },
-                    "grid": {
-                        "left": '7%',
-                        "right": '5%',
-                        "bottom": '10%',
-                        "containLabel": True
-                    },
-                    "xAxis": {
-                        "type": 'category',
-                        "data": wrapped_group_labels,
-                        "axisLabel": {
-                            "color": "#FFFFFF",
-                            "fontSize": 12
-                        },
-                        "axisTick": {
-                            "alignWithLabel": True
-                        },
-                        "axisLine": {
-                            "onZero": False
-                        }
-                    },
-                    "yAxis": {
-                        "type": 'value',
-                        "name": f"Mean of {selected_feature}",
-                        "nameLocation": 'middle',
-                        "nameGap": 50,
-                        "nameTextStyle": {
-                            "fontSize": 14,
-                            "fontWeight": 'bold',
-                            "color": "#FFFFFF"
-                        },
-                        "axisLabel": {"color": "#FFFFFF"}
-                    },
-                    "dataZoom": [
-                        {
-                            "type": "slider",
-                            "xAxisIndex": 0,
-                            "start": 0,
-                            "end": 100,  
-                            "handleSize": "150%",  
-                            "height": 25,  
-                            "bottom": '2%',
-                            "backgroundColor": "rgba(0, 0, 0, 0)",  
-                            "dataBackground": {
-                                "lineStyle": {
-                                    "color": {
-                                        "type": 'linear',
-                                        "x": 0,
-                                        "y": 0,
-                                        "x2": 1,
-                                        "y2": 0,
-                                        "colorStops": [
-                                            {"offset": 0, "color": "#E07B5F"},  # Coral Pink (light)
-                                            {"offset": 1, "color": "#C1533E"}   # Dark Coral (dark)
-                                        ]
-                                    },
-                                    "width": 2
-                                },
-                                "areaStyle": {"color": "rgba(0, 0, 0, 0)"}
-                            },
-                            "handleStyle": {
-                                "color": "#E07B5F",  # Coral Pink
-                                "borderColor": "#C1533E",  # Dark Coral
-                                "borderWidth": 2,
-                                "borderRadius": "50%"
-                            },
-                            "textStyle": {
-                                "color": "#C1533E",  # Dark Coral
-                                "fontSize": 9
-                            },
-                            "fillerColor": "rgba(224, 123, 95, 0.2)",  # Coral Pink with transparency
-                            "borderColor": "#C1533E"  # Dark Coral
-                        }
-                    ],
-            
-                    "series": [{
-                        "name": "Mean Value",
-                        "type": 'bar',
-                        "data": group_means,
-                        "itemStyle": {
-                            "color": {
-                                "type": 'linear',
-                                "x": 0,
-                                "y": 0,
-                                "x2": 0,
-                                "y2": 1,  # Vertical gradient (top to bottom)
-                                "colorStops": [
-                                    {"offset": 0, "color": '#E07B5F'},  # Coral Pink
-                                    {"offset": 1, "color": '#C1533E'}   # Dark Coral
-                                ]
-                            }
-                        },
-                        "barWidth": bar_width,
-                        "label": {
-                            "show": True,
-                            "position": 'top',
-                            "formatter": "{c}",
-                            "fontSize": 15,
-                            "fontWeight": 'bold',
-                            "color": '#E07B5F',
-                            "backgroundColor": "rgba(110, 122, 131, 0.5)", 
-                            "padding": [3, 5],  
-                            "borderRadius": 3,  
-                            "distance": 10
-                        }
-                    }]
-                }
-            st_echarts(options=options, height="600px", width=f"{max_chart_width}px")
+                if valid_groups:
+                    with st.expander("Summary statistics"):
+                        summary_df = pd.DataFrame(summary_rows).rename(columns={'mean': 'Mean', 'sd': 'SD', 'sem': 'SEM'})
+                        summary_df['n'] = summary_df['n'].astype(int)
+                        st.dataframe(summary_df.round(3))
+
+        if run_tests:
+            st.subheader("Significance Tests")
+            # Test results depend only on the cohorts' members, so everyone asking for the
+            # same comparison shares them
+            tests_key = canonical_key(
+                'footprint_tests', source_version(FOOTPRINT_FILE), [fingerprints[code] for code in selected_codes],
+                selected_groups, frozenset(selected_features), int(n_permutations), split_by_cancer_type
+            )
+            with st.spinner("Running tests..."), span('significance tests'):
+                tests_df = shared_cache().get_or_compute(tests_key, lambda: feature_tests(
+                    footprint_index, labels, selected_groups, selected_features,
+                    n_permutations=int(n_permutations), by_cancer_type=split_by_cancer_type,
+                    values=load_shared_values(FOOTPRINT_FILE, source_version(FOOTPRINT_FILE)) if MAX_WORKERS > 1 else None
+                ))
+            if tests_df.empty:
+                st.info("At least two groups with data are needed for the tests.")
+            else:
+                st.dataframe(tests_df)
 
 if __name__ == "__main__":
-    ddr_footprints_page()
+    run_page('DDR footprints', ddr_footprints_page)
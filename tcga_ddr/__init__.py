@@ -0,0 +1 @@
+"""Computation core shared by the TCGA-DDR Streamlit pages."""
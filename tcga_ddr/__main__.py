@@ -0,0 +1,3 @@
+from tcga_ddr.cli import main
+
+main()
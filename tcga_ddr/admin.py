@@ -0,0 +1,55 @@
+"""Hidden admin panel with the timing of the last rerun, stage histograms and cache counters.
+
+Every page calls ``run_page``; the panel is only shown when the URL has ``?admin=1``.
+"""
+import pandas as pd
+import streamlit as st
+
+from tcga_ddr import instrument
+from tcga_ddr.store import shared_cache
+
+
+def admin_enabled():
+    return st.experimental_get_query_params().get('admin', ['0'])[0] == '1'
+
+
+def run_page(page, render):
+    """Run ``render()`` as one traced rerun of ``page`` and show the admin panel if enabled."""
+    enabled = admin_enabled()
+    profile = enabled and st.session_state.get('admin_profile', False)
+    trace_memory = enabled and st.session_state.get('admin_trace_memory', False)
+    with instrument.rerun(page, profile=profile, trace_memory=trace_memory) as trace:
+        render()
+    if enabled:
+        admin_panel(trace)
+
+
+def prometheus_text():
+    stats = shared_cache().stats()
+    return instrument.registry().prometheus_text({
+        'cache_bytes': stats['bytes'], 'cache_entries': stats['entries'],
+        'cache_hits_total': stats['hits'], 'cache_misses_total': stats['misses'],
+        'cache_evictions_total': stats['evictions'],
+    })
+
+
+def admin_panel(trace):
+    st.sidebar.markdown('---')
+    st.sidebar.subheader('Admin')
+    st.sidebar.checkbox('Profile reruns (cProfile)', key='admin_profile')
+    st.sidebar.checkbox('Trace memory (tracemalloc)', key='admin_trace_memory')
+
+    with st.expander('Admin: timing of this rerun', expanded=True):
+        stages = pd.DataFrame(trace['stages'], columns=['Stage', 'Seconds'])
+        st.markdown(f"**{trace['page']}**: {trace['seconds']:.3f} s"
+                    + (f", peak traced memory {trace['peak_mb']:.1f} MB" if trace['peak_mb'] is not None else ''))
+        st.dataframe(stages.round(4))
+        if trace['profile']:
+            st.text(trace['profile'])
+
+    with st.expander('Admin: stage latency since start'):
+        st.dataframe(pd.DataFrame(instrument.registry().summary()).round(4))
+        st.write(shared_cache().stats())
+        text = prometheus_text()
+        st.download_button('Download Prometheus metrics', data=text, file_name='tcga_ddr_metrics.prom',
+                           mime='text/plain')
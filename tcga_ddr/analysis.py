@@ -0,0 +1,137 @@
+"""Streamlit-free analysis core: the three datasets loaded once and full analyses run on them."""
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from tcga_ddr.cohorts import ALL_GENES, ANY_GENES, cohort_labels
+from tcga_ddr.data import FOOTPRINT_FILE, GENE_LOSS_FILE, SURVIVAL_FILE, read_table
+from tcga_ddr.ingest import load_footprints, load_gene_loss
+from tcga_ddr.logrank import multivariate_logrank, pairwise_logrank
+from tcga_ddr.survival import DAYS_PER_YEAR, ENDPOINTS, RMST_HORIZON_YEARS, KaplanMeier, SurvivalIndex, landmark_table
+
+RULES = {'any': ANY_GENES, 'all': ALL_GENES}
+
+
+class Datasets:
+    """Gene-loss, survival and footprint indexes, plus the positions linking their samples."""
+
+    def __init__(self, gene_loss, survival, footprint):
+        self.gene_loss = gene_loss
+        self.survival = survival
+        self.footprint = footprint
+        self.survival_positions = gene_loss.positions('survival', survival.sample_keys)
+        self.footprint_positions = gene_loss.positions('footprint', footprint.sample_keys)
+
+    @classmethod
+    def load(cls, gene_loss_file=GENE_LOSS_FILE, survival_file=SURVIVAL_FILE, footprint_file=FOOTPRINT_FILE):
+        return cls(
+            load_gene_loss(gene_loss_file),
+            SurvivalIndex(read_table(survival_file)),
+            load_footprints(footprint_file),
+        )
+
+
+def normalize_spec(spec, datasets):
+    """Fill an analysis spec's defaults and validate its gene, cancer type and feature names.
+
+    A spec has ``deficiencies`` (each with ``name``, ``genes`` and an optional ``rule`` of
+    'any' or 'all'), and optional ``cancer_types``, ``endpoints`` and ``features``, each
+    either a list or 'all'.
+    """
+    index = datasets.gene_loss
+
+    def choose(value, available, what):
+        if value in (None, 'all'):
+            return list(available)
+        unknown = [item for item in value if item not in available]
+        if unknown:
+            raise ValueError(f"Unknown {what}: {', '.join(map(str, unknown))}")
+        return list(value)
+
+    deficiencies = []
+    for i, deficiency in enumerate(spec['deficiencies']):
+        rule = deficiency.get('rule', 'any')
+        if rule not in RULES:
+            raise ValueError(f"Deficiency rule must be 'any' or 'all', got {rule!r}")
+        deficiencies.append({
+            'name': deficiency.get('name', f'Deficiency {i + 1}'),
+            'genes': choose(deficiency['genes'], index.genes, 'genes'),
+            'mutation_type': RULES[rule],
+        })
+    return {
+        'name': spec.get('name'),
+        'deficiencies': deficiencies,
+        'cancer_types': choose(spec.get('cancer_types'), index.cancer_types, 'cancer types'),
+        'endpoints': choose(spec.get('endpoints'), ENDPOINTS, 'endpoints'),
+        'features': choose(spec.get('features'), datasets.footprint.features, 'features'),
+    }
+
+
+def survival_tables(km, names):
+    """Long table of every group's KM step function and the pairwise log-rank table."""
+    curves = []
+    for i, name in enumerate(names):
+        if km.n[i]:
+            time, survival, lower, upper = km.curve(i)
+            curves.append(pd.DataFrame({'Group': name, 'Time': time, 'Survival': survival,
+                                        'Lower CI': lower, 'Upper CI': upper}))
+    non_empty = [i for i in range(len(names)) if km.n[i]]
+    pairs, statistics, p_values = pairwise_logrank(km.deaths, km.at_risk, list(itertools.combinations(non_empty, 2)))
+    logrank = pd.DataFrame({
+        'Group 1': [names[i] for i, _ in pairs],
+        'Group 2': [names[j] for _, j in pairs],
+        'Statistic': statistics,
+        'p-value': p_values,
+        'n1': [int(km.n[i]) for i, _ in pairs],
+        'n2': [int(km.n[j]) for _, j in pairs],
+    })
+    curves = pd.concat(curves, ignore_index=True) if curves else pd.DataFrame(
+        columns=['Group', 'Time', 'Survival', 'Lower CI', 'Upper CI'])
+    return curves, logrank
+
+
+def footprint_table(cube, names, features):
+    rows = []
+    for feature in features:
+        stats = cube.group_stats(feature)
+        for i, name in enumerate(names):
+            rows.append({'Group': name, 'Feature': feature, **{k: v[i] for k, v in stats.items()}})
+    table = pd.DataFrame(rows)
+    table['n'] = table['n'].astype(int)
+    return table
+
+
+def run_analysis(datasets, spec):
+    """All tables of one normalized analysis spec, keyed by table name."""
+    cohorts = datasets.gene_loss.assign(spec['deficiencies'], spec['cancer_types'])
+    names = cohorts.names
+    all_groups = list(range(len(names)))
+    contingency = cohorts.contingency()
+    tables = {
+        'cohorts': pd.DataFrame({'Group': names, 'Sample Number': contingency.sum(axis=1).to_numpy()}),
+        'contingency': contingency.rename_axis('Group').reset_index(),
+    }
+    kms = {}
+
+    overall = []
+    survival_codes = cohorts.codes_for(datasets.survival_positions)
+    for endpoint in spec['endpoints']:
+        endpoint_data = datasets.survival[endpoint]
+        km = KaplanMeier.fit(endpoint_data, endpoint_data.labels(survival_codes, all_groups), len(names))
+        kms[endpoint] = km
+        tables[f'km_{endpoint}'], tables[f'logrank_{endpoint}'] = survival_tables(km, names)
+        statistic, dof, p_value = multivariate_logrank(km.deaths, km.at_risk)
+        overall.append({'Endpoint': endpoint, 'Statistic': statistic, 'df': dof, 'p-value': p_value})
+    tables['logrank_overall'] = pd.DataFrame(overall)
+    positions = datasets.survival_positions
+    strata = np.where(positions >= 0, datasets.gene_loss.cancer_codes[positions], -1)
+    tables['landmarks'] = landmark_table(datasets.survival, survival_codes, strata, names,
+                                         datasets.gene_loss.cancer_types, RMST_HORIZON_YEARS * DAYS_PER_YEAR,
+                                         endpoints=spec['endpoints'])
+
+    if spec['features']:
+        footprint_codes = cohorts.codes_for(datasets.footprint_positions)
+        cube = datasets.footprint.aggregate(cohort_labels(footprint_codes, all_groups), len(names), spec['features'])
+        tables['footprints'] = footprint_table(cube, names, spec['features'])
+    return tables, kms
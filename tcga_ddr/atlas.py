@@ -0,0 +1,348 @@
+"""Offline atlas of single-gene results for every gene, cancer type and endpoint.
+
+``build_atlas`` runs once, e.g. ``python -m tcga_ddr atlas``, and writes uncompressed
+Arrow tables that are memory-mapped when loaded:
+
+- ``survival_counts``: deaths and removals on each endpoint's time grid, per gene and
+  cancer type, of the samples that lost the gene (status 0) and of those with no call
+  for it (status 1). These are the Kaplan-Meier curves of the deficient cohorts.
+- ``survival_totals``: the same counts over all samples of each cancer type. The
+  proficient cohort is the total minus the other two, as in ``FootprintIndex.aggregate``.
+- ``footprint_stats``: count, sum and sum of squares of every footprint feature over
+  the deficient (status 0) and proficient (status 1) samples of each gene, cancer type
+  and footprint cancer type.
+- ``survival_summary`` and ``footprint_summary``: cohort sizes, log-rank statistics,
+  hazard ratios and footprint means per gene and cancer type (plus 'All'), for browsing.
+
+Gene-keyed tables are sorted by gene, so a lookup reads one contiguous slice. Counts
+are additive over cancer types: the counts of a single-gene definition over any
+selection of cancer types are sums of atlas rows and equal what a live computation
+gives. The atlas records the versions of the data files it was built from, and is
+ignored once any of them changes.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+from scipy import sparse
+
+from tcga_ddr.data import _write_atomic, _write_manifest
+from tcga_ddr.footprints import _summary
+from tcga_ddr.logrank import two_group_logrank
+from tcga_ddr.survival import ENDPOINTS
+
+ATLAS_DIR = os.environ.get('TCGA_DDR_ATLAS_DIR', 'atlas')
+
+_ATLAS_VERSION = 1
+
+
+def _sum_by(columns, dims, values):
+    # Distinct rows of the integer ``columns`` (bounded by ``dims``), in sorted order, with summed ``values``
+    keys = np.ravel_multi_index([np.asarray(column, dtype=np.int64) for column in columns], dims)
+    unique, inverse = np.unique(keys, return_inverse=True)
+    sums = [np.bincount(inverse, weights=value, minlength=len(unique)) for value in values]
+    return np.unravel_index(unique, dims), sums
+
+
+def _at_risk(removed):
+    return np.cumsum(removed[..., ::-1], axis=-1)[..., ::-1]
+
+
+def _write_table(path, columns):
+    if isinstance(columns, pd.DataFrame):
+        table = pa.Table.from_pandas(columns, preserve_index=False)
+    else:
+        table = pa.table(columns)
+    _write_atomic(path, lambda tmp_path: feather.write_feather(table, tmp_path, compression='uncompressed'))
+
+
+def _read_columns(path):
+    with pa.memory_map(path, 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return {name: table[name].to_numpy() for name in table.column_names}
+
+
+def _gene_offsets(gene_codes, n_genes):
+    # Row range of every gene in a table sorted by gene
+    return np.searchsorted(gene_codes, np.arange(n_genes + 1))
+
+
+def _survival_counts(batch, masks, observations, n_genes, n_types):
+    """Deaths and removals per (gene, cancer type, status, slot) of one endpoint for a batch of genes."""
+    positions, types, slots, events, n_slots = observations
+    columns, weights = [], []
+    for status, mask in enumerate(masks):
+        gene_at, observation = np.nonzero(mask[:, positions])
+        columns.append([batch[gene_at], types[observation], np.full(len(observation), status), slots[observation]])
+        weights.append(events[observation])
+    columns = [np.concatenate(parts) for parts in zip(*columns)]
+    events = np.concatenate(weights)
+    return _sum_by(columns, (n_genes, n_types, 2, n_slots), [events, np.ones(len(events))])
+
+
+def _survival_summary(genes, cancer_types, endpoint, totals, counts):
+    """Summary rows of one endpoint for the genes in ``counts``: one per cancer type with samples, plus 'All'."""
+    (gene_codes, type_codes, statuses, slots), (deaths, removed) = counts
+    n_types, n_slots = totals.shape[1:]
+    rows = []
+    for gene in np.unique(gene_codes):
+        at = gene_codes == gene
+        # (deaths/removed, status, cancer type, slot)
+        dense = np.zeros((2, 2, n_types, n_slots))
+        np.add.at(dense, (0, statuses[at], type_codes[at], slots[at]), deaths[at])
+        np.add.at(dense, (1, statuses[at], type_codes[at], slots[at]), removed[at])
+        deficient = dense[:, 0]
+        proficient = totals - dense[:, 0] - dense[:, 1]
+        # The 'All' row pools every cancer type
+        deficient = np.concatenate([deficient, deficient.sum(axis=1, keepdims=True)], axis=1)
+        proficient = np.concatenate([proficient, proficient.sum(axis=1, keepdims=True)], axis=1)
+        statistics, p_values, observed, expected = two_group_logrank(
+            deficient[0], _at_risk(deficient[1]), proficient[0], _at_risk(proficient[1]))
+        observed_p = proficient[0].sum(axis=1)
+        expected_p = observed + observed_p - expected
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hazard_ratio = (observed / expected) / (observed_p / expected_p)
+        n_deficient, n_proficient = deficient[1].sum(axis=1), proficient[1].sum(axis=1)
+        for t, cancer_type in enumerate(list(cancer_types) + ['All']):
+            if n_deficient[t] + n_proficient[t] == 0:
+                continue
+            rows.append({
+                'Gene': genes[gene], 'Cancer type': cancer_type, 'Endpoint': endpoint,
+                'n deficient': int(n_deficient[t]), 'n proficient': int(n_proficient[t]),
+                'events deficient': int(observed[t]), 'events proficient': int(observed_p[t]),
+                'statistic': statistics[t], 'p-value': p_values[t], 'HR': hazard_ratio[t],
+            })
+    return rows
+
+
+def _footprint_summary(genes, cancer_types, features, stats):
+    """Count and mean of every feature for the deficient and proficient samples, per cancer type and 'All'."""
+    frame = pd.DataFrame({name: stats[name] for name in ['gene', 'cancer_type', 'status', 'feature', 'n', 'sum', 'sum_sq']})
+    # The 'All' rows pool every cancer type
+    frame = pd.concat([frame, frame.assign(cancer_type=len(cancer_types))], ignore_index=True)
+    sums = frame.groupby(['gene', 'cancer_type', 'feature', 'status'])[['n', 'sum', 'sum_sq']].sum().unstack('status')
+    sums = sums.reindex(columns=pd.MultiIndex.from_product([['n', 'sum', 'sum_sq'], [0, 1]]), fill_value=0.0).fillna(0.0)
+    table = sums.index.to_frame(index=False)
+    type_names = list(cancer_types) + ['All']
+    summary = pd.DataFrame({
+        'Gene': [genes[g] for g in table['gene']],
+        'Cancer type': [type_names[t] for t in table['cancer_type']],
+        'Feature': [features[f] for f in table['feature']],
+    })
+    for status, cohort in enumerate(['deficient', 'proficient']):
+        stats = _summary(sums[('n', status)].to_numpy(), sums[('sum', status)].to_numpy(),
+                         sums[('sum_sq', status)].to_numpy())
+        summary[f'n {cohort}'] = stats['n'].astype(int)
+        summary[f'mean {cohort}'] = stats['mean']
+    return summary
+
+
+def build_atlas(datasets, out_dir, versions, genes=None, batch_size=64, progress=None):
+    """Precompute the atlas of ``genes`` (default: all) and write it to ``out_dir``.
+
+    ``versions`` maps 'gene_loss', 'survival' and 'footprint' to the ``source_version``
+    of the files ``datasets`` was loaded from.
+    """
+    index = datasets.gene_loss
+    footprint = datasets.footprint
+    genes = list(index.genes if genes is None else genes)
+    gene_rows = [index.genes.index(gene) for gene in genes]
+    n_genes, n_types, n_features = len(genes), len(index.cancer_types), len(footprint.features)
+
+    # Survival observations linked to the gene-loss table, with their cancer type and grid slot
+    observations, totals = {}, {}
+    for endpoint in ENDPOINTS:
+        endpoint_data = datasets.survival[endpoint]
+        positions = datasets.survival_positions[endpoint_data.rows]
+        keep = positions >= 0
+        positions = positions[keep]
+        types, slots, events = index.cancer_codes[positions], endpoint_data.time_index[keep], endpoint_data.event[keep]
+        n_slots = len(endpoint_data.grid)
+        observations[endpoint] = (positions, types, slots, events, n_slots)
+        # (deaths/removed, cancer type, slot)
+        totals[endpoint] = np.zeros((2, n_types, n_slots))
+        np.add.at(totals[endpoint], (0, types, slots), events)
+        np.add.at(totals[endpoint], (1, types, slots), 1.0)
+
+    # Footprint rows linked to the gene-loss table. Their statistics are placed in the column
+    # block of their (cancer type, footprint cancer type) pair, so one sparse product per
+    # batch sums every pair of every gene
+    fp_rows = np.flatnonzero(datasets.footprint_positions >= 0)
+    fp_positions = datasets.footprint_positions[fp_rows]
+    n_fp_types = len(footprint.cancer_types)
+    pairs, pair_of_row = np.unique(index.cancer_codes[fp_positions].astype(np.int64) * n_fp_types
+                                   + footprint.cancer_codes[fp_rows], return_inverse=True)
+    width = 3 * n_features
+    stats = footprint.sufficient_stats(fp_rows, list(range(n_features))).reshape(len(fp_rows), width)
+    placed = sparse.csr_matrix(
+        (stats.ravel(), (np.repeat(np.arange(len(fp_rows)), width), (pair_of_row[:, None] * width + np.arange(width)).ravel())),
+        shape=(len(fp_rows), len(pairs) * width))
+    in_pair = sparse.csr_matrix((np.ones(len(fp_rows)), (np.arange(len(fp_rows)), pair_of_row)),
+                                shape=(len(fp_rows), len(pairs)))
+
+    counts_parts, footprint_parts, summary_rows = [], [], []
+    n_batches = (n_genes + batch_size - 1) // batch_size
+    for batch_number, start in enumerate(range(0, n_genes, batch_size)):
+        batch = np.arange(start, min(start + batch_size, n_genes))
+        rows = [gene_rows[i] for i in batch]
+        loss = np.unpackbits(index.loss_bits[rows], axis=1, count=index.n_samples).astype(bool)
+        no_call = ~np.unpackbits(index.valid_bits[rows], axis=1, count=index.n_samples).astype(bool)
+
+        for e, endpoint in enumerate(ENDPOINTS):
+            counts = _survival_counts(batch, (loss, no_call), observations[endpoint], n_genes, n_types)
+            (gene_codes, type_codes, statuses, slots), (deaths, removed) = counts
+            counts_parts.append({
+                'gene': gene_codes.astype(np.int32), 'endpoint': np.full(len(gene_codes), e, dtype=np.int8),
+                'cancer_type': type_codes.astype(np.int16), 'status': statuses.astype(np.int8),
+                'slot': slots.astype(np.int32), 'deaths': deaths, 'removed': removed,
+            })
+            summary_rows += _survival_summary(genes, index.cancer_types, endpoint, totals[endpoint], counts)
+
+        cohorts = (loss[:, fp_positions], ~(loss | no_call)[:, fp_positions])
+        for status, members in enumerate(cohorts):
+            members = sparse.csr_matrix(members.astype(float))
+            sizes = (members @ in_pair).toarray()
+            sums = (members @ placed).toarray().reshape(len(batch), len(pairs), 3, n_features)
+            gene_at, pair_at = np.nonzero(sizes)
+            footprint_parts.append({
+                'gene': np.repeat(batch[gene_at], n_features).astype(np.int32),
+                'cancer_type': np.repeat(pairs[pair_at] // n_fp_types, n_features).astype(np.int16),
+                'footprint_cancer_type': np.repeat(pairs[pair_at] % n_fp_types, n_features).astype(np.int16),
+                'status': np.full(len(gene_at) * n_features, status, dtype=np.int8),
+                'feature': np.tile(np.arange(n_features), len(gene_at)).astype(np.int16),
+                'n': sums[gene_at, pair_at, 0].ravel(),
+                'sum': sums[gene_at, pair_at, 1].ravel(),
+                'sum_sq': sums[gene_at, pair_at, 2].ravel(),
+            })
+        if progress is not None:
+            progress(batch_number + 1, n_batches)
+
+    os.makedirs(out_dir, exist_ok=True)
+    counts = {name: np.concatenate([part[name] for part in counts_parts]) for name in counts_parts[0]}
+    order = np.lexsort((counts['slot'], counts['status'], counts['cancer_type'], counts['endpoint'], counts['gene']))
+    _write_table(os.path.join(out_dir, 'survival_counts.arrow'), {name: values[order] for name, values in counts.items()})
+
+    survival_totals = {name: [] for name in ['endpoint', 'cancer_type', 'slot', 'deaths', 'removed']}
+    for e, endpoint in enumerate(ENDPOINTS):
+        types, slots = np.nonzero(totals[endpoint][1])
+        survival_totals['endpoint'].append(np.full(len(types), e, dtype=np.int8))
+        survival_totals['cancer_type'].append(types.astype(np.int16))
+        survival_totals['slot'].append(slots.astype(np.int32))
+        survival_totals['deaths'].append(totals[endpoint][0][types, slots])
+        survival_totals['removed'].append(totals[endpoint][1][types, slots])
+    _write_table(os.path.join(out_dir, 'survival_totals.arrow'),
+                 {name: np.concatenate(parts) for name, parts in survival_totals.items()})
+
+    fp_stats = {name: np.concatenate([part[name] for part in footprint_parts]) for name in footprint_parts[0]}
+    order = np.argsort(fp_stats['gene'], kind='stable')
+    fp_stats = {name: values[order] for name, values in fp_stats.items()}
+    _write_table(os.path.join(out_dir, 'footprint_stats.arrow'), fp_stats)
+
+    _write_table(os.path.join(out_dir, 'survival_summary.arrow'), pd.DataFrame(summary_rows))
+    _write_table(os.path.join(out_dir, 'footprint_summary.arrow'),
+                 _footprint_summary(genes, index.cancer_types, footprint.features, fp_stats))
+    # Written last: an atlas without a manifest is never loaded
+    _write_manifest(os.path.join(out_dir, 'manifest.json'), {
+        'version': _ATLAS_VERSION, 'sources': versions, 'genes': genes,
+        'cancer_types': list(index.cancer_types), 'footprint_cancer_types': list(footprint.cancer_types),
+        'features': list(footprint.features),
+        'grid_sizes': {endpoint: observations[endpoint][4] for endpoint in ENDPOINTS},
+    })
+
+
+def atlas_version(path=ATLAS_DIR):
+    # Changes whenever the atlas is rebuilt; None when there is no atlas
+    try:
+        stat = os.stat(os.path.join(path, 'manifest.json'))
+    except OSError:
+        return None
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def load_atlas(path=ATLAS_DIR):
+    """The atlas in ``path``, or None if there is none (or it was built by another version)."""
+    try:
+        with open(os.path.join(path, 'manifest.json'), 'r') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != _ATLAS_VERSION:
+        return None
+    return Atlas(path, manifest)
+
+
+class Atlas:
+    """Memory-mapped atlas tables with lookups of single-gene cohorts."""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.sources = manifest['sources']
+        self.genes = manifest['genes']
+        self.gene_pos = {gene: i for i, gene in enumerate(self.genes)}
+        self.cancer_types = manifest['cancer_types']
+        self.footprint_cancer_types = manifest['footprint_cancer_types']
+        self.features = manifest['features']
+        self.grid_sizes = manifest['grid_sizes']
+        self._counts = _read_columns(os.path.join(path, 'survival_counts.arrow'))
+        self._stats = _read_columns(os.path.join(path, 'footprint_stats.arrow'))
+        self._count_offsets = _gene_offsets(self._counts['gene'], len(self.genes))
+        self._footprint_offsets = _gene_offsets(self._stats['gene'], len(self.genes))
+        totals = _read_columns(os.path.join(path, 'survival_totals.arrow'))
+        # (deaths/removed, cancer type, slot) per endpoint
+        self.totals = {}
+        for e, endpoint in enumerate(ENDPOINTS):
+            at = totals['endpoint'] == e
+            dense = np.zeros((2, len(self.cancer_types), self.grid_sizes[endpoint]))
+            dense[0, totals['cancer_type'][at], totals['slot'][at]] = totals['deaths'][at]
+            dense[1, totals['cancer_type'][at], totals['slot'][at]] = totals['removed'][at]
+            self.totals[endpoint] = dense
+
+    def covers(self, gene, **versions):
+        """Whether ``gene`` is in the atlas and it was built from these data ``versions``."""
+        return gene in self.gene_pos and all(self.sources.get(name) == version for name, version in versions.items())
+
+    def table(self, name):
+        """A browsable summary table ('survival_summary' or 'footprint_summary') as a DataFrame."""
+        with pa.memory_map(os.path.join(self.path, f'{name}.arrow'), 'r') as source:
+            return pa.ipc.open_file(source).read_all().to_pandas()
+
+    def _selected(self, cancer_types):
+        selected = np.zeros(len(self.cancer_types), dtype=bool)
+        positions = pd.Index(self.cancer_types, dtype=object).get_indexer(list(cancer_types))
+        selected[positions[positions >= 0]] = True
+        return selected
+
+    def survival_counts(self, endpoint, gene, cancer_types, codes):
+        """(cohort, deaths/removed/at risk, slot) counts of the cohorts ``codes`` of a one-gene definition.
+
+        Code 0 is the deficient and code 1 the proficient cohort; only samples of the
+        selected ``cancer_types`` count, as in ``GeneLossIndex.assign``.
+        """
+        g = self.gene_pos[gene]
+        rows = slice(self._count_offsets[g], self._count_offsets[g + 1])
+        selected = self._selected(cancer_types)
+        at = (self._counts['endpoint'][rows] == ENDPOINTS.index(endpoint)) & selected[self._counts['cancer_type'][rows]]
+        statuses, slots = self._counts['status'][rows][at], self._counts['slot'][rows][at]
+        # (deaths/removed, status, slot)
+        dense = np.zeros((2, 2, self.grid_sizes[endpoint]))
+        np.add.at(dense, (0, statuses, slots), self._counts['deaths'][rows][at])
+        np.add.at(dense, (1, statuses, slots), self._counts['removed'][rows][at])
+        deficient = dense[:, 0]
+        proficient = self.totals[endpoint][:, selected].sum(axis=1) - dense[:, 0] - dense[:, 1]
+        cohorts = [deficient, proficient]
+        return np.stack([np.stack([cohorts[code][0], cohorts[code][1], _at_risk(cohorts[code][1])]) for code in codes])
+
+    def footprint_stats(self, gene, cancer_types, codes):
+        """(cohort, footprint cancer type, statistic, feature) sums, as in ``FootprintIndex.aggregate``."""
+        g = self.gene_pos[gene]
+        rows = slice(self._footprint_offsets[g], self._footprint_offsets[g + 1])
+        stats = {name: values[rows] for name, values in self._stats.items()}
+        at = self._selected(cancer_types)[stats['cancer_type']]
+        cube = np.zeros((2, len(self.footprint_cancer_types), 3, len(self.features)))
+        for s, name in enumerate(['n', 'sum', 'sum_sq']):
+            np.add.at(cube, (stats['status'][at], stats['footprint_cancer_type'][at], s, stats['feature'][at]),
+                      stats[name][at])
+        return cube[list(codes)]
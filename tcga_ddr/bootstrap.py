@@ -0,0 +1,118 @@
+"""Bootstrap confidence intervals of cohort statistics, resampled in parallel with early stopping.
+
+A batch of resamples of a cohort with n samples is drawn at once as a (resamples x n)
+matrix of indices and turned into a matrix of counts, i.e. how often every sample was
+drawn. The statistics below are written for such weights, so a whole batch is one
+matrix product. Batches are spread over the shared process pool in rounds. Every
+(cohort, batch) has its own seed derived from the base seed, so the intervals do not
+depend on the number of workers. A cohort stops once a round leaves its percentile
+intervals within ``tolerance`` of their width.
+"""
+import functools
+
+import numpy as np
+from scipy import sparse
+
+from tcga_ddr.parallel import MAX_WORKERS, run_tasks
+from tcga_ddr.survival import median_survival, restricted_mean
+
+N_RESAMPLES = 10_000
+BATCH_SIZE = 500
+# Batches per cohort between two convergence checks
+ROUND_BATCHES = 4
+
+
+def resample_counts(rng, n, size):
+    """(size, n) float matrix of how often each of n samples is drawn in each resample."""
+    draws = rng.integers(0, n, size=(size, n)) + n * np.arange(size)[:, None]
+    return np.bincount(draws.ravel(), minlength=size * n).reshape(size, n).astype(float)
+
+
+def feature_means(values, weights):
+    """Weighted mean of every column of ``values`` (NaN = missing) for each row of ``weights``."""
+    valid = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (weights @ np.where(valid, values, 0.0)) / (weights @ valid)
+
+
+def survival_summaries(time, event, weights, horizon):
+    """Kaplan-Meier median survival and restricted mean survival time up to ``horizon``.
+
+    Returns a (resamples, 2) array; a median that is not reached is infinite.
+    """
+    grid, slot = np.unique(time, return_inverse=True)
+    rows = np.arange(len(time))
+    removed = sparse.csr_matrix((np.ones(len(time)), (rows, slot)), shape=(len(time), len(grid)))
+    died = sparse.csr_matrix((event.astype(float), (rows, slot)), shape=(len(time), len(grid)))
+    deaths = np.asarray((died.T @ weights.T).T)
+    at_risk = np.cumsum(np.asarray((removed.T @ weights.T).T)[:, ::-1], axis=1)[:, ::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        survival = np.cumprod(1.0 - np.where(at_risk > 0, deaths / at_risk, 0.0), axis=1)
+    return np.stack([median_survival(grid, survival), restricted_mean(grid, survival, horizon)], axis=1)
+
+
+def _batch_task(statistic, arrays, size, seed):
+    rng = np.random.default_rng(seed)
+    return statistic(*arrays, resample_counts(rng, len(arrays[0]), size))
+
+
+def _percentiles(samples, alpha):
+    # No interpolation, so statistics that can be infinite (unreached medians) stay well defined
+    return np.quantile(samples, [alpha / 2, 1 - alpha / 2], axis=0, method='inverted_cdf')
+
+
+def bootstrap(statistic, groups, n_resamples=N_RESAMPLES, alpha=0.05, tolerance=0.02, seed=0,
+              batch_size=BATCH_SIZE, max_workers=None):
+    """Percentile bootstrap intervals of ``statistic`` for every group.
+
+    ``groups`` holds one tuple of per-sample arrays per group; ``statistic(*arrays,
+    weights)`` returns one row of statistics per row of ``weights``. Returns one dict per
+    group with the ``estimate`` on the original sample, the ``lower`` and ``upper``
+    bounds and the number of ``resamples`` drawn before the bounds settled.
+    """
+    workers = MAX_WORKERS if max_workers is None else max_workers
+    n_batches = max(1, -(-n_resamples // batch_size))
+    results = []
+    for arrays in groups:
+        n = len(arrays[0])
+        estimate = statistic(*arrays, np.ones((1, n)))[0] if n else np.array([])
+        results.append({'estimate': estimate, 'lower': np.full(estimate.shape, np.nan),
+                        'upper': np.full(estimate.shape, np.nan), 'resamples': 0})
+    samples = [[] for _ in groups]
+    active = [g for g, arrays in enumerate(groups) if len(arrays[0]) > 1]
+    done_batches = 0
+    while active and done_batches < n_batches:
+        batches = range(done_batches, min(done_batches + ROUND_BATCHES, n_batches))
+        tasks = [(statistic, groups[g], min(batch_size, n_resamples - b * batch_size),
+                  np.random.SeedSequence(seed, spawn_key=(g, b))) for g in active for b in batches]
+        outputs = iter(run_tasks(_batch_task, tasks, max_workers=workers))
+        converged = []
+        for g in active:
+            samples[g].extend(next(outputs) for _ in batches)
+            drawn = np.concatenate(samples[g])
+            lower, upper = _percentiles(drawn, alpha)
+            previous = results[g]['lower'], results[g]['upper']
+            results[g].update(lower=lower, upper=upper, resamples=len(drawn))
+            if done_batches:
+                with np.errstate(invalid='ignore'):
+                    width = np.where(np.isfinite(upper - lower), upper - lower, np.inf)
+                    shift = np.maximum(np.abs(lower - previous[0]), np.abs(upper - previous[1]))
+                    shift = np.where((lower == previous[0]) & (upper == previous[1]), 0.0, shift)
+                    converged.append(bool(np.all((shift <= tolerance * width) | np.isnan(lower))))
+            else:
+                converged.append(False)
+        active = [g for g, stop in zip(active, converged) if not stop]
+        done_batches = batches.stop
+    return results
+
+
+def footprint_intervals(values, labels, n_groups, **options):
+    """Bootstrap intervals of every group's feature means; ``values`` is (samples, features)."""
+    groups = [(np.asarray(values[labels == g], dtype=float),) for g in range(n_groups)]
+    return bootstrap(feature_means, groups, **options)
+
+
+def survival_intervals(endpoint_data, labels, n_groups, horizon, **options):
+    """Bootstrap intervals of every group's median survival and RMST up to ``horizon``."""
+    groups = [(endpoint_data.time[labels == g], endpoint_data.event[labels == g]) for g in range(n_groups)]
+    return bootstrap(functools.partial(survival_summaries, horizon=horizon), groups, **options)
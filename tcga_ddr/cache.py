@@ -0,0 +1,140 @@
+"""Process-wide result cache with a memory budget, LRU/TTL eviction and hit/miss counters."""
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# Defaults for the shared caches, overridable from the environment
+CACHE_MB = float(os.environ.get('TCGA_DDR_CACHE_MB', 512))
+CACHE_TTL = float(os.environ.get('TCGA_DDR_CACHE_TTL', 0)) or None
+
+
+def canonical_key(*parts):
+    """Stable hash of JSON-like parts; sets (and frozensets) are hashed independent of order."""
+    def normalize(value):
+        if isinstance(value, (set, frozenset)):
+            return sorted((normalize(item) for item in value), key=repr)
+        if isinstance(value, dict):
+            return {str(k): normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(item) for item in value]
+        if isinstance(value, np.generic):
+            return value.item()
+        return value
+
+    return hashlib.sha1(json.dumps(normalize(parts), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def size_of(value):
+    # Approximate footprint of a cached value: array buffers plus container overhead
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(deep=True))
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(size_of(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(size_of(k) + size_of(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class ResultCache:
+    """Thread-safe LRU map bounded by total size, with optional time-to-live.
+
+    Entries are evicted least-recently-used first once their summed size exceeds
+    ``max_bytes``; with ``ttl`` (seconds) they also expire that long after being stored.
+    ``stats()`` reports hits, misses, evictions and the current size.
+    """
+
+    def __init__(self, max_bytes=int(CACHE_MB * 2 ** 20), ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def _live(self, key):
+        # Entry for key, dropping it if it has expired; call with the lock held
+        entry = self._entries.get(key)
+        if entry is not None and self.ttl is not None and time.monotonic() - entry[2] > self.ttl:
+            self._drop(key)
+            self.expirations += 1
+            entry = None
+        return entry
+
+    def _drop(self, key):
+        _, nbytes, _ = self._entries.pop(key)
+        self._bytes -= nbytes
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def peek(self, key):
+        # Like get, without touching the counters or the LRU order
+        with self._lock:
+            entry = self._live(key)
+            return None if entry is None else entry[0]
+
+    def put(self, key, value, nbytes=None):
+        """Store ``value``; values larger than the whole budget are not kept."""
+        nbytes = size_of(value) if nbytes is None else nbytes
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            if nbytes > self.max_bytes:
+                return value
+            self._entries[key] = (value, nbytes, time.monotonic())
+            self._bytes += nbytes
+            while self._bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+        return value
+
+    def get_or_compute(self, key, compute, nbytes=None):
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute(), nbytes)
+        return value
+
+    def __contains__(self, key):
+        return self.peek(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else np.nan,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
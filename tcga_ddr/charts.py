@@ -0,0 +1,359 @@
+"""Chart builders for the pages: ECharts option dicts and on-demand Matplotlib exports."""
+import io
+
+import numpy as np
+import pandas as pd
+from matplotlib.figure import Figure
+
+from tcga_ddr.survival import DAYS_PER_YEAR
+
+# Matplotlib's default cycle, so the interactive and exported KM plots use the same colours
+KM_COLORS = ["#1f77b4", "#ff7f0e", "#2ca02c", "#d62728", "#9467bd",
+             "#8c564b", "#e377c2", "#7f7f7f", "#bcbd22", "#17becf"]
+# Horizontal resolution the interactive KM curves are reduced to, about the chart's width in pixels
+KM_PIXEL_BUDGET = 1000
+# Candidate spacings (years) of the number-at-risk ticks; the smallest giving at most 10 intervals wins
+RISK_TICK_YEARS = (1, 2, 5, 10)
+# Footprint charts drawn at a time; longer feature lists are paged
+FOOTPRINT_CHARTS_PER_PAGE = 6
+
+
+def _points(time, values):
+    return np.column_stack([np.round(time, 1), np.round(values, 4)]).tolist()
+
+
+def downsample_steps(time, arrays, x_max, budget=KM_PIXEL_BUDGET):
+    """Indices of the points of step curves on a shared time axis that stay visible.
+
+    Points where no array changes (censoring-only times) draw nothing and are dropped,
+    except for the last, which ends the curve. Then the axis from 0 to ``x_max`` is
+    split into ``budget`` columns, and within a column only the first and last point and
+    the lowest and highest point of every array are kept. A step curve through those
+    points differs from the full curve by less than a column.
+    """
+    steps = np.zeros(len(time), dtype=bool)
+    steps[:1] = True
+    steps[-1:] = True
+    for values in arrays:
+        steps[1:] |= values[1:] != values[:-1]
+    candidates = np.flatnonzero(steps)
+    if len(candidates) <= budget:
+        return candidates
+    columns = np.minimum((time[candidates] / max(x_max, 1e-12) * budget).astype(np.int64), budget - 1)
+    keep = np.zeros(len(candidates), dtype=bool)
+    starts = np.flatnonzero(np.diff(columns, prepend=-1))
+    keep[starts] = True
+    keep[np.append(starts[1:], len(candidates)) - 1] = True
+    for values in arrays:
+        # Sorted by value within each column, the first and last entries are the extremes
+        order = np.lexsort((values[candidates], columns))
+        ends = np.flatnonzero(np.diff(columns[order], prepend=-1))
+        keep[order[ends]] = True
+        keep[order[np.append(ends[1:], len(candidates)) - 1]] = True
+    return candidates[keep]
+
+
+def risk_ticks(max_days):
+    """Times (days) of the number-at-risk table: whole years from 0 to the last follow-up."""
+    years = max_days / DAYS_PER_YEAR
+    step = next((step for step in RISK_TICK_YEARS if years / step <= 10), RISK_TICK_YEARS[-1])
+    return np.arange(0, np.floor(years / step) + 1) * step * DAYS_PER_YEAR
+
+
+def at_risk_table(km, groups, ticks=None):
+    """Number at risk of every non-empty group at each tick, with the ticks in years as columns."""
+    ticks = risk_ticks(km.grid[-1] if len(km.grid) else 0.0) if ticks is None else np.asarray(ticks)
+    _, at_risk = km.at(ticks)
+    rows = [i for i in range(len(groups)) if km.n[i]]
+    return pd.DataFrame(at_risk[rows].astype(int), index=[groups[i] for i in rows],
+                        columns=[f'{t / DAYS_PER_YEAR:g} y' for t in ticks])
+
+
+def km_chart_options(km, groups, show_legend=True, budget=KM_PIXEL_BUDGET):
+    """ECharts options drawing each group's KM step function and its confidence band.
+
+    Curves are reduced to the points visible at ``budget`` horizontal pixels.
+    """
+    series = []
+    x_max = km.grid[-1] if len(km.grid) else 0.0
+    for i, group in enumerate(groups):
+        if not km.n[i]:
+            continue
+        color = KM_COLORS[i % len(KM_COLORS)]
+        time, survival, lower, upper = km.curve(i)
+        # Curve and band share their points, as the band is stacked point by point
+        kept = downsample_steps(time, [survival, lower, upper], x_max, budget)
+        time, survival, lower, upper = time[kept], survival[kept], lower[kept], upper[kept]
+        # The band is drawn as an invisible lower line with the CI width stacked on top; sharing
+        # the group's name lets the legend toggle curve and band together
+        series.append({
+            "name": group,
+            "type": "line",
+            "step": "end",
+            "stack": f"ci-{i}",
+            "symbol": "none",
+            "silent": True,
+            "lineStyle": {"opacity": 0},
+            "data": _points(time, lower),
+        })
+        series.append({
+            "name": group,
+            "type": "line",
+            "step": "end",
+            "stack": f"ci-{i}",
+            "symbol": "none",
+            "silent": True,
+            "lineStyle": {"opacity": 0},
+            "areaStyle": {"color": color, "opacity": 0.3},
+            "data": _points(time, upper - lower),
+        })
+        series.append({
+            "name": group,
+            "type": "line",
+            "step": "end",
+            "symbol": "none",
+            "itemStyle": {"color": color},
+            "lineStyle": {"width": 2},
+            "data": _points(time, survival),
+        })
+
+    return {
+        "tooltip": {"trigger": "item"},
+        "legend": {
+            "show": show_legend,
+            "data": [group for i, group in enumerate(groups) if km.n[i]],
+            "right": "5%",
+            "top": "5%",
+            "orient": "vertical",
+            "type": "scroll",
+            "textStyle": {"color": "#FFFFFF", "fontSize": 12}
+        },
+        "grid": {"left": "8%", "right": "5%", "bottom": "12%", "containLabel": True},
+        "xAxis": {
+            "type": "value",
+            "name": "Days",
+            "nameLocation": "middle",
+            "nameGap": 30,
+            "nameTextStyle": {"color": "#FFFFFF", "fontSize": 14},
+            "axisLabel": {"color": "#FFFFFF"},
+            "splitLine": {"show": False}
+        },
+        "yAxis": {
+            "type": "value",
+            "name": "Probability",
+            "nameLocation": "middle",
+            "nameGap": 40,
+            "min": 0,
+            "max": 1,
+            "nameTextStyle": {"color": "#FFFFFF", "fontSize": 14},
+            "axisLabel": {"color": "#FFFFFF"}
+        },
+        "dataZoom": [{"type": "inside", "xAxisIndex": 0}],
+        "series": series,
+    }
+
+
+# Styling shared by every footprint bar chart; the option builders below only fill in the data
+_TEXT_COLOR = "#FFFFFF"
+_CORAL = "#E07B5F"
+_DARK_CORAL = "#C1533E"
+_FOOTPRINT_ZOOM = [{
+    "type": "slider",
+    "xAxisIndex": 0,
+    "start": 0,
+    "end": 100,
+    "handleSize": "150%",
+    "height": 25,
+    "bottom": '2%',
+    "backgroundColor": "rgba(0, 0, 0, 0)",
+    "dataBackground": {
+        "lineStyle": {
+            "color": {
+                "type": 'linear', "x": 0, "y": 0, "x2": 1, "y2": 0,
+                "colorStops": [{"offset": 0, "color": _CORAL}, {"offset": 1, "color": _DARK_CORAL}],
+            },
+            "width": 2
+        },
+        "areaStyle": {"color": "rgba(0, 0, 0, 0)"}
+    },
+    "handleStyle": {"color": _CORAL, "borderColor": _DARK_CORAL, "borderWidth": 2, "borderRadius": "50%"},
+    "textStyle": {"color": _DARK_CORAL, "fontSize": 9},
+    "fillerColor": "rgba(224, 123, 95, 0.2)",
+    "borderColor": _DARK_CORAL
+}]
+_FOOTPRINT_LABEL = {"show": True, "position": 'top', "formatter": "{c}", "fontWeight": 'bold',
+                    "padding": [3, 5], "borderRadius": 3, "distance": 10}
+
+
+def _footprint_options(feature, x_labels, legend, grid, x_axis_extra=None):
+    return {
+        "tooltip": {"trigger": 'axis', "axisPointer": {"type": 'shadow'}},
+        "legend": {
+            "data": legend,
+            "orient": 'vertical',
+            "right": '5%',
+            "top": 'middle',
+            "type": 'scroll',
+            "textStyle": {"color": _TEXT_COLOR, "fontSize": 12}
+        },
+        "grid": {**grid, "bottom": '10%', "containLabel": True},
+        "xAxis": {
+            "type": 'category',
+            "data": x_labels,
+            "axisLabel": {"color": _TEXT_COLOR, "fontSize": 12},
+            **(x_axis_extra or {}),
+        },
+        "yAxis": {
+            "type": 'value',
+            "name": f"Mean of {feature}",
+            "nameLocation": 'middle',
+            "nameGap": 50,
+            "nameTextStyle": {"fontSize": 14, "fontWeight": 'bold', "color": _TEXT_COLOR},
+            "axisLabel": {"color": _TEXT_COLOR}
+        },
+        "dataZoom": _FOOTPRINT_ZOOM,
+    }
+
+
+def footprint_split_options(feature, x_labels, categories, data, colors):
+    """Bars of every cancer type within each group; ``data`` holds one list of means per cancer type."""
+    options = _footprint_options(feature, x_labels, categories, {"left": '6%', "right": '20%'})
+    options["series"] = [{
+        "name": category,
+        "type": 'bar',
+        "data": values,
+        "itemStyle": {"color": colors.get(category, '#FFFFFF')},
+        "label": {**_FOOTPRINT_LABEL, "fontSize": 12, "color": colors.get(category, '#FFFFFF'),
+                  "backgroundColor": "rgba(110, 122, 131, 0.3)"},
+    } for category, values in zip(categories, data)]
+    return options
+
+
+def footprint_bar_options(feature, x_labels, groups, means, bar_width, errors=None, error_name=None):
+    """One bar per group mean, with ``errors`` as (low, high) whiskers when given."""
+    options = _footprint_options(feature, x_labels, groups, {"left": '7%', "right": '5%'},
+                                 {"axisTick": {"alignWithLabel": True}, "axisLine": {"onZero": False}})
+    options["series"] = [{
+        "name": "Mean Value",
+        "type": 'bar',
+        "data": means,
+        "itemStyle": {
+            "color": {
+                "type": 'linear', "x": 0, "y": 0, "x2": 0, "y2": 1,
+                "colorStops": [{"offset": 0, "color": _CORAL}, {"offset": 1, "color": _DARK_CORAL}],
+            }
+        },
+        "barWidth": bar_width,
+        "label": {**_FOOTPRINT_LABEL, "fontSize": 15, "color": _CORAL, "backgroundColor": "rgba(110, 122, 131, 0.5)"},
+    }]
+    if errors is not None:
+        # A boxplot with a flat box at the mean draws the error bar as whiskers
+        options["series"].append({
+            "name": error_name,
+            "type": 'boxplot',
+            "boxWidth": [bar_width / 2, bar_width / 2],
+            "itemStyle": {"color": "rgba(0, 0, 0, 0)", "borderColor": "#FFFFFF"},
+            "tooltip": {"show": False},
+            "data": [[low, m, m, m, high] for m, (low, high) in zip(means, errors)]
+        })
+    return options
+
+
+def footprint_heatmap_options(z, means, limit=3):
+    """Heatmap of the z-scores in ``z`` (rows x features); the tooltip also shows the cell's mean.
+
+    Colours saturate at +-``limit`` SD and empty cells are left blank.
+    """
+    rows, features = list(z.index), list(z.columns)
+    # ECharts leaves cells whose value is '-' empty
+    scores = np.where(np.isnan(z.to_numpy()), '-', z.round(2).to_numpy().astype(object))
+    values = np.where(np.isnan(means.to_numpy()), '-', means.round(3).to_numpy().astype(object))
+    data = [[j, i, scores[i, j], values[i, j]] for i in range(len(rows)) for j in range(len(features))]
+    return {
+        "tooltip": {"position": 'top'},
+        "grid": {"left": '3%', "right": '3%', "top": 10, "bottom": 90, "containLabel": True},
+        "xAxis": {
+            "type": 'category',
+            "data": features,
+            "splitArea": {"show": True},
+            "axisLabel": {"color": _TEXT_COLOR, "fontSize": 11, "rotate": 45, "interval": 0}
+        },
+        # Category axes run bottom-up, so the first row is drawn at the top
+        "yAxis": {
+            "type": 'category',
+            "data": rows,
+            "inverse": True,
+            "splitArea": {"show": True},
+            "axisLabel": {"color": _TEXT_COLOR, "fontSize": 11, "interval": 0}
+        },
+        "visualMap": {
+            "min": -limit,
+            "max": limit,
+            "dimension": 2,
+            "calculable": True,
+            "orient": 'horizontal',
+            "left": 'center',
+            "bottom": 0,
+            "text": [f"+{limit} SD", f"-{limit} SD"],
+            "textStyle": {"color": _TEXT_COLOR},
+            "inRange": {"color": ["#4F86F7", "#F7F7F7", _CORAL]}
+        },
+        "series": [{
+            "name": "z-score",
+            "type": 'heatmap',
+            "data": data,
+            "dimensions": ["feature", "row", "z-score", "mean"],
+            "encode": {"x": 0, "y": 1, "tooltip": [2, 3]},
+            "emphasis": {"itemStyle": {"borderColor": _TEXT_COLOR, "borderWidth": 1}}
+        }]
+    }
+
+
+def km_figure(km, groups, show_legend=True, risk_table=True):
+    """The original high-resolution KM figure, drawn on a standalone Figure.
+
+    With ``risk_table``, the numbers at risk at the ``risk_ticks`` are listed under the plot.
+    """
+    shown = [i for i in range(len(groups)) if km.n[i]]
+    if risk_table and shown:
+        fig = Figure(figsize=(10, 9 + 0.45 * len(shown)))
+        ax, table_ax = fig.subplots(2, 1, gridspec_kw={'height_ratios': [9, 0.45 * len(shown) + 0.6]})
+    else:
+        fig = Figure(figsize=(10, 9))
+        ax, table_ax = fig.subplots(), None
+    for i in shown:
+        color = KM_COLORS[i % len(KM_COLORS)]
+        time, survival, lower, upper = km.curve(i)
+        ax.step(time, survival, where='post', label=groups[i], color=color)
+        ax.fill_between(time, lower, upper, step='post', alpha=0.3, color=color, linewidth=0)
+
+    ax.set_xlabel('Days', fontsize=20)
+    ax.set_ylabel('Probability', fontsize=20)
+    ax.tick_params(labelsize=20)
+    if show_legend:
+        ax.legend(loc='upper right', fontsize=14)
+    if table_ax is not None:
+        ticks = risk_ticks(km.grid[-1])
+        table = at_risk_table(km, groups, ticks)
+        table_ax.set_xlim(ax.get_xlim())
+        table_ax.set_title('Number at risk', fontsize=14, loc='left')
+        table_ax.set_ylim(len(shown) - 0.5, -0.5)
+        table_ax.set_yticks(range(len(shown)))
+        table_ax.set_yticklabels(table.index, fontsize=12)
+        for row, i in enumerate(shown):
+            table_ax.get_yticklabels()[row].set_color(KM_COLORS[i % len(KM_COLORS)])
+            for tick, value in zip(ticks, table.iloc[row]):
+                table_ax.text(tick, row, str(value), ha='center', va='center', fontsize=12)
+        table_ax.set_xticks(ticks)
+        table_ax.set_xticklabels(table.columns, fontsize=12)
+        table_ax.tick_params(axis='both', length=0)
+        for side in table_ax.spines.values():
+            side.set_visible(False)
+        fig.subplots_adjust(hspace=0.25)
+    return fig
+
+
+def figure_png(fig, dpi=600):
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight')
+    return buffer.getvalue()
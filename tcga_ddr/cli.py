@@ -0,0 +1,165 @@
+"""Command-line entry point: ``python -m tcga_ddr run analyses.yaml``, ``screen`` or ``atlas``."""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+from tcga_ddr.analysis import Datasets, normalize_spec, run_analysis
+from tcga_ddr.atlas import ATLAS_DIR, build_atlas
+from tcga_ddr.data import FOOTPRINT_FILE, GENE_LOSS_FILE, SURVIVAL_FILE, source_version
+from tcga_ddr.screen import run_screen
+from tcga_ddr.survival import ENDPOINTS
+
+
+def load_config(path):
+    """Analyses from a JSON or YAML file: a list of specs, or ``{'defaults': {...}, 'analyses': [...]}``."""
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise SystemExit('Reading YAML configs requires PyYAML (pip install pyyaml); use JSON otherwise.')
+            config = yaml.safe_load(f)
+        else:
+            config = json.load(f)
+    if isinstance(config, list):
+        config = {'analyses': config}
+    defaults = config.get('defaults', {})
+    return [{**defaults, **analysis} for analysis in config['analyses']]
+
+
+def _slug(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'analysis'
+
+
+def write_table(table, path, fmt):
+    if fmt == 'parquet':
+        table.to_parquet(f'{path}.parquet', index=False)
+    else:
+        table.to_csv(f'{path}.csv', index=False)
+
+
+def write_km_plots(kms, names, out_dir):
+    # Imported lazily: Matplotlib is only needed when plots are requested
+    from tcga_ddr.charts import figure_png, km_figure
+    for endpoint, km in kms.items():
+        with open(os.path.join(out_dir, f'km_{endpoint}.png'), 'wb') as f:
+            f.write(figure_png(km_figure(km, names), dpi=150))
+
+
+def run(args):
+    specs = load_config(args.config)
+    datasets = Datasets.load(args.gene_loss, args.survival, args.footprint)
+    summary = []
+    for i, raw_spec in enumerate(specs):
+        spec = normalize_spec(raw_spec, datasets)
+        name = _slug(spec['name'] or f'analysis_{i + 1}')
+        out_dir = os.path.join(args.out, name)
+        os.makedirs(out_dir, exist_ok=True)
+
+        start = time.perf_counter()
+        tables, kms = run_analysis(datasets, spec)
+        for table_name, table in tables.items():
+            write_table(table, os.path.join(out_dir, table_name), args.format)
+        if args.plots:
+            write_km_plots(kms, tables['cohorts']['Group'].tolist(), out_dir)
+
+        summary.extend({'Analysis': name, **row} for row in tables['logrank_overall'].to_dict('records'))
+        print(f'[{i + 1}/{len(specs)}] {name}: {time.perf_counter() - start:.2f}s', file=sys.stderr)
+
+    write_table(pd.DataFrame(summary), os.path.join(args.out, 'summary'), args.format)
+
+
+def _versions(args):
+    return {'gene_loss': source_version(args.gene_loss), 'survival': source_version(args.survival),
+            'footprint': source_version(args.footprint)}
+
+
+def screen(args):
+    datasets = Datasets.load(args.gene_loss, args.survival, args.footprint)
+    genes = args.genes or datasets.gene_loss.genes
+    features = datasets.footprint.features if args.features == ['all'] else (args.features or [])
+
+    def progress(done, total):
+        print(f'\rbatches {done}/{total}', end='' if done < total else '\n', file=sys.stderr)
+
+    start = time.perf_counter()
+    survival_table, footprint_table = run_screen(
+        datasets, genes, mode=args.mode, rule=args.rule, cancer_types=args.cancer_types,
+        endpoints=args.endpoints, features=features, rank_by=args.rank_by, min_samples=args.min_samples,
+        batch_size=args.batch_size, checkpoint_dir=os.path.join(args.out, 'checkpoints'), versions=_versions(args),
+        progress=progress,
+    )
+    os.makedirs(args.out, exist_ok=True)
+    write_table(survival_table, os.path.join(args.out, 'ranked'), args.format)
+    if footprint_table is not None:
+        write_table(footprint_table, os.path.join(args.out, 'footprints'), args.format)
+    print(f'{len(survival_table)} candidates in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+
+def atlas(args):
+    datasets = Datasets.load(args.gene_loss, args.survival, args.footprint)
+    versions = _versions(args)
+
+    def progress(done, total):
+        print(f'\rbatches {done}/{total}', end='' if done < total else '\n', file=sys.stderr)
+
+    start = time.perf_counter()
+    genes = args.genes or datasets.gene_loss.genes
+    build_atlas(datasets, args.out, versions, genes=genes, batch_size=args.batch_size, progress=progress)
+    print(f'atlas of {len(genes)} genes written to {args.out} in {time.perf_counter() - start:.1f}s',
+          file=sys.stderr)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m tcga_ddr', description='Headless TCGA-DDR analyses.')
+    parser.add_argument('--gene-loss', default=GENE_LOSS_FILE, help='gene-loss workbook, CSV or Parquet file')
+    parser.add_argument('--survival', default=SURVIVAL_FILE, help='survival workbook, CSV or Parquet file')
+    parser.add_argument('--footprint', default=FOOTPRINT_FILE, help='DDR footprint workbook, CSV or Parquet file')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='run every analysis of a JSON/YAML config')
+    run_parser.add_argument('config', help='JSON or YAML file with the analyses')
+    run_parser.add_argument('--out', default='results', help='output directory (default: results)')
+    run_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    run_parser.add_argument('--plots', action='store_true', help='also write KM curves as PNG')
+    run_parser.set_defaults(handler=run)
+
+    screen_parser = commands.add_parser('screen', help='rank every gene or gene pair by survival difference')
+    screen_parser.add_argument('--mode', choices=['single', 'pairs'], default='pairs')
+    screen_parser.add_argument('--rule', choices=['any', 'all'], default='all',
+                               help='how the two genes of a pair define the deficiency (default: all)')
+    screen_parser.add_argument('--genes', nargs='+', help='genes to screen (default: all)')
+    screen_parser.add_argument('--cancer-types', nargs='+', help='cancer types to include (default: all)')
+    screen_parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    screen_parser.add_argument('--rank-by', choices=ENDPOINTS, help='endpoint used for ranking (default: first)')
+    screen_parser.add_argument('--features', nargs='+', help="footprint features to compare, or 'all'")
+    screen_parser.add_argument('--min-samples', type=int, default=10,
+                               help='smallest cohort size that is tested (default: 10)')
+    screen_parser.add_argument('--batch-size', type=int, default=256)
+    screen_parser.add_argument('--out', default='screen', help='output directory, also holds checkpoints')
+    screen_parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    screen_parser.set_defaults(handler=screen)
+
+    atlas_parser = commands.add_parser('atlas', help='precompute single-gene results for the web pages')
+    atlas_parser.add_argument('--genes', nargs='+', help='genes to include (default: all)')
+    atlas_parser.add_argument('--batch-size', type=int, default=64)
+    atlas_parser.add_argument('--out', default=ATLAS_DIR, help=f'atlas directory (default: {ATLAS_DIR})')
+    atlas_parser.set_defaults(handler=atlas)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'rank_by', None) and args.rank_by not in args.endpoints:
+        parser.error(f"--rank-by {args.rank_by} must be one of --endpoints ({' '.join(args.endpoints)})")
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""Bitset index over the gene-loss table and cohort assignment for deficiency groups."""
+import hashlib
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from tcga_ddr.data import read_only, sample_dictionary
+
+ANY_GENES = 'Any of the selected genes'
+ALL_GENES = 'All of the selected genes'
+
+# Number of packed deficiency, validity and cancer-type masks kept per index
+MASK_CACHE_SIZE = 1024
+
+
+def cohort_names(deficiency_names):
+    # Same order as itertools.product(['d', 'p'], repeat=k): the first deficiency is the
+    # most significant bit and 'd' sorts before 'p'
+    return ['-'.join(f'{status}{name}' for status, name in zip(comb, deficiency_names))
+            for comb in itertools.product(['d', 'p'], repeat=len(deficiency_names))]
+
+
+def cohort_labels(codes, selected_codes):
+    # Position of each row's cohort code in ``selected_codes``, or -1 if not selected
+    lookup = np.full(max(int(codes.max(initial=-1)), max(selected_codes, default=0)) + 2, -1, dtype=np.int64)
+    lookup[np.asarray(selected_codes, dtype=np.int64)] = np.arange(len(selected_codes))
+    return lookup[codes]
+
+
+class GeneLossIndex:
+    """Gene-loss table compiled into packed bit matrices, one row of bits per gene.
+
+    Samples are int32 keys into the process-wide sample dictionary and cancer types
+    are codes into ``cancer_types``. ``loss_bits[g]`` has a bit set for every sample
+    that lost gene ``g`` and ``valid_bits[g]`` for every sample where the gene-loss
+    call is not NaN; all arrays are read-only. Masks
+    derived from them are memoized by their inputs, so resubmitting a definition where
+    one deficiency changed only rebuilds that deficiency's mask.
+    """
+
+    def __init__(self, sample_keys, cancer_types, cancer_codes, genes, loss_bits, valid_bits):
+        read_only(sample_keys, cancer_codes, loss_bits, valid_bits)
+        self.sample_keys = sample_keys
+        self.cancer_types = cancer_types
+        self.cancer_codes = cancer_codes
+        self.genes = genes
+        self.loss_bits = loss_bits
+        self.valid_bits = valid_bits
+        self.n_samples = len(sample_keys)
+        self._gene_pos = {gene: i for i, gene in enumerate(genes)}
+        self._positions = {}
+        self._masks = OrderedDict()
+        self.token = hashlib.sha1(sample_keys.tobytes()).hexdigest()
+
+    @classmethod
+    def from_frame(cls, data):
+        genes = list(data.columns[2:])
+        values = data[genes].to_numpy(dtype=np.float32)
+        valid = ~np.isnan(values)
+        loss = valid & (values != 0)
+        cancer_codes, cancer_types = pd.factorize(data['Cancer type'], use_na_sentinel=False)
+        return cls(
+            sample_keys=sample_dictionary().encode(data['TCGA Sample']),
+            cancer_types=list(cancer_types),
+            cancer_codes=cancer_codes.astype(np.int16),
+            genes=genes,
+            loss_bits=np.packbits(loss.T, axis=1),
+            valid_bits=np.packbits(valid.T, axis=1),
+        )
+
+    @property
+    def sample_ids(self):
+        return sample_dictionary().decode(self.sample_keys)
+
+    @property
+    def nbytes(self):
+        arrays = [self.sample_keys, self.cancer_codes, self.loss_bits, self.valid_bits]
+        return sum(array.nbytes for array in arrays + list(self._masks.values()) + list(self._positions.values()))
+
+    def positions(self, table_key, sample_keys):
+        """Row of each of ``sample_keys`` in this index (-1 if absent), computed once per table_key."""
+        if table_key not in self._positions:
+            size = max(int(self.sample_keys.max(initial=-1)), int(np.max(sample_keys, initial=-1))) + 1
+            lookup = np.full(size, -1, dtype=np.int64)
+            # The first row of a duplicated sample wins
+            keys, first = np.unique(self.sample_keys, return_index=True)
+            lookup[keys] = first
+            positions = np.where(np.asarray(sample_keys) >= 0, lookup[sample_keys], -1)
+            read_only(positions)
+            self._positions[table_key] = positions
+        return self._positions[table_key]
+
+    def _rows(self, genes):
+        return [self._gene_pos[gene] for gene in genes]
+
+    def unpack(self, bits):
+        return np.unpackbits(bits, count=self.n_samples).astype(bool)
+
+    def _memo(self, key, compute):
+        # Small LRU of derived masks; they are never modified in place
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = compute()
+            mask.setflags(write=False)
+            self._masks[key] = mask
+            while len(self._masks) > MASK_CACHE_SIZE:
+                self._masks.popitem(last=False)
+        else:
+            self._masks.move_to_end(key)
+        return mask
+
+    def cancer_type_bits(self, selected_cancer_types):
+        def compute():
+            selected = np.zeros(len(self.cancer_types), dtype=bool)
+            positions = pd.Index(self.cancer_types).get_indexer(list(selected_cancer_types))
+            selected[positions[positions >= 0]] = True
+            return np.packbits(selected[self.cancer_codes])
+        return self._memo(('cancer_types', frozenset(selected_cancer_types)), compute)
+
+    def deficiency_bits(self, genes, mutation_type):
+        def compute():
+            rows = self.loss_bits[self._rows(genes)]
+            if mutation_type == ALL_GENES:
+                return np.bitwise_and.reduce(rows, axis=0)
+            return np.bitwise_or.reduce(rows, axis=0)
+        return self._memo(('deficiency', frozenset(genes), mutation_type), compute)
+
+    def validity_bits(self, genes):
+        return self._memo(('valid', frozenset(genes)),
+                          lambda: np.bitwise_and.reduce(self.valid_bits[self._rows(genes)], axis=0))
+
+    def proficient(self, genes, mutation_type):
+        # Unpacked complement of a deficiency mask: the bit each deficiency adds to a cohort code.
+        # Only the packed bits are memoized, so the memo stays an eighth of the unpacked size
+        return ~self.unpack(self.deficiency_bits(genes, mutation_type))
+
+    def assign(self, deficiencies, selected_cancer_types):
+        """Label every sample with the code of its d/p combination, or -1 if it is excluded.
+
+        Samples are kept when their cancer type is selected and none of the genes used by
+        any deficiency is NaN. A deficiency without genes leaves every cohort empty.
+        """
+        names = cohort_names([deficiency['name'] for deficiency in deficiencies])
+        codes = np.full(self.n_samples, -1, dtype=np.int16)
+        definition = ([dict(deficiency) for deficiency in deficiencies], list(selected_cancer_types))
+        if not all(deficiency['genes'] for deficiency in deficiencies):
+            return CohortSet(self, names, codes, definition=definition)
+
+        all_genes = list(dict.fromkeys(gene for deficiency in deficiencies for gene in deficiency['genes']))
+        member_bits = self.cancer_type_bits(selected_cancer_types) & self.validity_bits(all_genes)
+
+        # One pass over the deficiencies: shift in a 0 for deficient and a 1 for proficient
+        combination = np.zeros(self.n_samples, dtype=np.int16)
+        for deficiency in deficiencies:
+            combination = (combination << 1) | self.proficient(deficiency['genes'], deficiency['mutation_type'])
+        member = self.unpack(member_bits)
+        codes[member] = combination[member]
+        return CohortSet(self, names, codes, definition=definition)
+
+
+class CohortSet:
+    """Partition of the indexed samples into the 2^k cohorts of a deficiency definition.
+
+    ``definition`` is the ``(deficiencies, selected cancer types)`` it was assigned from.
+    """
+
+    def __init__(self, index, names, codes, fingerprints=None, definition=None):
+        self.index = index
+        self.names = names
+        self.codes = codes
+        self._fingerprints = fingerprints
+        self.definition = definition
+
+    def single_gene(self):
+        # The gene of a one-gene, one-deficiency definition, whose cohorts are d<gene> and p<gene>
+        if self.definition is None:
+            return None
+        deficiencies, _ = self.definition
+        if len(deficiencies) == 1 and len(deficiencies[0]['genes']) == 1:
+            return deficiencies[0]['genes'][0]
+        return None
+
+    def sizes(self):
+        return np.bincount(self.codes[self.codes >= 0], minlength=len(self.names))
+
+    def members(self):
+        # Row indices of every cohort, from a single stable sort of the codes
+        order = np.argsort(self.codes, kind='stable')
+        order = order[self.codes[order] >= 0]
+        return np.split(order, np.cumsum(self.sizes())[:-1])
+
+    def fingerprints(self):
+        """One hash per cohort of exactly which samples it holds, independent of its name.
+
+        Results derived from a cohort are keyed by its fingerprint, so they stay valid
+        for as long as its membership does, whatever happens to the other cohorts.
+        """
+        if self._fingerprints is None:
+            self._fingerprints = [
+                hashlib.sha1(self.index.token.encode() + rows.astype(np.int64).tobytes()).hexdigest()
+                for rows in self.members()
+            ]
+        return self._fingerprints
+
+    def codes_for(self, positions):
+        # Cohort code of each row of another table, given its positions in the index
+        return np.where(positions >= 0, self.codes[positions], -1)
+
+    def contingency(self):
+        # Cohort x cancer type sample counts from a single bincount over the combined codes
+        n_types = len(self.index.cancer_types)
+        member = self.codes >= 0
+        keys = self.codes[member].astype(np.int64) * n_types + self.index.cancer_codes[member]
+        counts = np.bincount(keys, minlength=len(self.names) * n_types).reshape(len(self.names), n_types)
+        return pd.DataFrame(counts, index=self.names, columns=self.index.cancer_types)
+
+    def to_dict(self):
+        sample_ids = self.index.sample_ids
+        return {name: set(sample_ids[rows]) for name, rows in zip(self.names, self.members())}
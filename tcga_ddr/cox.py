@@ -0,0 +1,345 @@
+"""Cox proportional-hazards comparisons of cohorts, stratified by cancer type.
+
+Every cohort is compared with a reference cohort in its own model, fitted on the
+samples of the two cohorts (as the pairwise log-rank tests are). Each cancer type has
+its own baseline hazard and ties are handled with Efron's method, as in lifelines.
+
+Without covariates a comparison's partial likelihood depends only on the deaths and
+numbers at risk of the two cohorts at every (cancer type, death time) cell. All
+comparisons are therefore fitted together by one vectorised Newton iteration over
+the cells where each comparison has deaths. With covariates, comparisons are fitted sample by sample in
+batches on the shared process pool. Each fit is warm-started from the unadjusted
+estimate of its cohort and the covariate effects of the previous fit in the batch.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2, norm
+
+from tcga_ddr.parallel import SharedArray, attach, in_process, run_tasks
+
+MAX_ITERATIONS = 50
+# Largest |log hazard ratio| considered estimable; beyond it a cohort without events drifts off
+MAX_COEFFICIENT = 20.0
+# Upper bound on the number of (comparison, cell) entries evaluated at once
+_BATCH_CELLS = 4_000_000
+
+
+def _segment_suffix_sums(values, segment_end):
+    # Sums over rows i..segment_end[i]-1 along the first axis, i.e. suffix sums within each segment
+    suffix = np.cumsum(values[::-1], axis=0)[::-1]
+    suffix = np.concatenate([suffix, np.zeros((1,) + values.shape[1:])])
+    return suffix[:-1] - suffix[segment_end]
+
+
+def _segment_ends(segments):
+    # For sorted segment labels, the position just past the last row of each row's segment
+    boundaries = np.flatnonzero(np.diff(segments)) + 1
+    ends = np.append(boundaries, len(segments))
+    return ends[np.searchsorted(boundaries, np.arange(len(segments)), side='right')]
+
+
+class StratifiedData:
+    """Observations sorted by (stratum, time) with their tie structure, fixed across Newton steps."""
+
+    def __init__(self, time, event, strata, X):
+        order = np.lexsort((time, strata))
+        self.time, self.event, self.strata = time[order], event[order].astype(bool), strata[order]
+        self.X = X[order]
+        self.segment_end = _segment_ends(self.strata)
+        # First row of each (stratum, time) tie: the risk set of a death is every row from there to its stratum's end
+        key = np.stack([self.strata, self.time])
+        new_tie = np.concatenate([[True], (np.diff(key, axis=1) != 0).any(axis=0)])
+        tie_start = np.flatnonzero(new_tie)
+        self.tie_first = tie_start[np.cumsum(new_tie) - 1]
+        deaths = np.flatnonzero(self.event)
+        self.deaths = deaths
+        _, self.death_group, d = np.unique(self.tie_first[deaths], return_inverse=True, return_counts=True)
+        group_start = np.concatenate([[0], np.cumsum(d)[:-1]])
+        # Efron: the l-th of d tied deaths removes l/d of the tied deaths' weight from the risk set
+        self.efron_fraction = (np.arange(len(deaths)) - group_start[self.death_group]) / d[self.death_group]
+        self.risk_row = self.tie_first[deaths]
+
+
+def efron_terms(data, beta):
+    """Log partial likelihood, score and information of a stratified Cox model with Efron ties."""
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        return _efron_terms(data, beta)
+
+
+def _efron_terms(data, beta):
+    X = data.X
+    eta = X @ beta
+    w = np.exp(eta - eta.max(initial=0.0))
+    wX = w[:, None] * X
+    wXX = wX[:, :, None] * X[:, None, :]
+    S0 = _segment_suffix_sums(w, data.segment_end)[data.risk_row]
+    S1 = _segment_suffix_sums(wX, data.segment_end)[data.risk_row]
+    S2 = _segment_suffix_sums(wXX, data.segment_end)[data.risk_row]
+    n_groups = data.death_group.max(initial=-1) + 1
+    deaths = data.deaths
+    D0 = np.bincount(data.death_group, weights=w[deaths], minlength=n_groups)[data.death_group]
+    D1 = np.zeros((n_groups, X.shape[1]))
+    np.add.at(D1, data.death_group, wX[deaths])
+    D2 = np.zeros((n_groups, X.shape[1], X.shape[1]))
+    np.add.at(D2, data.death_group, wXX[deaths])
+    f = data.efron_fraction
+    den = S0 - f * D0
+    num = S1 - f[:, None] * D1[data.death_group]
+    mom = S2 - f[:, None, None] * D2[data.death_group]
+    ratio = num / den[:, None]
+    loglik = eta[deaths].sum() - (np.log(den) + eta.max(initial=0.0)).sum()
+    score = X[deaths].sum(axis=0) - ratio.sum(axis=0)
+    information = (mom / den[:, None, None]).sum(axis=0) - np.einsum('ij,ik->jk', ratio, ratio)
+    return loglik, score, information
+
+
+def fit(time, event, strata, X, beta=None, max_iterations=MAX_ITERATIONS, tolerance=1e-9):
+    """Newton-Raphson fit with step halving; returns ``(beta, covariance, loglik, converged)``."""
+    data = StratifiedData(np.asarray(time, dtype=float), np.asarray(event), np.asarray(strata), np.asarray(X, dtype=float))
+    beta = np.zeros(data.X.shape[1]) if beta is None else np.array(beta, dtype=float)
+    loglik, score, information = efron_terms(data, beta)
+    converged = False
+    for _ in range(max_iterations):
+        try:
+            step = np.linalg.solve(information, score)
+        except np.linalg.LinAlgError:
+            break
+        for _ in range(30):
+            candidate = beta + step
+            new_loglik, new_score, new_information = efron_terms(data, candidate)
+            if np.isfinite(new_loglik) and new_loglik >= loglik - 1e-12:
+                break
+            step = step / 2
+        else:
+            break
+        beta, loglik, score, information = candidate, new_loglik, new_score, new_information
+        if np.abs(step).max(initial=0.0) < tolerance:
+            converged = True
+            break
+        # A coefficient drifting off towards infinity, as happens when a covariate separates the deaths
+        if np.abs(beta).max(initial=0.0) > MAX_COEFFICIENT:
+            break
+    try:
+        covariance = np.linalg.inv(information)
+    except np.linalg.LinAlgError:
+        covariance = np.full(information.shape, np.nan)
+    converged = converged and np.abs(beta).max(initial=0.0) < MAX_COEFFICIENT and (np.diag(covariance) > 0).all()
+    return beta, covariance, loglik, converged
+
+
+def _cells(slots, strata, event, labels, n_slots, n_groups):
+    """Deaths and numbers at risk of every group at each (stratum, death time) cell."""
+    keys = strata.astype(np.int64) * n_slots + slots
+    member = labels >= 0
+    cell_keys = np.unique(keys[member & event])
+    cell_strata = cell_keys // n_slots
+    # Rows are at risk at every cell of their stratum up to their own time
+    last = np.searchsorted(cell_keys, keys, side='right') - 1
+    at_cells = member & (last >= 0)
+    at_cells[at_cells] = cell_strata[last[at_cells]] == strata[at_cells]
+    n_cells = len(cell_keys)
+    removed = np.bincount(labels[at_cells] * n_cells + last[at_cells], minlength=n_groups * n_cells)
+    removed = removed.reshape(n_groups, n_cells).astype(float)
+    cell_end = _segment_ends(cell_strata)
+    at_risk = _segment_suffix_sums(removed.T, cell_end).T
+    is_death = member & event
+    death_cell = np.searchsorted(cell_keys, keys[is_death])
+    deaths = np.bincount(labels[is_death] * n_cells + death_cell, minlength=n_groups * n_cells)
+    return deaths.reshape(n_groups, n_cells).astype(float), at_risk
+
+
+def _comparison_cells(deaths, at_risk, reference, groups):
+    """Flat (comparison, cell) entries at which a comparison has deaths.
+
+    Only cells where the cohort or the reference has a death enter a comparison's
+    likelihood, so each one gets every death cell of the reference plus its own. Returns
+    the entry's comparison (position in ``groups``) and the cohort's and reference's
+    deaths and numbers at risk there.
+    """
+    ref_cells = np.flatnonzero(deaths[reference])
+    own = deaths[groups]
+    own[:, ref_cells] = 0
+    own_rows, own_cells = np.nonzero(own)
+    rows = np.concatenate([np.repeat(np.arange(len(groups)), len(ref_cells)), own_rows])
+    cells = np.concatenate([np.tile(ref_cells, len(groups)), own_cells])
+    cohort = np.asarray(groups)[rows]
+    return (rows, deaths[cohort, cells], at_risk[cohort, cells],
+            deaths[reference, cells], at_risk[reference, cells])
+
+
+def fit_counts(rows, deaths, at_risk, deaths_ref, at_risk_ref, n_rows, beta=None,
+               max_iterations=MAX_ITERATIONS, tolerance=1e-9):
+    """Efron fits of a cohort indicator for many comparisons at once, from counts at death cells.
+
+    Every argument but ``n_rows`` and ``beta`` is a flat array over (comparison, cell)
+    entries, as built by ``_comparison_cells``. Returns ``(beta, variance, converged)``
+    with one value per comparison.
+    """
+    beta = np.zeros(n_rows) if beta is None else np.array(beta, dtype=float)
+    total = deaths + deaths_ref
+    depth = int(total.max(initial=0))
+    observed = np.bincount(rows, weights=deaths, minlength=n_rows)
+
+    def row_sums(values):
+        return np.bincount(rows, weights=values, minlength=n_rows)
+
+    def terms(b):
+        e = np.exp(b)[rows]
+        s0, d0 = at_risk_ref + e * at_risk, deaths_ref + e * deaths
+        s1, d1 = e * at_risk, e * deaths
+        log_den = np.zeros(len(rows))
+        ratio_sum = np.zeros(len(rows))
+        variance_sum = np.zeros(len(rows))
+        # The l-th of the tied deaths at a cell, for every entry with more than l deaths
+        for l in range(depth):
+            active = np.flatnonzero(l < total)
+            f = l / total[active]
+            den = s0[active] - f * d0[active]
+            ratio = (s1[active] - f * d1[active]) / den
+            log_den[active] += np.log(den)
+            ratio_sum[active] += ratio
+            variance_sum[active] += ratio - ratio * ratio
+        return b * observed - row_sums(log_den), observed - row_sums(ratio_sum), row_sums(variance_sum)
+
+    loglik, score, information = terms(beta)
+    # Fits stop once converged, or once drifting off towards an infinite coefficient
+    done = np.zeros(n_rows, dtype=bool)
+    converged = np.zeros(n_rows, dtype=bool)
+    for _ in range(max_iterations):
+        done |= converged | (np.abs(beta) > MAX_COEFFICIENT) | ~(information > 0)
+        if done.all():
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            step = np.where(done, 0.0, np.clip(score / information, -5.0, 5.0))
+        for _ in range(30):
+            new = terms(beta + step)
+            worse = ~(new[0] >= loglik - 1e-12)
+            if not worse.any():
+                break
+            step = np.where(worse, step / 2, step)
+        beta = beta + step
+        loglik, score, information = new
+        converged |= ~done & (np.abs(step) < tolerance)
+    with np.errstate(divide='ignore'):
+        variance = 1.0 / information
+    return beta, variance, converged & (np.abs(beta) < MAX_COEFFICIENT) & (information > 0)
+
+
+def _adjusted_task(specs, scope, strata, center, scale, reference_rows, batch, warm_start):
+    """Covariate-adjusted fits of a batch of cohorts against the reference, each warm-started.
+
+    ``specs`` holds the time, the event and one covariate column each. The covariates are
+    standardised with ``center`` and ``scale`` for the solver. ``batch`` holds the
+    observation rows of each cohort; ``warm_start`` their unadjusted coefficients. The
+    covariate effects start from those of the previous fit.
+    """
+    time, event, *columns = (attach(spec, scope) for spec in specs)
+    results = []
+    previous = np.zeros(len(columns))
+    for rows, beta_group in zip(batch, warm_start):
+        keep = np.concatenate([rows, reference_rows])
+        covariates = (np.column_stack([column[keep] for column in columns]) - center) / scale
+        X = np.column_stack([np.arange(len(keep)) < len(rows), covariates])
+        start = np.concatenate([[beta_group if np.isfinite(beta_group) else 0.0], previous])
+        beta, covariance, _, converged = fit(time[keep], event[keep].astype(bool), strata[keep], X, beta=start)
+        if converged:
+            previous = beta[1:]
+        results.append((beta, np.sqrt(np.abs(np.diag(covariance))), converged))
+    return results
+
+
+def compare_cohorts(time, event, slots, n_slots, strata, labels, n_groups, reference, covariates=None,
+                    covariate_names=(), alpha=0.05, max_workers=None, batch_size=32, shared=None):
+    """Hazard ratio, CI and Wald p-value of every non-empty group against ``reference``.
+
+    ``labels`` gives each observation's group (-1 if unused), ``slots`` its position on
+    the endpoint's time grid and ``strata`` its cancer type code. ``covariates`` is an
+    optional (observations x covariates) matrix; observations with a NaN covariate are
+    left out of the adjusted fits. Returns one row per group with the covariate effects
+    in extra columns.
+
+    When the adjusted fits are spread over workers, they read ``time``, ``event`` and the
+    covariates from shared memory. ``shared`` may map 'time', 'event' and each covariate
+    name to a long-lived SharedArray of that column; otherwise copies are shared for
+    the duration of the call.
+    """
+    event = np.asarray(event).astype(bool)
+    labels = np.asarray(labels)
+    adjusted = covariates is not None and len(covariate_names) > 0
+    if adjusted:
+        covariates = np.asarray(covariates, dtype=float)
+        # Only observations with every covariate enter the adjusted fits
+        labels = np.where(np.isnan(covariates).any(axis=1), -1, labels)
+    n = np.bincount(labels[labels >= 0], minlength=n_groups)
+    events = np.bincount(labels[(labels >= 0) & event], minlength=n_groups)
+    groups = [g for g in range(n_groups) if g != reference and n[g]]
+    beta = np.full(n_groups, np.nan)
+    se = np.full(n_groups, np.nan)
+    converged = np.zeros(n_groups, dtype=bool)
+    extra = {}
+    if n[reference] == 0 or not groups:
+        groups = []
+    else:
+        deaths, at_risk = _cells(slots, strata, event, labels, n_slots, n_groups)
+        # Comparisons are fitted together, in batches of bounded size
+        rows_per_batch = max(1, _BATCH_CELLS // (np.count_nonzero(deaths[reference]) + 1))
+        for start in range(0, len(groups), rows_per_batch):
+            batch = groups[start:start + rows_per_batch]
+            b, v, ok = fit_counts(*_comparison_cells(deaths, at_risk, reference, batch), n_rows=len(batch))
+            beta[batch], se[batch], converged[batch] = b, np.sqrt(v), ok
+
+    # A cohort whose unadjusted coefficient is infinite (no events, say) stays so with covariates
+    fitted = [g for g in groups if converged[g]]
+    if adjusted and fitted:
+        # Standardised for the solver; the coefficients are scaled back below
+        center = np.nanmean(covariates[labels >= 0], axis=0)
+        scale = np.nanstd(covariates[labels >= 0], axis=0)
+        scale[~(scale > 0)] = 1.0
+        arrays = [time, event] + [covariates[:, j] for j in range(covariates.shape[1])]
+        order = np.argsort(labels, kind='stable')
+        bounds = np.searchsorted(labels[order], np.arange(n_groups + 1))
+        members = [order[bounds[g]:bounds[g + 1]] for g in range(n_groups)]
+        batches = [fitted[i:i + batch_size] for i in range(0, len(fitted), batch_size)]
+        # Fits run in this process use the arrays as they are
+        owned = []
+        if in_process(len(batches), max_workers):
+            specs = arrays
+        elif shared is not None:
+            specs = [shared[name].spec for name in ['time', 'event'] + list(covariate_names)]
+        else:
+            owned = [SharedArray(array) for array in arrays]
+            specs = [array.spec for array in owned]
+        scope = os.urandom(8).hex()
+        try:
+            tasks = [(specs, scope, np.asarray(strata), center, scale,
+                      members[reference], [members[g] for g in batch], beta[batch]) for batch in batches]
+            results = [result for batch_results in run_tasks(_adjusted_task, tasks, max_workers=max_workers)
+                       for result in batch_results]
+        finally:
+            for array in owned:
+                array.release()
+        covariate_beta = np.full((n_groups, len(covariate_names)), np.nan)
+        covariate_se = np.full((n_groups, len(covariate_names)), np.nan)
+        for group, (b, s, ok) in zip(fitted, results):
+            beta[group], se[group], converged[group] = b[0], s[0], ok
+            covariate_beta[group], covariate_se[group] = b[1:] / scale, s[1:] / scale
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            for j, name in enumerate(covariate_names):
+                extra[f'{name} HR'] = np.exp(covariate_beta[:, j])
+                extra[f'{name} p-value'] = chi2.sf((covariate_beta[:, j] / covariate_se[:, j]) ** 2, 1)
+
+    z = norm.ppf(1 - alpha / 2)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        table = pd.DataFrame({
+            'group': np.arange(n_groups), 'n': n, 'events': events,
+            'coef': beta, 'se': se, 'HR': np.exp(beta),
+            'lower': np.exp(beta - z * se), 'upper': np.exp(beta + z * se),
+            'p-value': chi2.sf((beta / se) ** 2, 1), 'converged': converged, **extra,
+        })
+    table = table[table['group'].isin(groups)].reset_index(drop=True)
+    # Estimates of fits that did not converge (e.g. a cohort without events) are not reported
+    estimates = [column for column in table.columns if column not in ('group', 'n', 'events', 'converged')]
+    table.loc[~table['converged'], estimates] = np.nan
+    return table
@@ -0,0 +1,217 @@
+"""Loading of the bundled Excel workbooks through a columnar on-disk cache.
+
+Each workbook sheet is converted once into an uncompressed Arrow IPC (Feather v2)
+file next to a small JSON manifest. Later loads memory-map the Arrow file instead
+of parsing the workbook XML again, so a fresh server process starts in milliseconds.
+
+The data files can be replaced by CSV or Parquet tables of the same layout through
+the ``TCGA_DDR_*_FILE`` environment variables; large ones are streamed by ``ingest``.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+GENE_LOSS_FILE = os.environ.get('TCGA_DDR_GENE_LOSS_FILE', 'DDR factors gene loss.xlsx')
+SURVIVAL_FILE = os.environ.get('TCGA_DDR_SURVIVAL_FILE', 'Survival_simple.xlsx')
+FOOTPRINT_FILE = os.environ.get('TCGA_DDR_FOOTPRINT_FILE', 'DDR footprint.xlsx')
+# Feature descriptions for a footprint table that is not a workbook (where they are on Sheet2)
+FOOTPRINT_DESCRIPTIONS_FILE = os.environ.get('TCGA_DDR_FOOTPRINT_DESCRIPTIONS_FILE')
+
+CACHE_DIR = os.environ.get('TCGA_DDR_CACHE_DIR', '.ddr_cache')
+
+_MANIFEST_VERSION = 1
+
+
+def source_version(path):
+    # Cheap identity of a source file, used as part of in-memory cache keys
+    stat = os.stat(path)
+    return f'{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def _file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _cache_paths(path, cache_dir):
+    stem = os.path.splitext(os.path.basename(path))[0].replace(' ', '_')
+    return os.path.join(cache_dir, stem), os.path.join(cache_dir, f'{stem}.manifest.json')
+
+
+def _sheet_file(prefix, sheet):
+    return f'{prefix}.{sheet}.arrow'
+
+
+def _read_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_atomic(path, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _write_manifest(manifest_path, manifest):
+    def write(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+    _write_atomic(manifest_path, write)
+
+
+def _is_fresh(path, prefix, manifest_path, manifest):
+    if manifest is None or manifest.get('version') != _MANIFEST_VERSION:
+        return False
+    if not all(os.path.exists(_sheet_file(prefix, sheet)) for sheet in manifest['sheets']):
+        return False
+    stat = os.stat(path)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # The file was touched (e.g. re-checked out); only rebuild if the content changed
+    if manifest['size'] == stat.st_size and manifest['sha256'] == _file_hash(path):
+        manifest['mtime_ns'] = stat.st_mtime_ns
+        _write_manifest(manifest_path, manifest)
+        return True
+    return False
+
+
+def _to_arrow(df):
+    # Excel columns of mixed content come back as object dtype; store them as strings
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.columns = [str(col) for col in df.columns]
+    return pa.Table.from_pandas(df, preserve_index=False)
+
+
+def _convert(path, prefix, manifest_path):
+    sheets = pd.read_excel(path, sheet_name=None)
+    for sheet, df in sheets.items():
+        table = _to_arrow(df)
+        _write_atomic(_sheet_file(prefix, sheet),
+                      lambda tmp_path: feather.write_feather(table, tmp_path, compression='uncompressed'))
+    stat = os.stat(path)
+    manifest = {
+        'version': _MANIFEST_VERSION,
+        'source': os.path.basename(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': _file_hash(path),
+        'sheets': list(sheets),
+    }
+    _write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def _read_sheet(prefix, sheet):
+    with pa.memory_map(_sheet_file(prefix, sheet), 'r') as source:
+        table = pa.ipc.open_file(source).read_all()
+    return table.to_pandas()
+
+
+def read_workbook(path, sheet_name=0, cache_dir=CACHE_DIR):
+    """Drop-in replacement for ``pd.read_excel(path, sheet_name=...)`` backed by the Arrow cache.
+
+    ``sheet_name`` may be a sheet position, a sheet name, or None for a dict of all sheets.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix, manifest_path = _cache_paths(path, cache_dir)
+    manifest = _read_manifest(manifest_path)
+    if not _is_fresh(path, prefix, manifest_path, manifest):
+        manifest = _convert(path, prefix, manifest_path)
+
+    sheets = manifest['sheets']
+    if sheet_name is None:
+        return {sheet: _read_sheet(prefix, sheet) for sheet in sheets}
+    if isinstance(sheet_name, int):
+        sheet_name = sheets[sheet_name]
+    if sheet_name not in sheets:
+        raise ValueError(f"Worksheet named '{sheet_name}' not found in {path}")
+    return _read_sheet(prefix, sheet_name)
+
+
+def table_format(path):
+    """'csv', 'parquet' or 'excel', from the file name."""
+    name = path.lower()
+    if name.endswith(('.parquet', '.pq')):
+        return 'parquet'
+    if name.endswith(('.csv', '.tsv', '.txt', '.csv.gz', '.tsv.gz', '.txt.gz')):
+        return 'csv'
+    return 'excel'
+
+
+def csv_separator(path):
+    return '\t' if '.tsv' in path.lower() else ','
+
+
+def read_table(path, sheet_name=0):
+    """Whole table from a workbook (through the Arrow cache), CSV or Parquet file."""
+    kind = table_format(path)
+    if kind == 'parquet':
+        return pd.read_parquet(path)
+    if kind == 'csv':
+        return pd.read_csv(path, sep=csv_separator(path))
+    return read_workbook(path, sheet_name=sheet_name)
+
+
+class SampleDictionary:
+    """Append-only, process-wide dictionary from sample IDs to int32 keys.
+
+    Every loaded table stores its samples as keys into this one dictionary, so each ID
+    string is held once per process and linking two tables is an integer lookup.
+    """
+
+    def __init__(self):
+        self._ids = pd.Index([], dtype=object)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    def encode(self, sample_ids):
+        ids = pd.Index(np.asarray(sample_ids, dtype=object))
+        with self._lock:
+            keys = self._ids.get_indexer(ids)
+            new = ids[keys < 0].unique()
+            if len(new):
+                self._ids = self._ids.append(pd.Index(new, dtype=object))
+                keys = self._ids.get_indexer(ids)
+        return keys.astype(np.int32)
+
+    def lookup(self, sample_ids):
+        # Keys of known IDs, -1 for the rest; unlike encode, nothing is added
+        return self._ids.get_indexer(pd.Index(np.asarray(sample_ids, dtype=object))).astype(np.int32)
+
+    def decode(self, keys):
+        return self._ids.to_numpy()[keys]
+
+    @property
+    def nbytes(self):
+        return int(self._ids.memory_usage(deep=True))
+
+
+_samples = SampleDictionary()
+
+
+def sample_dictionary():
+    return _samples
+
+
+def read_only(*arrays):
+    # Loaded tables are shared by every session; freezing their arrays keeps them that way
+    for array in arrays:
+        array.setflags(write=False)
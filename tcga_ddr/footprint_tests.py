@@ -0,0 +1,132 @@
+"""Significance of footprint differences between cohorts, overall and within cancer types.
+
+Rank tests (Mann-Whitney U for two cohorts, Kruskal-Wallis for more) are optionally
+complemented by permutation tests on the between-cohort sum of squares. Work is split
+into (feature, permutation chunk) tasks that read the footprint matrix from shared memory.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import kruskal, mannwhitneyu
+
+from tcga_ddr.multitest import adjust_pvalues
+from tcga_ddr.parallel import MAX_WORKERS, SharedArray, attach, in_process, run_tasks
+
+PERMUTATION_BATCH = 256
+
+
+def _between_groups(x, groups, sizes, n_groups):
+    # Sum of squared group sums over group sizes: the between-group sum of squares up
+    # to constants that do not change under permutation
+    sums = np.bincount(groups, weights=x, minlength=n_groups)
+    return (sums * sums / sizes).sum()
+
+
+def _permutation_exceedances(x, groups, sizes, n_permutations, rng):
+    n_groups = len(sizes)
+    observed = _between_groups(x, groups, sizes, n_groups)
+    exceed = 0
+    for start in range(0, n_permutations, PERMUTATION_BATCH):
+        batch = min(PERMUTATION_BATCH, n_permutations - start)
+        shuffled = rng.permuted(np.broadcast_to(groups, (batch, len(groups))), axis=1)
+        keys = shuffled + n_groups * np.arange(batch)[:, None]
+        sums = np.bincount(keys.ravel(), weights=np.tile(x, batch), minlength=batch * n_groups).reshape(batch, n_groups)
+        statistics = (sums * sums / sizes).sum(axis=1)
+        exceed += int((statistics >= observed * (1 - 1e-12)).sum())
+    return exceed
+
+
+def _feature_task(values_spec, scope, labels, cancer_codes, column, strata, n_permutations, seed, rank_tests):
+    """Rank tests and/or permutation exceedance counts of one feature for every stratum."""
+    values = attach(values_spec, scope)[:, column].astype(float)
+    rng = np.random.default_rng(seed)
+    results = []
+    for stratum in strata:
+        mask = (labels >= 0) & ~np.isnan(values)
+        if stratum is not None:
+            mask &= cancer_codes == stratum
+        x = values[mask]
+        present, groups = np.unique(labels[mask], return_inverse=True)
+        result = {'stratum': stratum, 'groups': len(present)}
+        if len(present) >= 2:
+            sizes = np.bincount(groups).astype(float)
+            if rank_tests:
+                samples = [x[groups == g] for g in range(len(present))]
+                if len(present) == 2:
+                    result['test'] = 'Mann-Whitney U'
+                    result['statistic'], result['p'] = mannwhitneyu(*samples, alternative='two-sided')
+                else:
+                    result['test'] = 'Kruskal-Wallis'
+                    try:
+                        result['statistic'], result['p'] = kruskal(*samples)
+                    except ValueError:  # all values identical
+                        result['statistic'], result['p'] = np.nan, np.nan
+            if n_permutations:
+                result['exceed'] = _permutation_exceedances(x, groups, sizes, n_permutations, rng)
+        results.append(result)
+    return results
+
+
+def feature_tests(index, labels, group_names, features, n_permutations=0, by_cancer_type=True,
+                  seed=0, max_workers=None, values=None):
+    """Table of per-feature tests between the labelled groups, with BH-corrected q-values.
+
+    Rows are one feature in one stratum ('All' or a cancer type) with at least two groups
+    that have data. ``values`` may be a SharedArray of the footprint matrix to reuse.
+    """
+    workers = MAX_WORKERS if max_workers is None else max_workers
+    strata = [None] + (list(range(len(index.cancer_types))) if by_cancer_type else [])
+    columns = [index.feature_pos[feature] for feature in features]
+
+    # Permutations are split in chunks so a few features still use every worker
+    n_chunks = max(1, min(workers, n_permutations // 1000)) if n_permutations else 1
+    chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(n_permutations), n_chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(len(columns) * n_chunks)
+    # Tasks run in this process read the matrix directly
+    local = in_process(len(columns) * n_chunks, workers)
+    shared = None if local else (values if values is not None else SharedArray(index.values))
+    values_spec = index.values if local else shared.spec
+    scope = os.urandom(8).hex()
+    tasks = []
+    for f, column in enumerate(columns):
+        for c, size in enumerate(chunk_sizes):
+            tasks.append((values_spec, scope, labels, index.cancer_codes, column, strata, size,
+                          seeds[f * n_chunks + c], c == 0))
+    try:
+        outputs = run_tasks(_feature_task, tasks, max_workers=workers)
+    finally:
+        if shared is not None and values is None:
+            shared.release()
+
+    rows = []
+    for f, feature in enumerate(features):
+        chunks = outputs[f * n_chunks:(f + 1) * n_chunks]
+        for s, stratum in enumerate(strata):
+            result = chunks[0][s]
+            if result['groups'] < 2:
+                continue
+            row = {
+                'Feature': feature,
+                'Cancer type': 'All' if stratum is None else index.cancer_types[stratum],
+                'Test': result['test'],
+                'Statistic': result['statistic'],
+                'p-value': result['p'],
+            }
+            if n_permutations:
+                exceed = sum(chunk[s]['exceed'] for chunk in chunks)
+                row['Permutation p-value'] = (exceed + 1) / (n_permutations + 1)
+            rows.append(row)
+
+    table = pd.DataFrame(rows)
+    if table.empty:
+        return table
+    # Benjamini-Hochberg within the pooled tests and within the per-cancer-type tests
+    pooled = (table['Cancer type'] == 'All').to_numpy()
+    for column, q_column in [('p-value', 'q-value'), ('Permutation p-value', 'Permutation q-value')]:
+        if column in table:
+            q = np.empty(len(table))
+            for family in (pooled, ~pooled):
+                q[family] = adjust_pvalues(table.loc[family, column].to_numpy(), 'fdr_bh')
+            table[q_column] = q
+    return table
@@ -0,0 +1,158 @@
+"""Aggregation of DDR footprint features over cohorts and cancer types."""
+import numpy as np
+import pandas as pd
+
+from tcga_ddr.data import read_only, sample_dictionary
+
+# Rows converted to float64 sufficient statistics at a time when computing the totals
+_CHUNK_ROWS = 65536
+
+
+def prepare_footprints(sheet):
+    # Feature names are displayed with spaces instead of underscores
+    data = sheet.copy()
+    data.columns = data.columns.str.replace('_', ' ')
+    return data
+
+
+def sufficient_stats(values):
+    # Validity, value and squared value of every cell, stacked on a new middle axis
+    values = np.asarray(values, dtype=float)
+    valid = ~np.isnan(values)
+    values = np.where(valid, values, 0.0)
+    return np.stack([valid.astype(float), values, values * values], axis=1)
+
+
+class FootprintIndex:
+    """Compact footprint table with per-cancer-type sufficient statistics.
+
+    The first three columns of the sheet are sample, cancer type and subtype; every
+    other column is a feature. Samples are int32 keys into the process-wide sample
+    dictionary, cancer types are codes and feature values are float32, with NaN where
+    missing. The count, sum and sum of squares of any set of rows is computed from them
+    in float64. Totals per (cancer type, feature) are kept as well, which lets the
+    largest cohort be obtained by subtraction. ``values`` may be a read-only memory
+    map, in which case ``totals`` should be passed in rather than recomputed.
+    """
+
+    def __init__(self, sample_keys, cancer_types, cancer_codes, features, values, totals=None):
+        self.sample_keys = sample_keys
+        self.features = features
+        self.feature_pos = {feature: i for i, feature in enumerate(self.features)}
+        self.cancer_types = cancer_types
+        self.cancer_codes = cancer_codes
+        self.values = values
+        if totals is None:
+            # (cancer type, statistic, feature) with statistic = count, sum, sum of squares
+            totals = np.zeros((len(self.cancer_types), 3, len(self.features)))
+            for start in range(0, len(self.values), _CHUNK_ROWS):
+                chunk = slice(start, start + _CHUNK_ROWS)
+                np.add.at(totals, self.cancer_codes[chunk], sufficient_stats(self.values[chunk]))
+        self.totals = totals
+        read_only(self.sample_keys, self.cancer_codes, self.values, self.totals)
+
+    @classmethod
+    def from_frame(cls, data):
+        features = data.columns[3:].tolist()
+        cancer_codes, cancer_types = pd.factorize(data['Cancer type'], use_na_sentinel=False)
+        return cls(
+            sample_keys=sample_dictionary().encode(data['TCGA Sample']),
+            cancer_types=list(cancer_types),
+            cancer_codes=cancer_codes.astype(np.int16),
+            features=features,
+            values=data[features].to_numpy(dtype=np.float32),
+        )
+
+    @property
+    def sample_ids(self):
+        return sample_dictionary().decode(self.sample_keys)
+
+    @property
+    def nbytes(self):
+        return self.sample_keys.nbytes + self.cancer_codes.nbytes + self.values.nbytes + self.totals.nbytes
+
+    def rows_for(self, sample_ids):
+        # Row of each sample in the footprint table, or -1 if it has no footprint data
+        return pd.Index(self.sample_keys).get_indexer(sample_dictionary().lookup(sample_ids))
+
+    def sufficient_stats(self, rows, columns):
+        """(rows, statistic, feature) float64 array of validity, value and squared value."""
+        return sufficient_stats(self.values[rows][:, columns])
+
+    def aggregate(self, labels, n_groups, features=None):
+        """Count, sum and sum of squares of every (group, cancer type, feature) cell.
+
+        Only the rows outside the largest group are visited, ``_CHUNK_ROWS`` at a time so
+        a memory-mapped matrix is never read in full; that group's cells are the
+        cancer-type totals minus everything else.
+        """
+        features = self.features if features is None else list(features)
+        columns = [self.feature_pos[feature] for feature in features]
+        n_types = len(self.cancer_types)
+        n_features = len(columns)
+        stats = np.zeros((n_groups + 1, n_types, 3, n_features))
+        if n_groups:
+            sizes = np.bincount(labels[labels >= 0], minlength=n_groups)
+            largest = int(np.argmax(sizes))
+            # Unselected rows go to an extra bucket so the subtraction stays exact
+            buckets = np.where(labels >= 0, labels, n_groups)
+            rest = np.flatnonzero(buckets != largest)
+            # Count, sum and sum of squares of every flat (group, cancer type, feature) cell
+            n_cells = (n_groups + 1) * n_types * n_features
+            flat = np.zeros((3, n_cells))
+            for start in range(0, len(rest), _CHUNK_ROWS):
+                rows = rest[start:start + _CHUNK_ROWS]
+                values = np.asarray(self.values[rows][:, columns], dtype=float)
+                valid = ~np.isnan(values)
+                values = np.where(valid, values, 0.0)
+                cells = ((buckets[rows].astype(np.int64) * n_types + self.cancer_codes[rows])[:, None] * n_features
+                         + np.arange(n_features)).ravel()
+                for s, weights in enumerate([valid, values, values * values]):
+                    flat[s] += np.bincount(cells, weights=weights.ravel(), minlength=n_cells)
+            stats = flat.reshape(3, n_groups + 1, n_types, n_features).transpose(1, 2, 0, 3).copy()
+            stats[largest] = self.totals[:, :, columns] - stats.sum(axis=0)
+        return FootprintCube(features, stats[:n_groups])
+
+
+class FootprintCube:
+    """Sufficient statistics over (group, cancer type, feature); every chart is a slice of it."""
+
+    def __init__(self, features, stats):
+        self.features = features
+        self.feature_pos = {feature: i for i, feature in enumerate(features)}
+        self.stats = stats
+        self.counts = stats[:, :, 0]
+        self.sums = stats[:, :, 1]
+        self.sumsq = stats[:, :, 2]
+
+    def group_counts(self, feature):
+        return self.counts[:, :, self.feature_pos[feature]].sum(axis=1)
+
+    def group_means(self, feature):
+        return self.group_stats(feature)['mean']
+
+    def group_stats(self, feature):
+        """Count, mean, sample SD and SEM of every group, pooled over cancer types."""
+        f = self.feature_pos[feature]
+        return _summary(self.counts[:, :, f].sum(axis=1), self.sums[:, :, f].sum(axis=1),
+                        self.sumsq[:, :, f].sum(axis=1))
+
+    def cancer_type_stats(self, feature, group, cancer_types):
+        """Count, mean, SD and SEM of one group per cancer type with data, sorted by cancer type."""
+        f = self.feature_pos[feature]
+        counts = self.counts[group, :, f]
+        present = [i for i in np.flatnonzero(counts > 0) if not pd.isna(cancer_types[i])]
+        stats = _summary(counts[present], self.sums[group, present, f], self.sumsq[group, present, f])
+        return pd.DataFrame(stats, index=[cancer_types[i] for i in present]).sort_index()
+
+    def cancer_type_means(self, feature, group, cancer_types):
+        return self.cancer_type_stats(feature, group, cancer_types)['mean']
+
+
+def _summary(count, total, total_sq):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = np.where(count > 0, total / count, np.nan)
+        variance = np.maximum(total_sq - count * mean * mean, 0.0) / (count - 1)
+        sd = np.where(count > 1, np.sqrt(variance), np.nan)
+        sem = sd / np.sqrt(count)
+    return {'n': count, 'mean': mean, 'sd': sd, 'sem': sem}
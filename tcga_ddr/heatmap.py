@@ -0,0 +1,65 @@
+"""Clustered heatmap of footprint means over cohorts and features.
+
+The means come from one ``FootprintCube`` over every selected feature. Each feature is
+z-scored across the rows, so features on different scales share one colour range.
+Rows and columns are ordered by average-linkage hierarchical clustering of the
+z-scores, which puts similar cohorts and co-varying features next to each other.
+"""
+import numpy as np
+import pandas as pd
+from scipy.cluster import hierarchy
+
+POOLED = 'All cancer types'
+BY_CANCER_TYPE = 'One row per cancer type'
+
+
+def footprint_means(cube, groups, cancer_types, view=POOLED):
+    """(row, feature) means of the groups in ``cube``, NaN where a cell has no data.
+
+    ``view`` pools all cancer types, gives every group one row per cancer type with data
+    (``BY_CANCER_TYPE``), or names a single cancer type.
+    """
+    features = list(cube.features)
+    if view == BY_CANCER_TYPE:
+        rows = [(g, t) for g in range(len(groups)) for t in range(len(cancer_types))
+                if not pd.isna(cancer_types[t]) and cube.counts[g, t].any()]
+        counts = np.array([cube.counts[g, t] for g, t in rows]).reshape(len(rows), len(features))
+        sums = np.array([cube.sums[g, t] for g, t in rows]).reshape(len(rows), len(features))
+        index = [f"{groups[g]} · {cancer_types[t]}" for g, t in rows]
+    else:
+        types = slice(None) if view == POOLED else [i for i, ct in enumerate(cancer_types) if ct == view]
+        counts = cube.counts[:, types].sum(axis=1)
+        sums = cube.sums[:, types].sum(axis=1)
+        index = list(groups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+    return pd.DataFrame(means, index=index, columns=features).dropna(how='all')
+
+
+def zscore(means):
+    """Each column centred on its mean over the rows and scaled by its SD; constant columns are 0."""
+    values = means.to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    filled = np.where(valid, values, 0.0)
+    count = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centre = filled.sum(axis=0) / count
+        spread = np.sqrt((np.where(valid, values - centre, 0.0) ** 2).sum(axis=0) / count)
+        z = np.where(spread > 0, (values - centre) / spread, 0.0)
+    return pd.DataFrame(np.where(np.isnan(values), np.nan, z), index=means.index, columns=means.columns)
+
+
+def leaf_order(matrix):
+    """Order of the rows of ``matrix`` along the leaves of their clustering tree; NaN counts as 0."""
+    if len(matrix) < 3:
+        return np.arange(len(matrix))
+    tree = hierarchy.linkage(np.nan_to_num(matrix), method='average', metric='euclidean', optimal_ordering=True)
+    return hierarchy.leaves_list(tree)
+
+
+def clustered_heatmap(means):
+    """Z-scores and means of ``means`` with rows and columns in clustering order."""
+    z = zscore(means)
+    values = z.to_numpy()
+    rows, columns = leaf_order(values), leaf_order(values.T)
+    return z.iloc[rows, columns], means.iloc[rows, columns]
@@ -0,0 +1,241 @@
+"""Streaming ingestion of gene-loss and footprint tables too large to load at once.
+
+CSV and Parquet tables are read in chunks of rows and compiled straight into the form
+the indexes keep. Gene-loss bits and the float32 footprint matrix are written to
+memory-mapped files in the cache directory, and the footprint totals per cancer type
+are summed chunk by chunk. Only the per-sample keys and codes are held in memory; the
+operating system pages the matrices in as cohorts are assigned and aggregated. The
+compiled files are reused until the source file changes.
+
+Workbooks are small and still go through ``read_workbook``.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from tcga_ddr.cohorts import GeneLossIndex
+from tcga_ddr.data import (CACHE_DIR, _read_manifest, _write_atomic, _write_manifest, csv_separator,
+                           read_workbook, sample_dictionary, table_format)
+from tcga_ddr.footprints import FootprintIndex, prepare_footprints, sufficient_stats
+
+# Cells (rows x columns) read per chunk, which bounds the memory used while compiling
+CHUNK_CELLS = int(os.environ.get('TCGA_DDR_CHUNK_CELLS', 1 << 23))
+
+_COMPILED_VERSION = 1
+
+
+def table_columns(path):
+    if table_format(path) == 'parquet':
+        return pq.ParquetFile(path).schema_arrow.names
+    return pd.read_csv(path, sep=csv_separator(path), nrows=0).columns.tolist()
+
+
+def chunk_rows_for(n_columns, chunk_cells=CHUNK_CELLS):
+    # A multiple of 8, so every chunk fills whole bytes of the bitsets
+    return max(8, chunk_cells // max(n_columns, 1) // 8 * 8)
+
+
+def count_rows(path, chunk_rows=65536):
+    if table_format(path) == 'parquet':
+        return pq.ParquetFile(path).metadata.num_rows
+    return sum(len(chunk) for chunk in pd.read_csv(path, sep=csv_separator(path), usecols=[0], chunksize=chunk_rows))
+
+
+def iter_chunks(path, chunk_rows):
+    """Yield a CSV or Parquet table as DataFrames of ``chunk_rows`` rows; the last may be shorter."""
+    if table_format(path) == 'parquet':
+        batches = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows))
+    else:
+        batches = pd.read_csv(path, sep=csv_separator(path), chunksize=chunk_rows)
+    # Parquet batches stop at row-group boundaries; regroup them into full chunks
+    pending, n = [], 0
+    for batch in batches:
+        pending.append(batch)
+        n += len(batch)
+        while n >= chunk_rows:
+            frame = pd.concat(pending, ignore_index=True) if len(pending) > 1 else pending[0]
+            yield frame.iloc[:chunk_rows]
+            pending, n = [frame.iloc[chunk_rows:]], n - chunk_rows
+    if n:
+        yield pd.concat(pending, ignore_index=True)
+
+
+def _encode_categories(values, categories):
+    # Codes of ``values`` in the growing list ``categories``, which gets any new values appended
+    values = pd.Index(np.asarray(values, dtype=object))
+    codes = pd.Index(categories, dtype=object).get_indexer(values)
+    if (codes < 0).any():
+        categories.extend(values[codes < 0].unique())
+        codes = pd.Index(categories, dtype=object).get_indexer(values)
+    return codes.astype(np.int16)
+
+
+def _compiled_paths(path, kind, cache_dir):
+    # The extension stays in the name, so a CSV and a Parquet copy of a table do not collide
+    prefix = os.path.join(cache_dir, f"{os.path.basename(path).replace(' ', '_')}.{kind}")
+    return prefix, f'{prefix}.manifest.json'
+
+
+def _is_current(path, prefix, manifest, files):
+    if manifest is None or manifest.get('version') != _COMPILED_VERSION:
+        return False
+    if not all(os.path.exists(f'{prefix}.{name}') for name in files):
+        return False
+    stat = os.stat(path)
+    return manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns
+
+
+def _manifest(path, **fields):
+    stat = os.stat(path)
+    return {'version': _COMPILED_VERSION, 'source': os.path.basename(path), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns, **fields}
+
+
+def _create_map(path, dtype, shape):
+    # Written under a temporary name and renamed by _finish_map once complete
+    return np.memmap(f'{path}.{os.getpid()}.tmp', dtype=dtype, mode='w+', shape=shape)
+
+
+def _finish_map(array, path):
+    array.flush()
+    os.replace(array.filename, path)
+
+
+def _save_npy(path, array):
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+    _write_atomic(path, write)
+
+
+def _write_samples(path, sample_keys, cancer_codes):
+    table = pa.table({'TCGA Sample': sample_dictionary().decode(sample_keys).astype(str),
+                      'cancer_code': cancer_codes})
+    _write_atomic(path, lambda tmp_path: feather.write_feather(table, tmp_path, compression='uncompressed'))
+
+
+def _read_samples(path):
+    table = feather.read_table(path)
+    sample_keys = sample_dictionary().encode(table['TCGA Sample'].to_numpy())
+    return sample_keys, table['cancer_code'].to_numpy().astype(np.int16)
+
+
+def _compile_gene_loss(path, prefix, manifest_path, chunk_cells):
+    columns = table_columns(path)
+    genes = columns[2:]
+    chunk_rows = chunk_rows_for(len(columns), chunk_cells)
+    n_samples = count_rows(path)
+    if not n_samples:
+        raise ValueError(f'{path} has no samples')
+    shape = (len(genes), (n_samples + 7) // 8)
+    loss_bits = _create_map(f'{prefix}.loss.bits', np.uint8, shape)
+    valid_bits = _create_map(f'{prefix}.valid.bits', np.uint8, shape)
+    sample_keys = np.empty(n_samples, dtype=np.int32)
+    cancer_codes = np.empty(n_samples, dtype=np.int16)
+    cancer_types = []
+    start = 0
+    for chunk in iter_chunks(path, chunk_rows):
+        rows = slice(start, start + len(chunk))
+        sample_keys[rows] = sample_dictionary().encode(chunk['TCGA Sample'])
+        cancer_codes[rows] = _encode_categories(chunk['Cancer type'], cancer_types)
+        values = chunk[genes].to_numpy(dtype=np.float32)
+        valid = ~np.isnan(values)
+        columns = slice(start // 8, (start + len(chunk) + 7) // 8)
+        loss_bits[:, columns] = np.packbits((valid & (values != 0)).T, axis=1)
+        valid_bits[:, columns] = np.packbits(valid.T, axis=1)
+        start += len(chunk)
+    _finish_map(loss_bits, f'{prefix}.loss.bits')
+    _finish_map(valid_bits, f'{prefix}.valid.bits')
+    _write_samples(f'{prefix}.samples.arrow', sample_keys, cancer_codes)
+    manifest = _manifest(path, n_samples=n_samples, genes=genes, cancer_types=cancer_types)
+    _write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def load_gene_loss(path, chunk_cells=CHUNK_CELLS, cache_dir=CACHE_DIR):
+    """GeneLossIndex of a gene-loss workbook, CSV or Parquet table.
+
+    CSV and Parquet tables are compiled chunk by chunk on first use; the index then
+    memory-maps the compiled bitsets.
+    """
+    if table_format(path) == 'excel':
+        return GeneLossIndex.from_frame(read_workbook(path, cache_dir=cache_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix, manifest_path = _compiled_paths(path, 'gene_loss', cache_dir)
+    manifest = _read_manifest(manifest_path)
+    if not _is_current(path, prefix, manifest, ['loss.bits', 'valid.bits', 'samples.arrow']):
+        manifest = _compile_gene_loss(path, prefix, manifest_path, chunk_cells)
+    shape = (len(manifest['genes']), (manifest['n_samples'] + 7) // 8)
+    sample_keys, cancer_codes = _read_samples(f'{prefix}.samples.arrow')
+    return GeneLossIndex(
+        sample_keys=sample_keys,
+        cancer_types=manifest['cancer_types'],
+        cancer_codes=cancer_codes,
+        genes=manifest['genes'],
+        loss_bits=np.memmap(f'{prefix}.loss.bits', dtype=np.uint8, mode='r', shape=shape),
+        valid_bits=np.memmap(f'{prefix}.valid.bits', dtype=np.uint8, mode='r', shape=shape),
+    )
+
+
+def _compile_footprints(path, prefix, manifest_path, chunk_cells):
+    columns = table_columns(path)
+    features = [column.replace('_', ' ') for column in columns[3:]]
+    chunk_rows = chunk_rows_for(len(columns), chunk_cells)
+    n_samples = count_rows(path)
+    if not n_samples:
+        raise ValueError(f'{path} has no samples')
+    values = _create_map(f'{prefix}.values.f32', np.float32, (n_samples, len(features)))
+    sample_keys = np.empty(n_samples, dtype=np.int32)
+    cancer_codes = np.empty(n_samples, dtype=np.int16)
+    cancer_types = []
+    totals = np.zeros((0, 3, len(features)))
+    start = 0
+    for chunk in iter_chunks(path, chunk_rows):
+        chunk = prepare_footprints(chunk)
+        rows = slice(start, start + len(chunk))
+        sample_keys[rows] = sample_dictionary().encode(chunk['TCGA Sample'])
+        codes = _encode_categories(chunk['Cancer type'], cancer_types)
+        cancer_codes[rows] = codes
+        chunk_values = chunk[features].to_numpy(dtype=np.float32)
+        values[rows] = chunk_values
+        if len(cancer_types) > len(totals):
+            totals = np.concatenate([totals, np.zeros((len(cancer_types) - len(totals), 3, len(features)))])
+        np.add.at(totals, codes, sufficient_stats(chunk_values))
+        start += len(chunk)
+    _finish_map(values, f'{prefix}.values.f32')
+    _write_samples(f'{prefix}.samples.arrow', sample_keys, cancer_codes)
+    _save_npy(f'{prefix}.totals.npy', totals)
+    manifest = _manifest(path, n_samples=n_samples, features=features, cancer_types=cancer_types)
+    _write_manifest(manifest_path, manifest)
+    return manifest
+
+
+def load_footprints(path, chunk_cells=CHUNK_CELLS, cache_dir=CACHE_DIR):
+    """FootprintIndex of a footprint workbook (its Sheet1), CSV or Parquet table.
+
+    CSV and Parquet tables are compiled chunk by chunk on first use, summing the
+    cancer-type totals as they go; the index then memory-maps the value matrix.
+    """
+    if table_format(path) == 'excel':
+        return FootprintIndex.from_frame(prepare_footprints(read_workbook(path, sheet_name='Sheet1',
+                                                                          cache_dir=cache_dir)))
+    os.makedirs(cache_dir, exist_ok=True)
+    prefix, manifest_path = _compiled_paths(path, 'footprints', cache_dir)
+    manifest = _read_manifest(manifest_path)
+    if not _is_current(path, prefix, manifest, ['values.f32', 'samples.arrow', 'totals.npy']):
+        manifest = _compile_footprints(path, prefix, manifest_path, chunk_cells)
+    sample_keys, cancer_codes = _read_samples(f'{prefix}.samples.arrow')
+    features = manifest['features']
+    return FootprintIndex(
+        sample_keys=sample_keys,
+        cancer_types=manifest['cancer_types'],
+        cancer_codes=cancer_codes,
+        features=features,
+        values=np.memmap(f'{prefix}.values.f32', dtype=np.float32, mode='r',
+                         shape=(manifest['n_samples'], len(features))),
+        totals=np.load(f'{prefix}.totals.npy'),
+    )
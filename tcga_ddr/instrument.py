@@ -0,0 +1,161 @@
+"""Timing spans around page stages, per-stage latency histograms and per-rerun traces.
+
+Pages wrap each rerun in ``rerun(page)`` and each stage in ``span(stage)``. Every span
+feeds a process-wide histogram (exported in Prometheus text format) and the trace of
+the current rerun; finished reruns are kept in a short history and logged as one JSON
+line on the ``tcga_ddr.timing`` logger. A rerun can optionally be run under cProfile
+and tracemalloc.
+"""
+import cProfile
+import io
+import json
+import logging
+import pstats
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger('tcga_ddr.timing')
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram, as in the Prometheus exposition format."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        position = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+        self.counts[position] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-quantile, the usual histogram estimate
+        if not self.count:
+            return float('nan')
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+
+class Registry:
+    """Process-wide per-stage histograms plus the history of recent reruns."""
+
+    def __init__(self, history=50):
+        self.histograms = {}
+        self.reruns = deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    def summary(self):
+        """One row per stage: count, mean and bucket estimates of the median and 95th percentile."""
+        with self._lock:
+            return [{
+                'stage': stage, 'count': h.count, 'mean_s': h.sum / h.count if h.count else float('nan'),
+                'p50_s': h.quantile(0.5), 'p95_s': h.quantile(0.95), 'total_s': h.sum,
+            } for stage, h in sorted(self.histograms.items())]
+
+    def prometheus_text(self, gauges=None):
+        """Histograms (and optional ``{name: value}`` gauges) in Prometheus text format."""
+        lines = ['# HELP tcga_ddr_stage_seconds Wall time of page stages.',
+                 '# TYPE tcga_ddr_stage_seconds histogram']
+        with self._lock:
+            for stage, h in sorted(self.histograms.items()):
+                label = stage.replace('\\', '\\\\').replace('"', '\\"')
+                cumulative = 0
+                for bound, count in zip(h.buckets + (float('inf'),), h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'tcga_ddr_stage_seconds_bucket{{stage="{label}",le="{le}"}} {cumulative}')
+                lines.append(f'tcga_ddr_stage_seconds_sum{{stage="{label}"}} {h.sum}')
+                lines.append(f'tcga_ddr_stage_seconds_count{{stage="{label}"}} {h.count}')
+        for name, value in (gauges or {}).items():
+            lines += [f'# TYPE tcga_ddr_{name} gauge', f'tcga_ddr_{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+_registry = Registry()
+_local = threading.local()
+
+
+def registry():
+    return _registry
+
+
+def current_trace():
+    # Trace of the rerun running on this thread (Streamlit runs each session's script on its own thread)
+    return getattr(_local, 'trace', None)
+
+
+@contextmanager
+def span(stage):
+    """Time a stage; nested spans are recorded as ``outer/inner``."""
+    trace = current_trace()
+    stack = getattr(_local, 'stack', [])
+    name = '/'.join(stack + [stage])
+    _local.stack = stack + [stage]
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _local.stack = stack
+        _registry.observe(name, seconds)
+        if trace is not None:
+            trace['stages'].append((name, seconds))
+
+
+@contextmanager
+def rerun(page, profile=False, trace_memory=False):
+    """Trace one script run of ``page``; the finished trace goes to the registry's history."""
+    trace = {'page': page, 'started': time.time(), 'stages': [], 'profile': None, 'peak_mb': None}
+    _local.trace = trace
+    _local.stack = []
+    profiler = cProfile.Profile() if profile else None
+    # tracemalloc is process-wide: leave it alone if someone else is already tracing
+    own_tracing = trace_memory and not tracemalloc.is_tracing()
+    if own_tracing:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        with span(page):
+            yield trace
+    finally:
+        trace['seconds'] = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(30)
+            trace['profile'] = out.getvalue()
+        if own_tracing:
+            trace['peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+            tracemalloc.stop()
+        _local.trace = None
+        _registry.reruns.append(trace)
+        stages = {}
+        for name, seconds in trace['stages']:
+            stages[name] = stages.get(name, 0.0) + seconds
+        logger.info(json.dumps({
+            'page': page, 'seconds': round(trace['seconds'], 6), 'peak_mb': trace['peak_mb'],
+            'stages': {name: round(seconds, 6) for name, seconds in stages.items()},
+        }))
@@ -0,0 +1,71 @@
+"""Batched log-rank tests over the death and at-risk matrices of many groups."""
+import itertools
+
+import numpy as np
+from scipy.stats import chi2
+
+# Upper bound on the number of (pair, time) cells evaluated at once
+_BATCH_CELLS = 4_000_000
+
+
+def _event_columns(deaths, at_risk):
+    # Only times with at least one death contribute to any log-rank statistic
+    columns = deaths.sum(axis=0) > 0
+    return deaths[:, columns], at_risk[:, columns]
+
+
+def two_group_logrank(deaths1, at_risk1, deaths2, at_risk2):
+    """Row-wise log-rank test of group 1 against group 2 over (rows x times) matrices.
+
+    Returns ``(statistics, p_values, observed1, expected1)``; observed and expected deaths
+    of group 2 are the totals minus those of group 1.
+    """
+    d = deaths1 + deaths2
+    n = at_risk1 + at_risk2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.where(n > 0, d * at_risk1 / n, 0.0).sum(axis=1)
+        variance = np.where(n > 1, at_risk1 * at_risk2 * d * (n - d) / (n * n * (n - 1)), 0.0).sum(axis=1)
+        observed = deaths1.sum(axis=1)
+        statistics = (observed - expected) ** 2 / variance
+    return statistics, chi2.sf(statistics, 1), observed, expected
+
+
+def pairwise_logrank(deaths, at_risk, pairs=None):
+    """Two-group log-rank statistics and p-values for ``pairs`` of rows (default: all pairs).
+
+    ``deaths`` and ``at_risk`` are (groups x times) matrices on a shared time grid, as
+    returned by ``EndpointData.counts``. Returns ``(pairs, statistics, p_values)``.
+    """
+    deaths, at_risk = _event_columns(deaths, at_risk)
+    if pairs is None:
+        pairs = list(itertools.combinations(range(deaths.shape[0]), 2))
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+    statistics = np.empty(len(pairs))
+    p_values = np.empty(len(pairs))
+
+    batch = max(1, _BATCH_CELLS // max(deaths.shape[1], 1))
+    for start in range(0, len(pairs), batch):
+        a, b = pairs[start:start + batch].T
+        chunk = slice(start, start + batch)
+        statistics[chunk], p_values[chunk], _, _ = two_group_logrank(deaths[a], at_risk[a], deaths[b], at_risk[b])
+    return pairs, statistics, p_values
+
+
+def multivariate_logrank(deaths, at_risk):
+    """Overall k-group log-rank test over the non-empty rows; returns ``(statistic, dof, p_value)``."""
+    present = at_risk[:, 0] > 0 if at_risk.shape[1] else np.zeros(at_risk.shape[0], dtype=bool)
+    deaths, at_risk = _event_columns(deaths[present], at_risk[present])
+    k = deaths.shape[0]
+    if k < 2:
+        return np.nan, 0, np.nan
+
+    d = deaths.sum(axis=0)
+    n = at_risk.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = np.where(n > 0, at_risk / n, 0.0)
+        weight = np.where(n > 1, d * (n - d) / (n - 1), 0.0)
+    z = deaths.sum(axis=1) - (share * d).sum(axis=1)
+    weighted = share * weight
+    covariance = np.diag(weighted.sum(axis=1)) - weighted @ share.T
+    statistic = float(z[:-1] @ np.linalg.pinv(covariance[:-1, :-1]) @ z[:-1])
+    return statistic, k - 1, float(chi2.sf(statistic, k - 1))
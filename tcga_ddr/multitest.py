@@ -0,0 +1,30 @@
+"""Multiple-testing correction of p-values."""
+import numpy as np
+
+CORRECTIONS = {
+    'None': None,
+    'Holm': 'holm',
+    'Benjamini-Hochberg': 'fdr_bh',
+}
+
+
+def adjust_pvalues(p_values, method):
+    """Adjusted p-values for ``method`` in {None, 'holm', 'fdr_bh'}; NaNs are left out and kept."""
+    p_values = np.asarray(p_values, dtype=float)
+    if method is None:
+        return p_values.copy()
+    adjusted = np.full_like(p_values, np.nan)
+    finite = np.flatnonzero(~np.isnan(p_values))
+    m = len(finite)
+    if m == 0:
+        return adjusted
+    order = finite[np.argsort(p_values[finite], kind='stable')]
+    ranked = p_values[order]
+    if method == 'holm':
+        values = np.maximum.accumulate((m - np.arange(m)) * ranked)
+    elif method == 'fdr_bh':
+        values = np.minimum.accumulate((m / np.arange(m, 0, -1) * ranked[::-1]))[::-1]
+    else:
+        raise ValueError(f'Unknown multiple-testing correction: {method}')
+    adjusted[order] = np.minimum(values, 1.0)
+    return adjusted
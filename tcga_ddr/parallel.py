@@ -0,0 +1,127 @@
+"""Process-pool helpers: a shared worker pool and NumPy arrays in shared memory."""
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+MAX_WORKERS = int(os.environ.get('TCGA_DDR_WORKERS', os.cpu_count() or 1))
+
+_executor = None
+# Shared-memory blocks created by this process and not yet released, by name
+_live = {}
+# Blocks mapped by this process, and the call they were mapped for
+_attached = {}
+_scope = None
+
+
+class SharedArray:
+    """Read-only copy of an array in a shared-memory block that workers attach to by name.
+
+    ``spec`` is what gets sent to workers; ``attach(spec, scope)`` maps it without
+    copying. An array that is already a memory-mapped file is not copied: workers map
+    the same file. The block is freed by ``release()``, or when the process exits.
+    """
+
+    def __init__(self, array):
+        if isinstance(array, np.memmap) and array.filename is not None and array.offset == 0:
+            self._shm = None
+            self.spec = ('file', array.filename, array.shape, array.dtype.str)
+            return
+        array = np.ascontiguousarray(array)
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=self._shm.buf)[...] = array
+        self.spec = ('shm', self._shm.name, array.shape, array.dtype.str)
+        _live[self._shm.name] = self._shm
+
+    def release(self):
+        if self._shm is not None:
+            _live.pop(self._shm.name, None)
+            detach(self._shm.name)
+            _unlink(self._shm)
+            self._shm = None
+
+
+def _unlink(shm):
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
+
+
+@atexit.register
+def _release_all():
+    for shm in list(_live.values()):
+        _unlink(shm)
+    _live.clear()
+
+
+def in_process(n_tasks, max_workers=None):
+    """Whether ``iter_tasks`` runs this many tasks in the calling process, so nothing needs sharing."""
+    workers = MAX_WORKERS if max_workers is None else max_workers
+    return workers <= 1 or n_tasks <= 1
+
+
+def attach(spec, scope=None):
+    """The array behind ``spec``; plain arrays are returned as they are.
+
+    Mappings are kept for the tasks of one call, identified by ``scope``. A task of
+    another call unmaps them first, so blocks released in between do not stay mapped.
+    """
+    global _scope
+    if isinstance(spec, np.ndarray):
+        return spec
+    if scope != _scope:
+        for name in list(_attached):
+            detach(name)
+        _scope = scope
+    kind, name, shape, dtype = spec
+    if name not in _attached:
+        if kind == 'file':
+            _attached[name] = (None, np.memmap(name, dtype=dtype, mode='r', shape=shape))
+        else:
+            shm = shared_memory.SharedMemory(name=name)
+            _attached[name] = (shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+    return _attached[name][1]
+
+
+def detach(name):
+    """Unmap a block mapped by ``attach``; views still held elsewhere keep it alive until they go."""
+    shm, _ = _attached.pop(name, (None, None))
+    if shm is not None:
+        try:
+            shm.close()
+        except BufferError:
+            pass
+
+
+def executor():
+    """Process pool shared by every parallel engine; 'spawn' keeps it safe from Streamlit's threads."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def iter_tasks(function, tasks, max_workers=None):
+    """Yield ``(position, function(*task))`` for every task as it completes."""
+    tasks = list(tasks)
+    if in_process(len(tasks), max_workers):
+        for position, task in enumerate(tasks):
+            yield position, function(*task)
+        return
+    futures = {executor().submit(function, *task): position for position, task in enumerate(tasks)}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def run_tasks(function, tasks, max_workers=None):
+    """``[function(*task) for task in tasks]``, spread over the shared pool when useful."""
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+    for position, result in iter_tasks(function, tasks, max_workers):
+        results[position] = result
+    return results
@@ -0,0 +1,250 @@
+"""Exhaustive single-gene and gene-pair deficiency screens ranked by survival difference.
+
+Every candidate defines one deficiency (a gene, or a pair of genes combined with the
+'any'/'all' rule) and splits the selected samples into deficient and proficient cohorts.
+Candidates are processed in batches: the cohort bitsets of a whole batch are unpacked at
+once and every endpoint's deaths and numbers at risk come from one sparse product, so a
+batch costs a few matrix operations. Batches run on the shared process pool and are
+checkpointed, so an interrupted screen resumes where it stopped.
+"""
+import itertools
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import t as t_dist
+
+from tcga_ddr.logrank import two_group_logrank
+from tcga_ddr.multitest import adjust_pvalues
+from tcga_ddr.parallel import SharedArray, attach, in_process, iter_tasks
+
+_worker_cache = {}
+
+
+def candidates(genes, mode):
+    if mode == 'single':
+        return [(gene,) for gene in genes]
+    if mode == 'pairs':
+        return list(itertools.combinations(genes, 2))
+    raise ValueError(f"Screen mode must be 'single' or 'pairs', got {mode!r}")
+
+
+class ScreenContext:
+    """Arrays every batch needs, placed in shared memory once per screen."""
+
+    def __init__(self, datasets, cancer_types, endpoints, features, shared=True):
+        index = datasets.gene_loss
+        arrays = {
+            'loss_bits': index.loss_bits,
+            'valid_bits': index.valid_bits,
+            'member_bits': index.cancer_type_bits(cancer_types),
+        }
+        self.meta = {'n_samples': index.n_samples, 'endpoints': {}, 'features': list(features)}
+        for endpoint in endpoints:
+            endpoint_data = datasets.survival[endpoint]
+            positions = datasets.survival_positions[endpoint_data.rows]
+            keep = positions >= 0
+            arrays[f'{endpoint}.positions'] = positions[keep]
+            arrays[f'{endpoint}.time_index'] = endpoint_data.time_index[keep]
+            arrays[f'{endpoint}.event'] = endpoint_data.event[keep]
+            self.meta['endpoints'][endpoint] = len(endpoint_data.grid)
+        if features:
+            footprint = datasets.footprint
+            keep = datasets.footprint_positions >= 0
+            columns = [footprint.feature_pos[feature] for feature in features]
+            arrays['footprint.positions'] = datasets.footprint_positions[keep]
+            arrays['footprint.stats'] = footprint.sufficient_stats(np.flatnonzero(keep), columns).reshape(int(keep.sum()), -1)
+
+        self.gene_rows = {gene: i for i, gene in enumerate(index.genes)}
+        self._shared = {name: SharedArray(array) for name, array in arrays.items()} if shared else {}
+        self.specs = {name: self._shared[name].spec if shared else array for name, array in arrays.items()}
+        # Identifies this screen's arrays in the workers' caches
+        self.key = os.urandom(8).hex()
+
+    def release(self):
+        for array in self._shared.values():
+            array.release()
+
+
+def _arrays(key, specs, meta):
+    # Workers build the sparse time-grid indicators once per screen
+    if key not in _worker_cache:
+        _worker_cache.clear()
+        arrays = {name: attach(spec, key) for name, spec in specs.items()}
+        indicators = {}
+        for endpoint, n_times in meta['endpoints'].items():
+            time_index = arrays[f'{endpoint}.time_index']
+            m = len(time_index)
+            rows = np.arange(m)
+            removed = sparse.csr_matrix((np.ones(m), (rows, time_index)), shape=(m, n_times))
+            deaths = sparse.csr_matrix((arrays[f'{endpoint}.event'], (rows, time_index)), shape=(m, n_times))
+            indicators[endpoint] = (removed.T.tocsr(), deaths.T.tocsr())
+        _worker_cache[key] = (arrays, indicators)
+    return _worker_cache[key]
+
+
+def _screen_batch(key, specs, meta, gene_rows, rule, min_samples):
+    """Survival and footprint comparisons of deficient vs proficient for a batch of candidates."""
+    arrays, indicators = _arrays(key, specs, meta)
+    n = meta['n_samples']
+    rows = np.asarray(gene_rows)
+    loss = arrays['loss_bits'][rows]
+    deficient_bits = np.bitwise_and.reduce(loss, axis=1) if rule == 'all' else np.bitwise_or.reduce(loss, axis=1)
+    member_bits = np.bitwise_and.reduce(arrays['valid_bits'][rows], axis=1) & arrays['member_bits']
+    member = np.unpackbits(member_bits, axis=1, count=n).astype(bool)
+    deficient = np.unpackbits(deficient_bits, axis=1, count=n).astype(bool) & member
+    proficient = member & ~deficient
+    n_deficient = deficient.sum(axis=1)
+    n_proficient = proficient.sum(axis=1)
+    testable = (n_deficient >= min_samples) & (n_proficient >= min_samples)
+
+    survival = {'n deficient': n_deficient, 'n proficient': n_proficient}
+    for endpoint in meta['endpoints']:
+        positions = arrays[f'{endpoint}.positions']
+        removed_t, deaths_t = indicators[endpoint]
+        counts = []
+        for cohort in (deficient, proficient):
+            weights = cohort[:, positions].T.astype(float)
+            removed = (removed_t @ weights).T
+            at_risk = np.cumsum(removed[:, ::-1], axis=1)[:, ::-1]
+            counts += [(deaths_t @ weights).T, at_risk]
+        statistics, p_values, observed, expected = two_group_logrank(*counts)
+        observed_p = counts[2].sum(axis=1)
+        expected_p = observed + observed_p - expected
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hazard_ratio = (observed / expected) / (observed_p / expected_p)
+        survival[f'{endpoint} statistic'] = np.where(testable, statistics, np.nan)
+        survival[f'{endpoint} p-value'] = np.where(testable, p_values, np.nan)
+        survival[f'{endpoint} HR'] = np.where(testable, hazard_ratio, np.nan)
+
+    footprints = {}
+    features = meta['features']
+    if features:
+        positions = arrays['footprint.positions']
+        stats = arrays['footprint.stats']
+        summaries = []
+        for cohort in (deficient, proficient):
+            totals = (cohort[:, positions].astype(float) @ stats).reshape(len(rows), 3, len(features))
+            count, total, total_sq = totals[:, 0], totals[:, 1], totals[:, 2]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = total / count
+                variance = np.maximum(total_sq - count * mean * mean, 0.0) / (count - 1)
+            summaries.append((count, mean, variance))
+        (n1, m1, v1), (n2, m2, v2) = summaries
+        with np.errstate(divide='ignore', invalid='ignore'):
+            se2 = v1 / n1 + v2 / n2
+            t_stat = (m1 - m2) / np.sqrt(se2)
+            dof = se2 ** 2 / ((v1 / n1) ** 2 / (n1 - 1) + (v2 / n2) ** 2 / (n2 - 1))
+            p = 2 * t_dist.sf(np.abs(t_stat), dof)
+        valid = (n1 >= min_samples) & (n2 >= min_samples)
+        footprints = {'mean deficient': m1, 'mean proficient': m2, 'difference': m1 - m2,
+                      't': np.where(valid, t_stat, np.nan), 'p-value': np.where(valid, p, np.nan)}
+    return survival, footprints
+
+
+def _batch_frames(batch, survival, footprints, features):
+    genes = ['+'.join(candidate) for candidate in batch]
+    survival_table = pd.DataFrame({'Genes': genes, **survival})
+    footprint_table = None
+    if features:
+        footprint_table = pd.DataFrame({
+            'Genes': np.repeat(genes, len(features)),
+            'Feature': np.tile(features, len(genes)),
+            **{name: values.ravel() for name, values in footprints.items()},
+        })
+    return survival_table, footprint_table
+
+
+def run_screen(datasets, genes, mode='pairs', rule='all', cancer_types=None, endpoints=('OS',),
+               features=(), rank_by=None, min_samples=10, batch_size=256, checkpoint_dir=None,
+               versions=None, max_workers=None, progress=None):
+    """Ranked survival table and long footprint table for every gene or gene pair.
+
+    With ``checkpoint_dir`` every finished batch is written there and reused when the
+    same screen is started again on the same data; ``versions`` maps 'gene_loss',
+    'survival' and 'footprint' to the ``source_version`` of the files ``datasets`` was
+    loaded from. ``progress(done, total)`` is called after each batch.
+    """
+    endpoints = list(endpoints)
+    rank_by = rank_by or endpoints[0]
+    if rank_by not in endpoints:
+        raise ValueError(f"Cannot rank by {rank_by!r}, which is not among the endpoints: {', '.join(endpoints)}")
+    cancer_types = list(datasets.gene_loss.cancer_types) if cancer_types is None else list(cancer_types)
+    features = list(features)
+    all_candidates = candidates(list(genes), mode)
+    batches = [all_candidates[i:i + batch_size] for i in range(0, len(all_candidates), batch_size)]
+
+    done = {}
+    if checkpoint_dir:
+        done = _open_checkpoints(checkpoint_dir, {
+            'mode': mode, 'rule': rule, 'genes': list(genes), 'cancer_types': sorted(map(str, cancer_types)),
+            'endpoints': endpoints, 'features': features, 'min_samples': min_samples, 'batch_size': batch_size,
+            'sources': versions or {},
+        }, len(batches))
+    if progress:
+        progress(len(done), len(batches))
+
+    pending = [i for i in range(len(batches)) if i not in done]
+    if pending:
+        # Batches run in this process need no shared copies
+        context = ScreenContext(datasets, cancer_types, endpoints, features,
+                                shared=not in_process(len(pending), max_workers))
+        try:
+            tasks = [(context.key, context.specs, context.meta,
+                      [[context.gene_rows[gene] for gene in candidate] for candidate in batches[i]],
+                      rule, min_samples) for i in pending]
+            for position, (survival, footprints) in iter_tasks(_screen_batch, tasks, max_workers):
+                i = pending[position]
+                done[i] = _batch_frames(batches[i], survival, footprints, features)
+                if checkpoint_dir:
+                    _write_checkpoint(checkpoint_dir, i, *done[i])
+                if progress:
+                    progress(len(done), len(batches))
+        finally:
+            context.release()
+            _worker_cache.pop(context.key, None)
+
+    survival_table = pd.concat([done[i][0] for i in range(len(batches))], ignore_index=True)
+    for endpoint in endpoints:
+        survival_table[f'{endpoint} q-value'] = adjust_pvalues(survival_table[f'{endpoint} p-value'], 'fdr_bh')
+    survival_table = survival_table.sort_values(f'{rank_by} p-value', kind='stable', na_position='last')
+    survival_table = survival_table.reset_index(drop=True)
+
+    footprint_table = None
+    if features:
+        footprint_table = pd.concat([done[i][1] for i in range(len(batches))], ignore_index=True)
+        footprint_table['q-value'] = adjust_pvalues(footprint_table['p-value'], 'fdr_bh')
+        footprint_table = footprint_table.sort_values('p-value', kind='stable', na_position='last').reset_index(drop=True)
+    return survival_table, footprint_table
+
+
+def _open_checkpoints(checkpoint_dir, settings, n_batches):
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest = os.path.join(checkpoint_dir, 'screen.json')
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            if json.load(f) != settings:
+                raise ValueError(f'{checkpoint_dir} holds checkpoints of a different screen')
+    else:
+        with open(manifest, 'w') as f:
+            json.dump(settings, f)
+
+    done = {}
+    for i in range(n_batches):
+        survival_path = os.path.join(checkpoint_dir, f'batch_{i:05d}.survival.parquet')
+        if os.path.exists(survival_path):
+            footprint_path = os.path.join(checkpoint_dir, f'batch_{i:05d}.footprints.parquet')
+            footprint_table = pd.read_parquet(footprint_path) if os.path.exists(footprint_path) else None
+            done[i] = (pd.read_parquet(survival_path), footprint_table)
+    return done
+
+
+def _write_checkpoint(checkpoint_dir, i, survival_table, footprint_table):
+    # The survival file marks the batch as done, so it is written last
+    if footprint_table is not None:
+        footprint_table.to_parquet(os.path.join(checkpoint_dir, f'batch_{i:05d}.footprints.parquet'), index=False)
+    path = os.path.join(checkpoint_dir, f'batch_{i:05d}.survival.parquet')
+    survival_table.to_parquet(f'{path}.tmp', index=False)
+    os.replace(f'{path}.tmp', path)
@@ -0,0 +1,91 @@
+"""Process-wide stores of computed cohorts and of results derived from them, shared by every session and page.
+
+Both live in one ResultCache, so a single memory budget (``TCGA_DDR_CACHE_MB``) bounds
+everything that is kept between reruns.
+"""
+import zlib
+
+import numpy as np
+
+from tcga_ddr.cache import ResultCache, canonical_key
+from tcga_ddr.cohorts import CohortSet
+
+
+def definition_key(deficiencies, selected_cancer_types, version):
+    # Genes and cancer types are sets; deficiency order is kept because it names the cohorts
+    return canonical_key(
+        'cohorts',
+        [[d['name'], frozenset(d['genes']), d['mutation_type']] for d in deficiencies],
+        frozenset(str(ct) for ct in selected_cancer_types),
+        version,
+    )
+
+
+class CohortStore:
+    """Map from a definition key to zlib-compressed cohort codes over the sample table."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def put(self, key, cohorts):
+        blob = zlib.compress(cohorts.codes.astype(np.int16).tobytes())
+        fingerprints = cohorts.fingerprints()
+        self.cache.put(('cohorts', key), (cohorts.index, cohorts.names, blob, fingerprints, cohorts.definition),
+                       nbytes=len(blob) + 40 * len(fingerprints))
+
+    def get(self, key):
+        entry = self.cache.get(('cohorts', key))
+        if entry is None:
+            return None
+        index, names, blob, fingerprints, definition = entry
+        codes = np.frombuffer(zlib.decompress(blob), dtype=np.int16)
+        return CohortSet(index, names, codes, fingerprints, definition)
+
+    def __contains__(self, key):
+        return ('cohorts', key) in self.cache
+
+
+class CohortResults:
+    """Map from ``(kind, cohort fingerprint)`` to the arrays computed for one cohort.
+
+    ``kind`` names the computation and the data it ran on, e.g. ``('survival', 'OS',
+    version)``. Because fingerprints only change with a cohort's membership, editing one
+    deficiency invalidates exactly the cohorts whose samples moved.
+    """
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def rows(self, kind, fingerprints, compute):
+        """Stacked results of the cohorts with ``fingerprints``, computing only the missing ones.
+
+        ``compute(missing)`` gets the positions of the uncached cohorts and returns their
+        results stacked along the first axis, in the same order.
+        """
+        cached = {fp: self.cache.get(('result', kind, fp)) for fp in dict.fromkeys(fingerprints)}
+        missing_fps = [fp for fp, value in cached.items() if value is None]
+        if missing_fps:
+            first = {fp: i for i, fp in reversed(list(enumerate(fingerprints)))}
+            computed = compute([first[fp] for fp in missing_fps])
+            for fp, value in zip(missing_fps, computed):
+                value = value.copy()
+                value.setflags(write=False)
+                cached[fp] = self.cache.put(('result', kind, fp), value)
+        return np.stack([cached[fp] for fp in fingerprints]) if fingerprints else None
+
+
+_shared_cache = ResultCache()
+_shared_store = CohortStore(_shared_cache)
+_shared_results = CohortResults(_shared_cache)
+
+
+def shared_cache():
+    return _shared_cache
+
+
+def shared_store():
+    return _shared_store
+
+
+def shared_results():
+    return _shared_results
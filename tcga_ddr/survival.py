@@ -0,0 +1,206 @@
+"""Pre-sorted survival endpoints and a Kaplan-Meier engine for many cohorts at once."""
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from tcga_ddr.cohorts import cohort_labels
+from tcga_ddr.data import read_only, sample_dictionary
+
+ENDPOINTS = ['OS', 'DSS', 'DFI', 'PFI']
+DAYS_PER_YEAR = 365.25
+# Times (in years) at which the survival table reports survival and numbers at risk
+LANDMARK_YEARS = (1, 3, 5)
+RMST_HORIZON_YEARS = 5
+
+
+class EndpointData:
+    """One endpoint's (time, event) pairs with NaNs removed, sorted by time.
+
+    ``rows`` maps back to rows of the survival table and ``time_index`` points every
+    observation at its slot in ``grid``, the sorted unique observation times.
+    """
+
+    def __init__(self, rows, time, event):
+        order = np.argsort(time, kind='stable')
+        self.rows = rows[order].astype(np.int32)
+        self.time = time[order]
+        self.event = event[order]
+        self.grid, time_index = np.unique(self.time, return_inverse=True)
+        self.time_index = time_index.astype(np.int32)
+        read_only(self.rows, self.time, self.event, self.grid, self.time_index)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.rows, self.time, self.event, self.grid, self.time_index))
+
+    def labels(self, codes, selected_codes):
+        # Position of each observation's cohort in ``selected_codes``, or -1
+        return cohort_labels(codes[self.rows], selected_codes)
+
+    def counts(self, labels, n_groups):
+        """Deaths, removals (deaths + censored) and number at risk on the shared grid."""
+        keep = labels >= 0
+        n_times = len(self.grid)
+        keys = labels[keep] * n_times + self.time_index[keep]
+        size = n_groups * n_times
+        deaths = np.bincount(keys, weights=self.event[keep], minlength=size).reshape(n_groups, n_times)
+        removed = np.bincount(keys, minlength=size).reshape(n_groups, n_times).astype(float)
+        at_risk = np.cumsum(removed[:, ::-1], axis=1)[:, ::-1]
+        return deaths, removed, at_risk
+
+
+class SurvivalIndex:
+    """Survival table split into one pre-sorted EndpointData per endpoint.
+
+    Any further numeric columns are kept as ``covariates`` for the Cox model.
+    """
+
+    def __init__(self, data):
+        self.sample_keys = sample_dictionary().encode(data['TCGA Sample'])
+        read_only(self.sample_keys)
+        self.endpoints = {}
+        for endpoint in ENDPOINTS:
+            time = data[f'{endpoint}.time'].to_numpy(dtype=float)
+            event = data[endpoint].to_numpy(dtype=float)
+            valid = ~(np.isnan(time) | np.isnan(event))
+            self.endpoints[endpoint] = EndpointData(np.flatnonzero(valid), time[valid], event[valid])
+        known = {'TCGA Sample', 'Cancer type'} | set(ENDPOINTS) | {f'{endpoint}.time' for endpoint in ENDPOINTS}
+        self.covariates = [column for column in data.columns
+                           if column not in known and pd.api.types.is_numeric_dtype(data[column])]
+        self.covariate_values = data[self.covariates].to_numpy(dtype=np.float32)
+        read_only(self.covariate_values)
+
+    def __getitem__(self, endpoint):
+        return self.endpoints[endpoint]
+
+    @property
+    def sample_ids(self):
+        return sample_dictionary().decode(self.sample_keys)
+
+    @property
+    def nbytes(self):
+        return (self.sample_keys.nbytes + self.covariate_values.nbytes
+                + sum(endpoint.nbytes for endpoint in self.endpoints.values()))
+
+
+def median_survival(grid, survival):
+    """First time each row of ``survival`` drops to 0.5 or below; infinite if it never does."""
+    below = survival <= 0.5
+    return np.where(below.any(axis=1), grid[np.argmax(below, axis=1)], np.inf)
+
+
+def restricted_mean(grid, survival, horizon):
+    """Area under each row's step function from 0 to ``horizon``, i.e. the RMST."""
+    # S is 1 until the first grid time and survival[:, i] from grid[i] until grid[i + 1]
+    edges = np.minimum(np.concatenate([[0.0], grid, [np.inf]]), horizon)
+    steps = np.concatenate([np.ones((len(survival), 1)), survival], axis=1)
+    return (steps * np.diff(edges)).sum(axis=1)
+
+
+class KaplanMeier:
+    """Kaplan-Meier estimates of several groups on one shared time grid.
+
+    Confidence intervals use the exponential Greenwood (log(-log)) transform, as lifelines does.
+    """
+
+    def __init__(self, grid, deaths, removed, at_risk, alpha=0.05):
+        self.grid = grid
+        self.deaths = deaths
+        self.removed = removed
+        self.at_risk = at_risk
+        self.n = removed.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            hazard = np.where(at_risk > 0, deaths / at_risk, 0.0)
+            self.survival = np.cumprod(1.0 - hazard, axis=1)
+            variance = np.cumsum(np.where(deaths > 0, deaths / (at_risk * (at_risk - deaths)), 0.0), axis=1)
+            z = norm.ppf(1 - alpha / 2)
+            log_s = np.log(self.survival)
+            self.lower = np.exp(-np.exp(np.log(-log_s) - z * np.sqrt(variance) / log_s))
+            self.upper = np.exp(-np.exp(np.log(-log_s) + z * np.sqrt(variance) / log_s))
+        # The band is undefined where S is 0 or 1 and collapses onto the curve there
+        self.lower = np.where(np.isnan(self.lower), self.survival, self.lower)
+        self.upper = np.where(np.isnan(self.upper), self.survival, self.upper)
+
+    @classmethod
+    def fit(cls, endpoint_data, labels, n_groups, alpha=0.05):
+        deaths, removed, at_risk = endpoint_data.counts(labels, n_groups)
+        return cls(endpoint_data.grid, deaths, removed, at_risk, alpha=alpha)
+
+    def at(self, times):
+        """Survival and number at risk of every group at each of ``times``.
+
+        Survival is NaN past a group's last observation, unless the curve has reached 0.
+        """
+        times = np.asarray(times, dtype=float)
+        last = np.searchsorted(self.grid, times, side='right') - 1
+        survival = np.where(last >= 0, self.survival[:, np.maximum(last, 0)], 1.0)
+        following = np.searchsorted(self.grid, times, side='left')
+        at_risk = np.zeros((len(self.n), len(times)))
+        inside = following < len(self.grid)
+        at_risk[:, inside] = self.at_risk[:, following[inside]]
+        # Last time at which each group still had someone under observation
+        observed = self.removed > 0
+        last_index = len(self.grid) - 1 - np.argmax(observed[:, ::-1], axis=1)
+        last_time = np.where(observed.any(axis=1), self.grid[last_index], -np.inf)
+        survival = np.where((times[None, :] <= last_time[:, None]) | (survival == 0), survival, np.nan)
+        return survival, at_risk
+
+    def summary(self, horizon, landmarks=LANDMARK_YEARS):
+        """Per-group n, events, median survival, RMST up to ``horizon`` and landmark survival.
+
+        ``horizon`` is in days and ``landmarks`` in years.
+        """
+        survival, at_risk = self.at(np.asarray(landmarks, dtype=float) * DAYS_PER_YEAR)
+        empty = self.n == 0
+        table = {'n': self.n, 'Events': self.deaths.sum(axis=1),
+                 'Median': np.where(empty, np.nan, median_survival(self.grid, self.survival)),
+                 'RMST': np.where(empty, np.nan, restricted_mean(self.grid, self.survival, horizon))}
+        for j, years in enumerate(landmarks):
+            table[f'Survival {years:g}y'] = survival[:, j]
+            table[f'At risk {years:g}y'] = at_risk[:, j]
+        return table
+
+    def curve(self, group):
+        """Step-function points of one group: time 0 plus every time the group has observations."""
+        observed = self.removed[group] > 0
+        time = self.grid[observed]
+        arrays = [self.survival[group][observed], self.lower[group][observed], self.upper[group][observed]]
+        if len(time) == 0 or time[0] > 0:
+            time = np.concatenate([[0.0], time])
+            arrays = [np.concatenate([[1.0], values]) for values in arrays]
+        return (time, *arrays)
+
+
+def landmark_table(survival_index, codes, strata, group_names, cancer_types, horizon, endpoints=ENDPOINTS,
+                   landmarks=LANDMARK_YEARS):
+    """Survival summary of every group x endpoint x cancer type, plus the group over all types.
+
+    ``codes`` gives the group of every row of the survival table (-1 if none) and
+    ``strata`` its cancer type code. Groups and cancer types are counted together with
+    one bincount per endpoint; the pooled rows are sums of the per-type counts.
+    """
+    n_groups, n_types = len(group_names), len(cancer_types)
+    columns = ['Endpoint', 'Group', 'Cancer type']
+    frames = []
+    for endpoint in endpoints:
+        data = survival_index[endpoint]
+        group, stratum = codes[data.rows].astype(np.int64), strata[data.rows]
+        labels = np.where((group >= 0) & (stratum >= 0), group * n_types + stratum, -1)
+        deaths, removed, at_risk = data.counts(labels, n_groups * n_types)
+        # Each group's per-type rows followed by its pooled row
+        shape = (n_groups, n_types, len(data.grid))
+        deaths, removed, at_risk = (np.concatenate([a.reshape(shape), a.reshape(shape).sum(axis=1, keepdims=True)],
+                                                   axis=1).reshape(-1, len(data.grid))
+                                    for a in (deaths, removed, at_risk))
+        km = KaplanMeier(data.grid, deaths, removed, at_risk)
+        frame = pd.DataFrame(km.summary(horizon, landmarks))
+        frame.insert(0, 'Endpoint', endpoint)
+        frame.insert(1, 'Group', np.repeat(group_names, n_types + 1))
+        frame.insert(2, 'Cancer type', np.tile(np.array(list(cancer_types) + ['All'], dtype=object), n_groups))
+        frames.append(frame[frame['n'] > 0])
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    table = pd.concat(frames, ignore_index=True)
+    counts = ['n', 'Events'] + [f'At risk {years:g}y' for years in landmarks]
+    table[counts] = table[counts].astype(int)
+    return table
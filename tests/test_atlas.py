@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from tcga_ddr.analysis import Datasets
+from tcga_ddr.atlas import build_atlas, load_atlas
+from tcga_ddr.cohorts import ANY_GENES, cohort_labels
+from tcga_ddr.footprints import FootprintIndex
+from tcga_ddr.survival import ENDPOINTS, SurvivalIndex
+
+
+@pytest.fixture(scope='module')
+def datasets():
+    n = 2000
+    return Datasets(synthetic.gene_loss_index(n, 12, seed=0), SurvivalIndex(synthetic.survival_frame(n, seed=1)),
+                    FootprintIndex.from_frame(synthetic.footprint_frame(n, seed=2)))
+
+
+@pytest.fixture(scope='module')
+def atlas(datasets, tmp_path_factory):
+    path = tmp_path_factory.mktemp('atlas')
+    versions = {'gene_loss': 'g', 'survival': 's', 'footprint': 'f'}
+    build_atlas(datasets, str(path), versions, genes=datasets.gene_loss.genes[:4], batch_size=3)
+    return load_atlas(str(path))
+
+
+@pytest.mark.parametrize('gene', [0, 3])
+@pytest.mark.parametrize('n_types', [None, 3])
+def test_atlas_sums_equal_live_computation(datasets, atlas, gene, n_types):
+    index = datasets.gene_loss
+    gene = index.genes[gene]
+    cancer_types = list(index.cancer_types)[:n_types]
+    cohorts = index.assign([{'name': gene, 'genes': [gene], 'mutation_type': ANY_GENES}], cancer_types)
+    for endpoint in ENDPOINTS:
+        data = datasets.survival[endpoint]
+        labels = data.labels(cohorts.codes_for(datasets.survival_positions), [0, 1])
+        live = np.stack(data.counts(labels, 2), axis=1)
+        np.testing.assert_allclose(atlas.survival_counts(endpoint, gene, cancer_types, [0, 1]), live)
+    labels = cohort_labels(cohorts.codes_for(datasets.footprint_positions), [0, 1])
+    live = datasets.footprint.aggregate(labels, 2).stats
+    np.testing.assert_allclose(atlas.footprint_stats(gene, cancer_types, [0, 1]), live, rtol=1e-9, atol=1e-6)
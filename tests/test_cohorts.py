@@ -0,0 +1,57 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tcga_ddr.cohorts import ALL_GENES, ANY_GENES, GeneLossIndex
+
+
+def _frame(n=200, seed=0):
+    rng = np.random.default_rng(seed)
+    values = rng.choice([0.0, 1.0, 2.0, np.nan], size=(n, 4), p=[0.5, 0.3, 0.1, 0.1])
+    data = pd.DataFrame(values, columns=['G1', 'G2', 'G3', 'G4'])
+    data.insert(0, 'TCGA Sample', [f'S-{i:04d}' for i in range(n)])
+    data.insert(1, 'Cancer type', rng.choice(['BRCA', 'OV', 'UCEC'], size=n))
+    return data
+
+
+def _baseline(data, deficiencies, cancer_types):
+    # The set logic the groups page used before the bitset index
+    filtered = data[data['Cancer type'].isin(cancer_types)]
+    for deficiency in deficiencies:
+        if deficiency['genes']:
+            filtered = filtered.dropna(subset=deficiency['genes'])
+    results = {}
+    for deficiency in deficiencies:
+        genes = deficiency['genes']
+        if not genes:
+            results[deficiency['name']] = {'d': set(), 'p': set()}
+            continue
+        lost = filtered[genes].any(axis=1) if deficiency['mutation_type'] == ANY_GENES else filtered[genes].all(axis=1)
+        results[deficiency['name']] = {'d': set(filtered[lost]['TCGA Sample']),
+                                       'p': set(filtered[~lost]['TCGA Sample'])}
+    groups = {}
+    for comb in itertools.product(['d', 'p'], repeat=len(deficiencies)):
+        samples = set(filtered['TCGA Sample'])
+        for status, deficiency in zip(comb, deficiencies):
+            samples &= results[deficiency['name']][status]
+        groups['-'.join(f'{status}{d["name"]}' for status, d in zip(comb, deficiencies))] = samples
+    return groups
+
+
+@pytest.mark.parametrize('deficiencies', [
+    [{'name': 'A', 'genes': ['G1'], 'mutation_type': ANY_GENES}],
+    [{'name': 'A', 'genes': ['G1', 'G2'], 'mutation_type': ANY_GENES},
+     {'name': 'B', 'genes': ['G2', 'G3'], 'mutation_type': ALL_GENES}],
+    [{'name': 'A', 'genes': ['G1'], 'mutation_type': ALL_GENES},
+     {'name': 'B', 'genes': ['G3', 'G4'], 'mutation_type': ANY_GENES},
+     {'name': 'C', 'genes': ['G2', 'G4'], 'mutation_type': ALL_GENES}],
+    [{'name': 'A', 'genes': ['G1'], 'mutation_type': ANY_GENES},
+     {'name': 'B', 'genes': [], 'mutation_type': ANY_GENES}],
+])
+@pytest.mark.parametrize('cancer_types', [['BRCA', 'OV', 'UCEC'], ['OV']])
+def test_assign_matches_set_logic(deficiencies, cancer_types):
+    data = _frame()
+    cohorts = GeneLossIndex.from_frame(data).assign(deficiencies, cancer_types)
+    assert cohorts.to_dict() == _baseline(data, deficiencies, cancer_types)
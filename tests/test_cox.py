@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from tcga_ddr.cox import compare_cohorts, fit
+
+lifelines = pytest.importorskip('lifelines')
+
+
+def _data(n=800, seed=0):
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(0, 4, n)
+    strata = rng.integers(0, 3, n)
+    covariates = rng.normal(size=(n, 2))
+    hazard = np.exp(0.3 * labels - 0.2 * strata + 0.5 * covariates[:, 0])
+    # Rounded times give ties, within and across strata
+    time = np.ceil(rng.exponential(500 / hazard) / 20) * 20
+    event = rng.random(n) < 0.7
+    return time, event, strata, labels, covariates
+
+
+def _lifelines(time, event, strata, X):
+    frame = pd.DataFrame(X, columns=[f'x{j}' for j in range(X.shape[1])])
+    frame['T'], frame['E'], frame['stratum'] = time, event, strata
+    return lifelines.CoxPHFitter().fit(frame, 'T', 'E', strata=['stratum']).summary
+
+
+def test_fit_matches_lifelines():
+    time, event, strata, labels, covariates = _data()
+    X = np.column_stack([labels == 2, covariates])
+    beta, covariance, _, converged = fit(time, event, strata, X)
+    reference = _lifelines(time, event, strata, X)
+    assert converged
+    np.testing.assert_allclose(beta, reference['coef'], rtol=1e-6)
+    np.testing.assert_allclose(np.sqrt(np.diag(covariance)), reference['se(coef)'], rtol=1e-6)
+
+
+@pytest.mark.parametrize('adjusted', [False, True])
+@pytest.mark.parametrize('max_workers', [1, 2])
+def test_compare_cohorts_matches_lifelines(adjusted, max_workers):
+    time, event, strata, labels, covariates = _data()
+    grid, slots = np.unique(time, return_inverse=True)
+    table = compare_cohorts(time, event, slots, len(grid), strata, labels, 4, 0,
+                            covariates=covariates if adjusted else None,
+                            covariate_names=['a', 'b'] if adjusted else (), max_workers=max_workers, batch_size=1)
+    for g in (1, 2, 3):
+        keep = np.isin(labels, [0, g])
+        X = (labels[keep] == g)[:, None]
+        if adjusted:
+            X = np.column_stack([X, covariates[keep]])
+        reference = _lifelines(time[keep], event[keep], strata[keep], X)
+        row = table[table['group'] == g].iloc[0]
+        assert row['converged']
+        assert row['coef'] == pytest.approx(reference['coef'].iloc[0], rel=1e-6)
+        assert row['se'] == pytest.approx(reference['se(coef)'].iloc[0], rel=1e-6)
+        assert row['p-value'] == pytest.approx(reference['p'].iloc[0], rel=1e-5)
+        if adjusted:
+            assert row['a HR'] == pytest.approx(reference['exp(coef)'].iloc[1], rel=1e-6)
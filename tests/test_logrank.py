@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from tcga_ddr.logrank import multivariate_logrank, pairwise_logrank
+from tcga_ddr.survival import EndpointData
+
+statistics = pytest.importorskip('lifelines.statistics')
+
+
+def _data(n_groups=3, n=300, seed=0):
+    rng = np.random.default_rng(seed)
+    # Rounded times give ties, within and across groups
+    labels = rng.integers(0, n_groups, n)
+    time = np.ceil(rng.exponential(100 * (1 + labels)) / 10) * 10
+    event = (rng.random(n) < 0.7).astype(float)
+    return time, event, labels
+
+
+def test_pairwise_logrank_matches_lifelines():
+    time, event, labels = _data()
+    data = EndpointData(np.arange(len(time)), time, event)
+    deaths, _, at_risk = data.counts(labels[data.rows], 3)
+    pairs, stats, p_values = pairwise_logrank(deaths, at_risk)
+    for (i, j), statistic, p in zip(pairs, stats, p_values):
+        reference = statistics.logrank_test(time[labels == i], time[labels == j],
+                                            event[labels == i], event[labels == j])
+        assert statistic == pytest.approx(reference.test_statistic, rel=1e-9)
+        assert p == pytest.approx(reference.p_value, rel=1e-9)
+
+
+def test_multivariate_logrank_matches_lifelines():
+    time, event, labels = _data(n_groups=4)
+    data = EndpointData(np.arange(len(time)), time, event)
+    deaths, _, at_risk = data.counts(labels[data.rows], 4)
+    statistic, dof, p = multivariate_logrank(deaths, at_risk)
+    reference = statistics.multivariate_logrank_test(time, labels, event)
+    assert dof == 3
+    assert statistic == pytest.approx(reference.test_statistic, rel=1e-9)
+    assert p == pytest.approx(reference.p_value, rel=1e-9)
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from tcga_ddr.survival import KaplanMeier
+
+lifelines = pytest.importorskip('lifelines')
+
+
+def _fit(time, event):
+    # One group's counts on the grid of its distinct times
+    grid, slot = np.unique(time, return_inverse=True)
+    deaths = np.bincount(slot, weights=event, minlength=len(grid))[None, :]
+    removed = np.bincount(slot, minlength=len(grid)).astype(float)[None, :]
+    at_risk = removed[:, ::-1].cumsum(axis=1)[:, ::-1]
+    return KaplanMeier(grid, deaths, removed, at_risk)
+
+
+@pytest.mark.parametrize('event', [[1, 1, 1, 1, 1, 1], [1, 0, 1, 1, 0, 1]])
+def test_confidence_band_matches_lifelines(event):
+    time = np.array([5.0, 8.0, 8.0, 12.0, 20.0, 30.0])
+    event = np.array(event, dtype=float)
+    km = _fit(time, event)
+    reference = lifelines.KaplanMeierFitter().fit(time, event)
+    band = reference.confidence_interval_survival_function_.loc[km.grid]
+    np.testing.assert_allclose(km.survival[0], reference.survival_function_.loc[km.grid].iloc[:, 0])
+    np.testing.assert_allclose(km.lower[0], band.iloc[:, 0], atol=1e-9)
+    np.testing.assert_allclose(km.upper[0], band.iloc[:, 1], atol=1e-9)
+
+
+def test_landmarks_past_the_last_observation():
+    # Everyone died: survival stays 0. Censored tail: survival is unknown.
+    km = _fit(np.array([5.0, 8.0, 12.0]), np.array([1.0, 1.0, 1.0]))
+    survival, _ = km.at([10.0, 100.0])
+    np.testing.assert_allclose(survival[0], [1 / 3, 0.0])
+    km = _fit(np.array([5.0, 8.0, 12.0]), np.array([1.0, 1.0, 0.0]))
+    survival, _ = km.at([10.0, 100.0])
+    np.testing.assert_allclose(survival[0], [1 / 3, np.nan])